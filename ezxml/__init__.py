@@ -1,16 +1,277 @@
+import array
+import codecs
+import contextlib
+import hashlib
+import io
+import keyword
+import mmap as _mmap
+import multiprocessing
+import os
+import re
+import struct
+import sys
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from functools import partial
+from timeit import default_timer as _timer
+
 try:
     import simplejson as json
 except ImportError:
     import json
 
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 try:
     import xml.etree.cElementTree as ElementTree
 except ImportError:
     import xml.etree.ElementTree as ElementTree
 
+from xml.parsers import expat
+
+
+class Instrumentation(object):
+    """
+    Statistics collected by ezxml while instrument() is active:
+
+        seconds            wall time per phase: 'parse' (building the element
+                           tree), 'convert' (arrayify_etree()),
+                           'parse_convert' (the expat backend, which does both
+                           at once) and 'wrap' (allocating Objectifiers while
+                           navigating)
+        calls              the number of times each phase ran
+        nodes, leaves      elements converted, and those without children
+        coercion_failures  leaf texts that a type rejected with ValueError
+                           after its prefilter accepted them, or that didn't
+                           convert to their tag's hinted type
+        wrappers           Objectifiers allocated while navigating
+
+    Counters are updated without locking, to keep instrumented parses
+    cheap: while several threads parse inside instrument(), an increment
+    made at the same moment by two of them may be lost, so the counts are
+    a lower bound. Time spent in concurrent threads adds up, and can exceed
+    the wall time of the block.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+        self.nodes = 0
+        self.leaves = 0
+        self.coercion_failures = 0
+        self.wrappers = 0
+
+    def add_time(self, phase, seconds):
+        self.seconds[phase] = self.seconds.get(phase, 0.0) + seconds
+        self.calls[phase] = self.calls.get(phase, 0) + 1
+
+    def as_dict(self):
+        """
+        Returns the statistics as a dict of plain values, e.g. for a metrics
+        pipeline.
+        """
+        return {
+            'seconds': dict(self.seconds),
+            'calls': dict(self.calls),
+            'nodes': self.nodes,
+            'leaves': self.leaves,
+            'coercion_failures': self.coercion_failures,
+            'wrappers': self.wrappers,
+        }
+
+
+#: The active Instrumentation, or None; checked by the instrumented code
+_instrumentation = None
+
+# Every Instrumentation of an instrument() block that hasn't ended yet, in
+# the order the blocks started
+_collectors = []
+_collectors_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def instrument(stats=None):
+    """
+    Collects statistics about everything ezxml does in the process (in all
+    threads) inside the with block into stats, a new Instrumentation unless
+    one is given to accumulate into, and yields it:
+
+        with ezxml.instrument() as stats:
+            obj = ezxml.fromstring(xml)
+            obj.Items.Item[0].ISBN
+        metrics.send(stats.as_dict())
+
+    While blocks overlap, whether nested or in different threads, the
+    statistics go to the most recently started block that hasn't ended.
+    Outside of instrument() the instrumented code only checks a module
+    global, so it costs next to nothing.
+    """
+    global _instrumentation
+
+    if stats is None:
+        stats = Instrumentation()
+    with _collectors_lock:
+        _collectors.append(stats)
+        _instrumentation = stats
+    try:
+        yield stats
+    finally:
+        # Blocks in different threads don't necessarily end in the reverse
+        # order that they started in
+        with _collectors_lock:
+            for i in range(len(_collectors) - 1, -1, -1):
+                if _collectors[i] is stats:
+                    del _collectors[i]
+                    break
+            _instrumentation = _collectors[-1] if _collectors else None
+
+
+def _count_coercion_failure():
+    stats = _instrumentation
+    if stats is not None:
+        stats.coercion_failures += 1
+
+
+def _timed(phase, func, *args, **kwargs):
+    """
+    Calls func, adding the time it takes to phase if instrument() is active.
+    """
+    stats = _instrumentation
+    if stats is None:
+        return func(*args, **kwargs)
+    start = _timer()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        stats.add_time(phase, _timer() - start)
+
+
+class Budget(object):
+    """
+    Limits on the resources a single parse may use, enforced while the
+    document is parsed and converted (None means no limit):
+
+        max_depth  elements open at once
+        max_nodes  elements in total
+        max_text   characters of text in total
+        timeout    seconds from the start of the parse, checked every 64
+                   elements and whenever text is counted
+
+    A Budget holds no state of its own, so one can be shared by any number
+    of parses.
+    """
+
+    __slots__ = ('max_depth', 'max_nodes', 'max_text', 'timeout')
+
+    def __init__(self, max_depth=None, max_nodes=None, max_text=None, timeout=None):
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+        self.max_text = max_text
+        self.timeout = timeout
+
+    def __getstate__(self):
+        return (self.max_depth, self.max_nodes, self.max_text, self.timeout)
+
+    def __setstate__(self, state):
+        self.max_depth, self.max_nodes, self.max_text, self.timeout = state
+
+    def __repr__(self):
+        return 'Budget(max_depth=%r, max_nodes=%r, max_text=%r, timeout=%r)' % self.__getstate__()
+
+
+class BudgetExceeded(ValueError):
+    """
+    Raised when a parse exceeds its Budget. limit names the exceeded limit
+    ('max_depth', 'max_nodes', 'max_text' or 'timeout') and stats holds
+    what the parse had used when it was stopped: 'depth', 'nodes', 'text'
+    and 'seconds'.
+    """
+
+    def __init__(self, limit, stats):
+        ValueError.__init__(self, "%s exceeded after %d elements (%d deep), %d characters of text and %.3fs" % (
+            limit, stats['nodes'], stats['depth'], stats['text'], stats['seconds']))
+        self.limit = limit
+        self.stats = stats
+
+    def __reduce__(self):
+        # So that it survives being passed back from parse_many() workers
+        return (BudgetExceeded, (self.limit, self.stats))
+
+
+class _BudgetMeter(object):
+    """
+    Tracks what one parse has used of its Budget.
+    """
+
+    __slots__ = ('budget', 'start', 'deadline', 'depth', 'nodes', 'text')
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.start = _timer()
+        self.deadline = None if budget.timeout is None else self.start + budget.timeout
+        self.depth = 0
+        self.nodes = 0
+        self.text = 0
+
+    def node(self, depth):
+        """
+        Counts an element depth levels deep (1 for the root).
+        """
+        budget = self.budget
+        self.depth = depth
+        self.nodes += 1
+        if budget.max_depth is not None and depth > budget.max_depth:
+            self.exceeded('max_depth')
+        if budget.max_nodes is not None and self.nodes > budget.max_nodes:
+            self.exceeded('max_nodes')
+        if self.deadline is not None and not self.nodes & 63 and _timer() > self.deadline:
+            self.exceeded('timeout')
+
+    def add_text(self, length):
+        self.text += length
+        if self.budget.max_text is not None and self.text > self.budget.max_text:
+            self.exceeded('max_text')
+        # So that a single huge text node can't outlast the timeout
+        if self.deadline is not None and _timer() > self.deadline:
+            self.exceeded('timeout')
+
+    def add(self, nodes, text):
+        """
+        Counts the elements and text of a part of the document that was
+        parsed apart from this meter, checking the totals and the time.
+        """
+        budget = self.budget
+        self.nodes += nodes
+        if budget.max_nodes is not None and self.nodes > budget.max_nodes:
+            self.exceeded('max_nodes')
+        if self.deadline is not None and _timer() > self.deadline:
+            self.exceeded('timeout')
+        self.add_text(text)
+
+    def exceeded(self, limit):
+        raise BudgetExceeded(limit, {
+            'depth': self.depth,
+            'nodes': self.nodes,
+            'text': self.text,
+            'seconds': _timer() - self.start,
+        })
+
 
 class ObjectifiedElement(object):
 
+    # Elements have no per-instance __dict__; children are only allocated
+    # once the first one is appended
+    __slots__ = ('tag', '_children', '_parent', '_text')
+
     def __init__(self, *args):
         if len(args) > 0:
             if isinstance(args[0], basestring):
@@ -21,7 +282,7 @@ class ObjectifiedElement(object):
             text = None
 
         self.tag = self.__class__.__name__
-        self._children = []
+        self._children = None
         self._parent = None
         self._text = text
 
@@ -40,29 +301,36 @@ class ObjectifiedElement(object):
         return self._parent
 
     def getchildren(self):
+        if self._children is None:
+            return []
         return self._children
 
     def countchildren(self):
-        return len(self.getchildren())
+        if self._children is None:
+            return 0
+        return len(self._children)
 
     def append(self, child):
         child._parent = self
-        self._children.append(child)
-
-    def __setattr__(self, attr_name, value):
-        if attr_name == 'text':
-            raise TypeError("attribute %r of %r objects is not writable"
-                % (attr_name, self.__class__.__name__))
-
-        super(ObjectifiedElement, self).__setattr__(attr_name, value)
+        if self._children is None:
+            self._children = [child]
+        else:
+            self._children.append(child)
 
     @property
     def text(self):
         return self._text
 
+    @text.setter
+    def text(self, value):
+        raise TypeError("attribute %r of %r objects is not writable"
+            % ('text', self.__class__.__name__))
+
 
 class ObjectifiedDataElement(ObjectifiedElement):
 
+    __slots__ = ()
+
     # def __init__(self, text=None):
     #     super(ObjectifiedDataElement, self).__init__()
     #     self._text = text
@@ -79,6 +347,8 @@ class ObjectifiedDataElement(ObjectifiedElement):
 
 class StringElement(ObjectifiedDataElement):
 
+    __slots__ = ()
+
     def __repr__(self):
         if self.text:
             return repr(str(self))
@@ -86,120 +356,3264 @@ class StringElement(ObjectifiedDataElement):
             return repr(u'')
 
 
-def arrayify_etree(e):
-    children = e.getchildren()
+class IntElement(ObjectifiedDataElement):
 
-    if len(children) == 0:
-        try:
-            return {e.tag: int(e.text)}
-        except (TypeError, ValueError):
-            return {e.tag: e.text}
-    else:
-        d = {}
-
-        # Merge data from child nodes into one dict
-        for x in children:
-            for k, v in arrayify_etree(x).items():
-                if k in d:
-                    if isinstance(d[k], list):
-                        d[k].append(v)
-                    else:
-                        d[k] = [d[k], v]
-                else:
-                    d[k] = v
+    __slots__ = ()
 
-        return {e.tag: d}
+    @property
+    def pyval(self):
+        return int(self.text)
 
+    def __repr__(self):
+        return repr(self.pyval)
 
-class Objectifier(object):
-    def __init__(self, response_data):
-        if type(response_data) == list:
-            if self.is_list_of_2_element_tuples(response_data):
-                self.response_data = dict(response_data)
-            else:
-                self.response_data = response_data
-        else:
-            try:
-                self.response_data = json.loads(response_data)
-            except ValueError:
-                try:
-                    self.response_data = arrayify_xml(response_data)
-                except ElementTree.ParseError:
-                    self.response_data = response_data
-            except TypeError:
-                self.response_data = response_data
 
-    def is_list_of_2_element_tuples(self, input):
-        if not isinstance(input, list):
-            return False
+class FloatElement(ObjectifiedDataElement):
+
+    __slots__ = ()
+
+    @property
+    def pyval(self):
+        return float(self.text)
+
+    def __repr__(self):
+        return repr(self.pyval)
+
+
+class BoolElement(ObjectifiedDataElement):
+
+    __slots__ = ()
+
+    @property
+    def pyval(self):
+        return parse_bool(self.text)
+
+    def __repr__(self):
+        return repr(self.pyval)
+
+
+class NoneElement(ObjectifiedDataElement):
+
+    __slots__ = ()
+
+    @property
+    def pyval(self):
+        return None
+
+    def __str__(self):
+        return ''
+
+    def __repr__(self):
+        return repr(None)
 
-        for item in input:
-            if not isinstance(item, tuple) or len(item) != 2:
-                return False
 
+def parse_bool(text):
+    """
+    Converts 'true' or 'false' to a bool.
+    """
+    if text == 'true':
         return True
+    elif text == 'false':
+        return False
+    raise ValueError("Invalid boolean: %r" % text)
 
-    @staticmethod
-    def objectify_if_needed(response_data):
+
+class LeafType(object):
+    """
+    A type that leaf text can be converted to: convert(text) returns the
+    Python value (raising ValueError if it can't), prefilter(text) is a
+    cheap check that text is a candidate at all (None to always try
+    convert), and element_class is the matching ObjectifiedDataElement.
+    """
+
+    __slots__ = ('name', 'convert', 'prefilter', 'element_class')
+
+    def __init__(self, name, convert, prefilter=None, element_class=StringElement):
+        self.name = name
+        self.convert = convert
+        self.prefilter = prefilter
+        self.element_class = element_class
+
+
+def _keep_text(text):
+    return text
+
+
+_string_type = LeafType('str', _keep_text)
+
+
+class TypeTable(object):
+    """
+    An ordered table of LeafTypes used to infer the Python value of leaf
+    text, plus per-tag hints that skip inference for tags whose type is
+    known. Text that no type accepts stays a string.
+    """
+
+    def __init__(self):
+        self._types = OrderedDict()
+        self._hints = {}
+        self._chain = ()
+
+    def copy(self):
+        table = TypeTable()
+        table._types.update(self._types)
+        table._hints.update(self._hints)
+        table._chain = self._chain
+        return table
+
+    def register(self, name, convert, prefilter=None, element_class=StringElement):
         """
-        Returns an objectifier object to wrap the provided response_data.
+        Adds a type that is tried after the already registered ones, or
+        replaces the type registered as name.
         """
-        if hasattr(response_data, 'pop'):
-            return Objectifier(response_data)
-        return response_data
+        self._types[name] = LeafType(name, convert, prefilter, element_class)
+        self._compile()
 
-    def __dir__(self):
-        try:
-            return self.response_data.keys()
-        except AttributeError:
-            return []
-
-    def __repr__(self):
-        try:
-            return "<Objectifier#dict {}>".format(" ".join(["%s=%s" % (k, type(v).__name__)
-                for k, v in self.response_data.iteritems()]))
-        except AttributeError:
-            try:
-                return "<Objectifier#list elements:{}>".format(len(self.response_data))
-            except TypeError:
-                return self.response_data
+    def unregister(self, name):
+        del self._types[name]
+        self._compile()
 
-    def __contains__(self, k):
-        return k in self.response_data
+    def hint(self, tag, name):
+        """
+        Converts the text of every tag element with the type registered as
+        name ('str' to keep it as is) instead of inferring its type.
+        """
+        if name == 'str':
+            self._hints[tag] = _string_type
+        else:
+            self._hints[tag] = self._types[name]
 
-    def __len__(self):
-        return len(self.response_data)
+    def _compile(self):
+        self._chain = tuple([(t.prefilter, t.convert) for t in self._types.itervalues()])
 
-    def __iter__(self):
+    def leaf_type(self, text, tag=None):
         """
-        Provides iteration functionality for the wrapped object.
+        Returns the LeafType that the text of a tag element converts with.
         """
-        try:
-            for k, v in self.response_data.iteritems():
-                yield (k, Objectifier.objectify_if_needed(v))
-        except AttributeError:
-            try:
-                for i in self.response_data:
-                    yield Objectifier.objectify_if_needed(i)
-            except TypeError:
-                raise StopIteration
+        if tag in self._hints:
+            return self._hints[tag]
+        for leaf_type in self._types.itervalues():
+            if leaf_type.prefilter is None or leaf_type.prefilter(text):
+                try:
+                    leaf_type.convert(text)
+                except ValueError:
+                    continue
+                return leaf_type
+        return _string_type
 
-    def __getitem__(self, k):
-        try:
-            return Objectifier.objectify_if_needed(self.response_data[k])
-        except TypeError:
+    def coerce(self, text, tag=None):
+        """
+        Returns the Python value for the text of a tag element.
+        """
+        if text is None:
             return None
 
-    def __getattr__(self, k):
-        if k in self.response_data:
-            return Objectifier.objectify_if_needed(self.response_data[k])
+        if self._hints:
+            hinted = self._hints.get(tag)
+            if hinted is not None:
+                try:
+                    return hinted.convert(text)
+                except ValueError:
+                    _count_coercion_failure()
+                    return text
+
+        for prefilter, convert in self._chain:
+            if prefilter is None or prefilter(text):
+                try:
+                    return convert(text)
+                except ValueError:
+                    _count_coercion_failure()
+
+        return text
+
+    def element(self, text=None, tag=None):
+        """
+        Returns a typed data element (IntElement, StringElement, ...) for
+        the text of a tag element.
+        """
+        if text is None:
+            element = NoneElement()
+        else:
+            element = self.leaf_type(text, tag).element_class(text)
+        if tag is not None:
+            element.tag = tag
+        return element
+
+
+_int_pattern = re.compile(r'\s*[-+]?\d+\s*$')
+
+
+def _maybe_int(text):
+    # Plain unsigned digits are by far the most common case, and isdigit()
+    # is much cheaper than a regular expression match
+    return text.isdigit() or _int_pattern.match(text) is not None
+
+
+#: The TypeTable used when none is given: ints, floats and booleans
+default_types = TypeTable()
+default_types.register('int', int, _maybe_int, IntElement)
+default_types.register(
+    'float', float, re.compile(r'\s*[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?\s*$').match, FloatElement)
+default_types.register(
+    'bool', parse_bool, re.compile(r'(?:true|false)$').match, BoolElement)
+
+
+def coerce_text(text, tag=None, types=None):
+    """
+    Returns the Python value for the text of a leaf element, as inferred by
+    types (default_types if None).
+    """
+    if types is None:
+        types = default_types
+    return types.coerce(text, tag)
+
+
+#: The key an element's attributes are stored under when attributes are kept
+ATTRIBUTES_KEY = '@'
+
+#: The key a leaf element's value is stored under when it has attributes
+TEXT_KEY = '#text'
+
+
+class AttributeIndex(dict):
+    """
+    Maps the values of the attribute name (e.g. 'id') to the arrayified
+    value of the element carrying it, filled in during conversion. Values
+    are expected to be unique; for duplicates one of the elements wins.
+    """
+
+    def __init__(self, name):
+        super(AttributeIndex, self).__init__()
+        self.name = name
+
+
+class TagNames(dict):
+    """
+    Translates ElementTree's "{uri}local" names using nsmap, a mapping of
+    prefix to namespace URI: names in a mapped namespace become
+    "prefix_local", or just "local" if the prefix is ''. The URI '*' maps
+    every other namespace; without it names in unmapped namespaces are left
+    as they are.
+
+    Each distinct name is translated once and the result is shared by every
+    element with that name, so a TagNames should live as long as the
+    document (or stream of records) it is used for.
+    """
+
+    def __init__(self, nsmap):
+        super(TagNames, self).__init__()
+        self.prefixes = dict([(uri, prefix) for prefix, uri in nsmap.iteritems()])
+        self.default_prefix = self.prefixes.pop('*', None)
+
+    def __missing__(self, name):
+        translated = name
+        if isinstance(name, basestring) and name[:1] == '{':
+            uri, local = name[1:].split('}', 1)
+            prefix = self.prefixes.get(uri, self.default_prefix)
+            if prefix == '':
+                translated = local
+            elif prefix is not None:
+                translated = '%s_%s' % (prefix, local)
+        self[name] = translated
+        return translated
+
+
+def tag_names(nsmap):
+    """
+    Returns nsmap as a TagNames, or None if nsmap is None.
+    """
+    if nsmap is None or isinstance(nsmap, TagNames):
+        return nsmap
+    return TagNames(nsmap)
+
+
+def arrayify_etree(e, types=None, attributes=False, index=None, nsmap=None, budget=None):
+    """
+    Converts the element e into nested dicts, folding repeated child tags into
+    lists and converting leaf text with the TypeTable types (default_types if
+    None). Returns {e.tag: value}.
+
+    Attributes are dropped unless attributes is True, in which case they are
+    stored as a dict under ATTRIBUTES_KEY; a leaf element with attributes
+    becomes a dict holding its value under TEXT_KEY. Elements without
+    attributes are stored exactly as before. If index is an AttributeIndex
+    it is filled with every element carrying its attribute.
+
+    nsmap translates namespaced tag and attribute names, see TagNames.
+
+    The tree is walked with an explicit stack, so arbitrarily deep documents
+    can be converted without hitting the recursion limit. budget, a Budget,
+    limits the conversion (counting the text of leaves only) and raises
+    BudgetExceeded as soon as it is exceeded.
+    """
+    stats = _instrumentation
+    if stats is not None:
+        start = _timer()
+
+    coerce = (default_types if types is None else types).coerce
+    names = tag_names(nsmap)
+    meter = None if budget is None else _BudgetMeter(budget)
+
+    # The root element is merged into result like any other child
+    result = {}
+    iters = [iter([e])]
+    dicts = [result]
+
+    while iters:
+        d = dicts[-1]
+
+        for child in iters[-1]:
+            tag = child.tag if names is None else names[child.tag]
+            descend = len(child) != 0
+            if meter is not None:
+                meter.node(len(iters))
+                if not descend and child.text:
+                    meter.add_text(len(child.text))
+
+            if descend:
+                value = {}
+                if attributes:
+                    attrib = child.items()
+                    if attrib:
+                        value[ATTRIBUTES_KEY] = _attrib_dict(attrib, names)
+            else:
+                value = coerce(child.text, tag)
+                if attributes:
+                    attrib = child.items()
+                    if attrib:
+                        value = {ATTRIBUTES_KEY: _attrib_dict(attrib, names), TEXT_KEY: value}
+
+            if index is not None:
+                key = child.get(index.name)
+                if key is not None:
+                    index[key] = value
+
+            # Merge the child into its parent, folding repeated tags into a list
+            if tag in d:
+                existing = d[tag]
+                if isinstance(existing, list):
+                    existing.append(value)
+                else:
+                    d[tag] = [existing, value]
+            else:
+                d[tag] = value
+
+            if descend:
+                # Descend; the rest of this node's children are picked up
+                # from its iterator once the child is done
+                iters.append(iter(child))
+                dicts.append(value)
+                break
+        else:
+            iters.pop()
+            dicts.pop()
+
+    if stats is not None:
+        stats.add_time('convert', _timer() - start)
+        for node in e.iter():
+            stats.nodes += 1
+            if len(node) == 0:
+                stats.leaves += 1
+
+    return result
+
+
+def _attrib_dict(items, names):
+    if names is None:
+        return dict(items)
+    return dict([(names[k], v) for k, v in items])
+
+
+class DictTreeBuilder(object):
+    """
+    An ElementTree-style parser target (start/data/end/close) that builds
+    the same structure as arrayify_etree() directly from parser events,
+    without building an element tree first. close() returns
+    {root_tag: value}. The options are those of arrayify_etree().
+    """
+
+    def __init__(self, types=None, attributes=False, index=None, nsmap=None):
+        self._coerce = (default_types if types is None else types).coerce
+        self._names = tag_names(nsmap)
+        self._attributes = attributes
+        self._index = index
+        self._tags = []
+        # For each open element, the dict its children are merged into, or
+        # None while it has no children yet
+        self._dicts = []
+        # The attributes of each open element, if they are needed at all
+        self._attribs = [] if attributes or index is not None else None
+        # Text of the innermost open element, collected while it is a leaf
+        self._text = []
+        self._root = None
+
+    def _stored_attrib(self, attrib):
+        if self._names is None:
+            return attrib
+        return _attrib_dict(attrib.iteritems(), self._names)
+
+    def start(self, tag, attrib=None):
+        if self._names is not None:
+            tag = self._names[tag]
+        dicts = self._dicts
+        if dicts and dicts[-1] is None:
+            if self._attributes and self._attribs[-1]:
+                dicts[-1] = {ATTRIBUTES_KEY: self._stored_attrib(self._attribs[-1])}
+            else:
+                dicts[-1] = {}
+        self._tags.append(tag)
+        dicts.append(None)
+        if self._attribs is not None:
+            self._attribs.append(attrib)
+        self._text = []
+
+    def data(self, text):
+        # Text after an element's first child (tails, whitespace between
+        # records) is never part of the result, so don't hold on to it
+        if self._dicts and self._dicts[-1] is None:
+            self._text.append(text)
+
+    def end(self, tag=None):
+        tag = self._tags.pop()
+        value = self._dicts.pop()
+        attrib = self._attribs.pop() if self._attribs is not None else None
+
+        if value is None:
+            value = self._coerce(''.join(self._text) if self._text else None, tag)
+            self._text = []
+            if self._attributes and attrib:
+                value = {ATTRIBUTES_KEY: self._stored_attrib(attrib), TEXT_KEY: value}
+
+        if self._index is not None and attrib:
+            key = attrib.get(self._index.name)
+            if key is not None:
+                self._index[key] = value
+
+        if not self._dicts:
+            self._root = {tag: value}
+            return
+
+        # Merge the element into its parent, folding repeated tags into a list
+        d = self._dicts[-1]
+        if tag in d:
+            existing = d[tag]
+            if isinstance(existing, list):
+                existing.append(value)
+            else:
+                d[tag] = [existing, value]
+        else:
+            d[tag] = value
+
+    def close(self):
+        return self._root
+
+
+def _include_trie(include):
+    """
+    Compiles include paths (as for select(), without indexes) into a trie of
+    dicts keyed by tag, with None as the key for '*' and as the value for a
+    path's last step, meaning the whole subtree is included.
+    """
+    trie = {}
+    for path in include:
+        steps = compile_path(path)
+        node = trie
+        for i, (name, index) in enumerate(steps):
+            if index is not None:
+                raise ValueError("include paths can't have indexes: %r" % path)
+            if i == len(steps) - 1:
+                node[name] = None
+            elif node.get(name, {}) is None:
+                # A shorter path already includes the whole subtree
+                break
+            else:
+                node = node.setdefault(name, {})
+    return trie
+
+
+def _merge_tries(a, b):
+    if a is None or b is None:
         return None
+    merged = dict(a)
+    for name, node in b.iteritems():
+        merged[name] = _merge_tries(merged[name], node) if name in merged else node
+    return merged
+
+
+_excluded = object()
+
+
+class _ProjectingTarget(object):
+    """
+    A parser target that passes on to target only the root element, the
+    elements on the way to an include path and the whole subtrees at the end
+    of one (see fromstring()). Other elements are skipped as they are
+    parsed, along with the text between the elements that only lead to the
+    included ones. Tags are matched after translating them with names.
+    """
+
+    def __init__(self, target, include, names=None):
+        self.target = target
+        self._names = names
+        self._root_trie = _include_trie(include)
+        # The trie of each open element passed on, None inside an included
+        # subtree
+        self._tries = []
+        # How deep inside a skipped subtree the parser is
+        self._skipped = 0
+
+    def start(self, tag, attrib=None):
+        if self._skipped:
+            self._skipped += 1
+            return
+
+        tries = self._tries
+        if not tries:
+            trie = self._root_trie
+        elif tries[-1] is None:
+            trie = None
+        else:
+            parent = tries[-1]
+            name = tag if self._names is None else self._names[tag]
+            trie = parent.get(name, _excluded)
+            if None in parent:
+                wildcard = parent[None]
+                trie = wildcard if trie is _excluded else _merge_tries(trie, wildcard)
+            if trie is _excluded:
+                self._skipped = 1
+                return
+
+        tries.append(trie)
+        self.target.start(tag, attrib)
+
+    def end(self, tag):
+        if self._skipped:
+            self._skipped -= 1
+            return
+        self._tries.pop()
+        return self.target.end(tag)
+
+    def data(self, text):
+        if not self._skipped and self._tries[-1] is None:
+            self.target.data(text)
+
+    def close(self):
+        return self.target.close()
+
+
+class _BudgetTarget(object):
+    """
+    A parser target that passes every event on to target, failing with
+    BudgetExceeded as soon as the parse exceeds budget.
+    """
+
+    def __init__(self, target, budget):
+        self.target = target
+        self._meter = _BudgetMeter(budget)
+
+    def start(self, tag, attrib=None):
+        meter = self._meter
+        meter.node(meter.depth + 1)
+        self.target.start(tag, attrib)
+
+    def end(self, tag):
+        self._meter.depth -= 1
+        return self.target.end(tag)
+
+    def data(self, text):
+        self._meter.add_text(len(text))
+        self.target.data(text)
+
+    def close(self):
+        return self.target.close()
+
+
+class _LatchingTarget(object):
+    """
+    A parser target that passes every event on to target until one of its
+    callbacks raises, then ignores the rest of the events and raises the
+    error again from close().
 
+    Python 3's parsers stop calling the target once it raises, but Python
+    2's cElementTree goes on calling end() for the elements still open,
+    which would fail in target and replace the original error.
+    """
 
-def fromstring(xml_str):
-    etree = ElementTree.fromstring(xml_str)
+    def __init__(self, target):
+        self.target = target
+        self._error = None
+
+    def start(self, tag, attrib=None):
+        if self._error is None:
+            try:
+                self.target.start(tag, attrib)
+            except Exception as e:
+                self._error = e
+                raise
+
+    def end(self, tag):
+        if self._error is None:
+            try:
+                return self.target.end(tag)
+            except Exception as e:
+                self._error = e
+                raise
+
+    def data(self, text):
+        if self._error is None:
+            try:
+                self.target.data(text)
+            except Exception as e:
+                self._error = e
+                raise
+
+    def close(self):
+        if self._error is not None:
+            raise self._error
+        return self.target.close()
+
+
+def _limit_target(target, include, budget, names=None):
+    """
+    Wraps target to project it on include and to enforce budget, either of
+    which may be None.
+    """
+    if include is not None:
+        target = _ProjectingTarget(target, include, names)
+    if budget is not None:
+        # Outermost, so that skipped elements count as well
+        target = _LatchingTarget(_BudgetTarget(target, budget))
+    return target
+
+
+def _dict_builder(include, options, budget=None):
+    """
+    Returns the target that arrayifies with options, projected on include and
+    limited by budget if they aren't None.
+    """
+    builder = DictTreeBuilder(**options)
+    stats = _instrumentation
+    if stats is not None:
+        _count_nodes(builder, stats)
+    return _limit_target(builder, include, budget, builder._names)
+
+
+def _count_nodes(builder, stats):
+    # Counts the nodes and leaves that builder (a DictTreeBuilder) sees; an
+    # element is a leaf if no child has started by the time it ends
+    start = builder.start
+    end = builder.end
+
+    def counting_start(tag, attrib=None):
+        stats.nodes += 1
+        start(tag, attrib)
+
+    def counting_end(tag):
+        if builder._dicts[-1] is None:
+            stats.leaves += 1
+        return end(tag)
+
+    builder.start = counting_start
+    builder.end = counting_end
+
+
+class Backend(object):
+    """
+    A parser backend. Subclasses implement fromstring() to return the root
+    element of an ElementTree-compatible tree. parse_target() feeds the
+    parse events to an ElementTree-style parser target (used for include,
+    budget and schemas); by default it replays the events of the tree from
+    fromstring(), and backends that can feed a target while parsing should
+    override it. Backends that can build the arrayified structure more
+    directly override arrayify() as well. The parse(),
+    parse_target_file() and arrayify_file() variants read from a file
+    object, and should be overridden by backends that can do so without
+    reading it all at once.
+
+    max_depth is the deepest nesting of elements the backend can parse, or
+    None if it has no limit of its own.
+    """
+
+    max_depth = None
+
+    def fromstring(self, xml_str):
+        raise NotImplementedError
+
+    def parse(self, source):
+        return self.fromstring(source.read())
+
+    def parse_target(self, xml_str, target):
+        """
+        Feeds the parse events of xml_str to target and returns the result
+        of target.close().
+        """
+        _replay(self.fromstring(xml_str), target)
+        return target.close()
+
+    def parse_target_file(self, source, target):
+        return self.parse_target(source.read(), target)
+
+    def arrayify(self, xml_str, include=None, budget=None, **options):
+        """
+        Parses xml_str and returns {root_tag: value}, exactly as
+        arrayify_etree() would for the parsed tree with the same options.
+        With include, the document is projected while it is parsed, and
+        with budget the parse is limited by a Budget (see fromstring()).
+        """
+        if include is not None or budget is not None:
+            return _timed('parse_convert', self.parse_target, xml_str, _dict_builder(include, options, budget))
+        return arrayify_etree(_timed('parse', self.fromstring, xml_str), **options)
+
+    def arrayify_file(self, source, include=None, budget=None, **options):
+        if include is not None or budget is not None:
+            return _timed('parse_convert', self.parse_target_file, source, _dict_builder(include, options, budget))
+        return arrayify_etree(_timed('parse', self.parse, source), **options)
+
+
+def _replay(root, target):
+    # Feeds target the start, data and end events of the tree under root,
+    # walked with an explicit stack so that deep trees don't hit the
+    # recursion limit; comments and processing instructions are skipped
+    target.start(root.tag, dict(root.attrib))
+    if root.text:
+        target.data(root.text)
+    stack = [(root, iter(root))]
+
+    while stack:
+        for e in stack[-1][1]:
+            if isinstance(e.tag, basestring):
+                target.start(e.tag, dict(e.attrib))
+                if e.text:
+                    target.data(e.text)
+                stack.append((e, iter(e)))
+                break
+            if e.tail:
+                target.data(e.tail)
+        else:
+            e = stack.pop()[0]
+            target.end(e.tag)
+            if stack and e.tail:
+                target.data(e.tail)
+
+
+#: The size of the chunks that parse_target() feeds documents in
+FEED_CHUNK_SIZE = 65536
+
+
+def _feed_chunks(parser, data):
+    # Once a target raises, ElementTree and lxml raise the error only at the
+    # end of the data fed in the same call, after parsing all of it (and
+    # Python 2's cElementTree goes on calling the target, see
+    # _LatchingTarget); feeding in chunks lets the error (e.g.
+    # BudgetExceeded) stop the parse early
+    for i in range(0, len(data), FEED_CHUNK_SIZE):
+        parser.feed(data[i:i + FEED_CHUNK_SIZE])
+
+
+class ElementTreeBackend(Backend):
+    """
+    Parses with the standard library ElementTree (the C accelerated version
+    where available).
+    """
+
+    def __init__(self, module=ElementTree):
+        self.module = module
+
+    def fromstring(self, xml_str):
+        return self.module.fromstring(xml_str)
+
+    def parse(self, source):
+        return self.module.parse(source).getroot()
+
+    def parse_target(self, xml_str, target):
+        parser = self.module.XMLParser(target=target)
+        _feed_chunks(parser, xml_str)
+        return parser.close()
+
+    def parse_target_file(self, source, target):
+        parser = self.module.XMLParser(target=target)
+        while True:
+            data = source.read(65536)
+            if not data:
+                break
+            parser.feed(data)
+        return parser.close()
+
+
+class LxmlBackend(Backend):
+    """
+    Parses with lxml's C parser. Comments and processing instructions are
+    dropped and entities are not resolved, to match ElementTree.
+
+    libxml2 refuses documents nested more than 256 levels deep (max_depth)
+    and very large text nodes, which guards against resource exhaustion by
+    hostile documents. huge_tree=True lifts those limits, to 2048 levels
+    (the most libxml2 allows) and no limit on text, for trusted documents
+    that need it; untrusted ones are then best limited with a Budget (see
+    fromstring()). The 'lxml' backend is registered with the limits on; to
+    opt out, register another:
+
+        ezxml.register_backend('lxml-huge', ezxml.LxmlBackend(huge_tree=True))
+    """
+
+    def __init__(self, huge_tree=False):
+        from lxml import etree
+        self.etree = etree
+        self.huge_tree = huge_tree
+        self.max_depth = 2048 if huge_tree else 256
+
+    def _parser(self, target=None):
+        return self.etree.XMLParser(
+            remove_comments=True, remove_pis=True, resolve_entities=False, huge_tree=self.huge_tree, target=target)
+
+    def fromstring(self, xml_str):
+        return self.etree.fromstring(xml_str, self._parser())
+
+    def parse(self, source):
+        return self.etree.parse(source, self._parser()).getroot()
+
+    def parse_target(self, xml_str, target):
+        parser = self._parser(target)
+        _feed_chunks(parser, xml_str)
+        # With a target, lxml returns the result of target.close()
+        return parser.close()
+
+    def parse_target_file(self, source, target):
+        return self.etree.parse(source, self._parser(target))
+
+
+class ExpatBackend(Backend):
+    """
+    Feeds pyexpat events straight into a DictTreeBuilder, so arrayify()
+    never builds an intermediate element tree. fromstring() (used for lazy
+    parsing) falls back to ElementTree, which is built on expat as well.
+    """
+
+    def fromstring(self, xml_str):
+        return ElementTree.fromstring(xml_str)
+
+    def parse(self, source):
+        return ElementTree.parse(source).getroot()
+
+    def parse_target(self, xml_str, target):
+        return self._feed(lambda parser: parser.Parse(xml_str, True), target)
+
+    def parse_target_file(self, source, target):
+        return self._feed(lambda parser: parser.ParseFile(source), target)
+
+    def arrayify(self, xml_str, include=None, budget=None, **options):
+        return self.parse_target(xml_str, _dict_builder(include, options, budget))
+
+    def arrayify_file(self, source, include=None, budget=None, **options):
+        return self.parse_target_file(source, _dict_builder(include, options, budget))
+
+    def _feed(self, parse, target):
+        parser = expat.ParserCreate(None, '}')
+        parser.buffer_text = True
+
+        # Translate expat's "uri}local" names to ElementTree's "{uri}local",
+        # sharing one string per distinct name
+        names = {}
+
+        def fixname(key):
+            try:
+                return names[key]
+            except KeyError:
+                name = names[key] = '{' + key if '}' in key else key
+                return name
+
+        target_start = target.start
+
+        def start(tag, attrib):
+            if attrib:
+                attrib = dict([(fixname(k), v) for k, v in attrib.iteritems()])
+            target_start(fixname(tag), attrib)
+
+        parser.StartElementHandler = start
+        parser.EndElementHandler = target.end
+        parser.CharacterDataHandler = target.data
+
+        try:
+            _timed('parse_convert', parse, parser)
+        except expat.ExpatError as err:
+            error = ElementTree.ParseError(str(err))
+            error.code = err.code
+            error.position = (err.lineno, err.offset)
+            raise error
+
+        return target.close()
+
+
+_backends = {}
+_default_backend = 'etree'
+
+
+def register_backend(name, backend):
+    """
+    Registers backend (a Backend instance) under name, replacing any backend
+    already registered with that name.
+    """
+    _backends[name] = backend
+
+
+def available_backends():
+    """
+    Returns the names of the registered backends.
+    """
+    return sorted(_backends)
+
+
+def get_backend(name=None):
+    """
+    Returns the backend registered as name, or the default backend.
+    """
+    if name is None:
+        name = _default_backend
+    try:
+        return _backends[name]
+    except KeyError:
+        raise ValueError("Unknown backend: %r" % name)
+
+
+def set_default_backend(name):
+    """
+    Sets the backend used when none is passed to fromstring().
+    """
+    global _default_backend
+
+    get_backend(name)
+    _default_backend = name
+
+
+register_backend('etree', ElementTreeBackend())
+register_backend('expat', ExpatBackend())
+
+try:
+    register_backend('lxml', LxmlBackend())
+except ImportError:
+    pass
+
+
+def arrayify_xml(xml_str, backend=None, **options):
+    """
+    Parses xml_str with the given backend and returns {root_tag: value}.
+    The options are those of arrayify_etree().
+    """
+    return get_backend(backend).arrayify(xml_str, **options)
+
+
+_path_step = re.compile(r'^([^\[\]]+)(?:\[(-?\d+)\])?$')
+
+#: The number of compiled paths kept by compile_path()
+PATH_CACHE_SIZE = 256
+
+_compiled_paths = OrderedDict()
+
+
+def compile_path(path):
+    """
+    Compiles a slash separated path such as 'Items/Item[0]/ISBN' into a tuple
+    of (name, index) steps. name is None for the '*' wildcard and index is
+    None unless the step has an [n] suffix (0-based, negative counts from
+    the end). The most recently used paths are cached.
+    """
+    try:
+        steps = _compiled_paths.pop(path)
+    except KeyError:
+        steps = []
+        for step in path.strip('/').split('/'):
+            match = _path_step.match(step)
+            if match is None:
+                raise ValueError("Invalid path: %r" % path)
+            name, index = match.groups()
+            steps.append((None if name == '*' else name,
+                          None if index is None else int(index)))
+        steps = tuple(steps)
+
+        while len(_compiled_paths) >= PATH_CACHE_SIZE:
+            _compiled_paths.popitem(last=False)
+
+    _compiled_paths[path] = steps
+    return steps
+
+
+def select_data(data, path):
+    """
+    Returns a list of the values in the arrayified data matching path (see
+    compile_path()). A list of repeated elements matches every element, and
+    data that is itself such a list is searched element by element.
+
+    With attributes kept, '*' matches child elements only, never the
+    ATTRIBUTES_KEY and TEXT_KEY entries. A leaf element with attributes is
+    matched as the {ATTRIBUTES_KEY: ..., TEXT_KEY: ...} dict it is stored
+    as; a further TEXT_KEY step ('Item/Name/#text') selects its value, and
+    an ATTRIBUTES_KEY step its attributes.
+    """
+    nodes = data if isinstance(data, list) else [data]
+
+    for name, index in compile_path(path):
+        matches = []
+
+        for node in nodes:
+            if not isinstance(node, dict):
+                continue
+
+            if name is None:
+                found = []
+                for key, value in node.iteritems():
+                    if key == ATTRIBUTES_KEY or key == TEXT_KEY:
+                        continue
+                    if isinstance(value, list):
+                        found.extend(value)
+                    else:
+                        found.append(value)
+            elif name in node:
+                found = node[name]
+                if not isinstance(found, list):
+                    found = [found]
+            else:
+                continue
+
+            if index is None:
+                matches.extend(found)
+            elif -len(found) <= index < len(found):
+                matches.append(found[index])
+
+        nodes = matches
+
+    return nodes
+
+
+def sniff_format(data):
+    """
+    Returns 'xml' or 'json' depending on the first non-whitespace character
+    of the document data (after any byte order mark), or None if it looks
+    like neither.
+    """
+    if isinstance(data, bytes):
+        bom = codecs.BOM_UTF8
+    else:
+        bom = u'\ufeff'
+
+    i = len(bom) if data.startswith(bom) else 0
+    n = len(data)
+
+    while i < n:
+        c = data[i:i + 1]
+        if not c.isspace():
+            break
+        i += 1
+    else:
+        return None
+
+    if c in ('<', b'<'):
+        return 'xml'
+    elif c in ('{', '[', b'{', b'['):
+        return 'json'
+    return None
+
+
+#: The first bytes of every document written by dumps_binary()
+BINARY_MAGIC = b'EZXB'
+BINARY_VERSION = 1
+
+# Value opcodes of the binary format
+_NONE, _TRUE, _FALSE, _INT, _BIG_INT, _FLOAT, _STR, _DICT, _LIST = range(9)
+
+
+def _pack_integers(values, formats):
+    """
+    Packs values with the narrowest of the struct formats (format characters,
+    narrowest first) that holds them all, prefixed by count and format.
+    """
+    low = min(values) if values else 0
+    high = max(values) if values else 0
+    for format in formats:
+        bits = struct.calcsize(format) * 8
+        if format.islower():
+            fits = -(1 << (bits - 1)) <= low and high < 1 << (bits - 1)
+        else:
+            fits = 0 <= low and high < 1 << bits
+        if fits:
+            break
+    return struct.pack('<Ic', len(values), format.encode('ascii')) + \
+        struct.pack('<%d%s' % (len(values), format), *values)
+
+
+def _unpack_array(data, offset):
+    """
+    Reads an array written by _pack_integers() (or a '<Ic' header followed
+    by packed values) at offset and returns (values, new offset).
+    """
+    count, format = struct.unpack_from('<Ic', data, offset)
+    if format not in b'BHIbhiqd':
+        raise struct.error("invalid array format %r" % (format,))
+    offset += 5
+    format = '<%d%s' % (count, format.decode('ascii'))
+    return struct.unpack_from(format, data, offset), offset + struct.calcsize(format)
+
+
+def dumps_binary(data):
+    """
+    Serializes data (nested dicts and lists of strings, numbers, booleans
+    and None, as built by arrayify_etree()) to a compact binary document
+    that loads_binary() reads back much faster than the XML can be parsed.
+
+    Dict keys and strings are stored once each in a string table, numbers
+    are stored natively, and containers are stored as their lengths followed
+    by their contents. Values of any other type raise TypeError.
+    """
+    strings = {}
+    ops = bytearray()
+    refs = []
+    ints = []
+    floats = []
+
+    def ref(string):
+        try:
+            return strings[string]
+        except KeyError:
+            index = strings[string] = len(strings)
+            return index
+
+    # Walked with an explicit stack like arrayify_etree(), so that deep
+    # documents don't hit the recursion limit
+    stack = [iter([(None, data)])]
+
+    while stack:
+        for key, value in stack[-1]:
+            if key is not None:
+                refs.append(ref(key))
+
+            if value is None:
+                ops.append(_NONE)
+            elif value is True:
+                ops.append(_TRUE)
+            elif value is False:
+                ops.append(_FALSE)
+            elif isinstance(value, (int, long)):
+                if -(1 << 63) <= value < 1 << 63:
+                    ops.append(_INT)
+                    ints.append(value)
+                else:
+                    ops.append(_BIG_INT)
+                    refs.append(ref(str(value)))
+            elif isinstance(value, float):
+                ops.append(_FLOAT)
+                floats.append(value)
+            elif isinstance(value, basestring):
+                ops.append(_STR)
+                refs.append(ref(value))
+            elif isinstance(value, dict):
+                ops.append(_DICT)
+                refs.append(len(value))
+                for k in value:
+                    if not isinstance(k, basestring):
+                        raise TypeError("Can't serialize dict key %r" % (k,))
+                stack.append(value.iteritems())
+                break
+            elif isinstance(value, list):
+                ops.append(_LIST)
+                refs.append(len(value))
+                stack.append((None, v) for v in value)
+                break
+            else:
+                raise TypeError("Can't serialize %r" % (value,))
+        else:
+            stack.pop()
+
+    encoded = [s.encode('utf-8') for s in sorted(strings, key=strings.get)]
+
+    return b''.join([
+        BINARY_MAGIC,
+        struct.pack('<B', BINARY_VERSION),
+        _pack_integers([len(s) for s in encoded], 'BHI'),
+        b''.join(encoded),
+        struct.pack('<I', len(ops)),
+        bytes(ops),
+        _pack_integers(refs, 'BHI'),
+        _pack_integers(ints, 'bhiq'),
+        struct.pack('<Ic', len(floats), b'd'),
+        struct.pack('<%dd' % len(floats), *floats),
+    ])
+
+
+def loads_binary(data):
+    """
+    Reads a document written by dumps_binary() (or Objectifier.dumps())
+    and returns the data, wrapped in an Objectifier if it is a dict or a
+    list. Data that isn't such a document, including a truncated or
+    corrupted one, raises ValueError.
+    """
+    return Objectifier.objectify_if_needed(_decode_binary(data))
+
+
+def _decode_binary(data):
+    # The data of a binary document, as loads_binary() but unwrapped
+    if data[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+        raise ValueError("Not an ezxml binary document")
+    try:
+        return _read_binary(data, len(BINARY_MAGIC))
+    except (struct.error, IndexError, StopIteration) as e:
+        raise ValueError("Truncated or corrupt ezxml binary document: %s" % (e,))
+
+
+def _read_binary(data, offset):
+    # The data of a binary document, read from after its magic; corrupt
+    # offsets and counts fail with the errors loads_binary() converts
+    version = struct.unpack_from('<B', data, offset)[0]
+    if version != BINARY_VERSION:
+        raise ValueError("Unsupported ezxml binary version: %r" % version)
+    offset += 1
+
+    lengths, offset = _unpack_array(data, offset)
+    strings = []
+    for length in lengths:
+        if offset + length > len(data):
+            raise ValueError("Truncated ezxml binary document")
+        strings.append(data[offset:offset + length].decode('utf-8'))
+        offset += length
+
+    count = struct.unpack_from('<I', data, offset)[0]
+    offset += 4
+    ops = bytearray(data[offset:offset + count])
+    if len(ops) != count:
+        raise ValueError("Truncated ezxml binary document")
+    offset += count
+
+    refs, offset = _unpack_array(data, offset)
+    ints, offset = _unpack_array(data, offset)
+    floats, offset = _unpack_array(data, offset)
+
+    refs = iter(refs).next
+    ints = iter(ints).next
+    floats = iter(floats).next
+
+    # Each entry is [container, items left, is a dict]
+    result = []
+    stack = [[result, 1, False]]
+
+    for op in ops:
+        while stack[-1][1] == 0:
+            stack.pop()
+        top = stack[-1]
+        top[1] -= 1
+        if top[2]:
+            key = strings[refs()]
+
+        if op == _STR:
+            value = strings[refs()]
+        elif op == _INT:
+            value = ints()
+        elif op == _DICT:
+            value = {}
+        elif op == _LIST:
+            value = []
+        elif op == _FLOAT:
+            value = floats()
+        elif op == _NONE:
+            value = None
+        elif op == _TRUE:
+            value = True
+        elif op == _FALSE:
+            value = False
+        elif op == _BIG_INT:
+            value = int(strings[refs()])
+        else:
+            raise ValueError("Invalid opcode in ezxml binary document: %r" % op)
+
+        if top[2]:
+            top[0][key] = value
+        else:
+            top[0].append(value)
+
+        if op == _DICT or op == _LIST:
+            stack.append([value, refs(), op == _DICT])
+
+    if any([entry[1] for entry in stack]):
+        raise ValueError("Truncated ezxml binary document")
+    return result[0]
+
+
+class Objectifier(object):
+    __slots__ = ('response_data', '_wrappers', '_attribute_index', '_root_tag')
+
+    def __init__(self, response_data, format=None):
+        """
+        Wraps response_data, which is either already decoded data (a dict or
+        list) or a JSON or XML document.
+
+        format ('json' or 'xml') says how to parse a document. By default the
+        format is detected with sniff_format(), and a document that fails to
+        parse is wrapped as is.
+        """
+        self._wrappers = None
+        self._attribute_index = None
+        self._root_tag = None
+
+        if type(response_data) == list:
+            if self.is_list_of_2_element_tuples(response_data):
+                self.response_data = dict(response_data)
+            else:
+                self.response_data = response_data
+        elif format == 'json':
+            self.response_data = json.loads(response_data)
+        elif format == 'xml':
+            self.response_data = arrayify_xml(response_data).items()[0][1]
+        elif format is not None:
+            raise ValueError("Unknown format: %r" % format)
+        elif not isinstance(response_data, (basestring, bytes)):
+            self.response_data = response_data
+        elif sniff_format(response_data) == 'xml':
+            try:
+                self.response_data = arrayify_xml(response_data).items()[0][1]
+            except SyntaxError:
+                # The base of ElementTree's and lxml's parse errors
+                self.response_data = response_data
+        else:
+            # JSON documents, and also bare JSON scalars such as "42"
+            try:
+                self.response_data = json.loads(response_data)
+            except ValueError:
+                self.response_data = response_data
+
+    def is_list_of_2_element_tuples(self, input):
+        if not isinstance(input, list):
+            return False
+
+        for item in input:
+            if not isinstance(item, tuple) or len(item) != 2:
+                return False
+
+        return True
+
+    def select(self, path):
+        """
+        Returns a list of the plain values matching path, e.g.
+        'Items/Item/ISBN' or 'Items/Item[0]/*'. See compile_path().
+        """
+        return select_data(self.response_data, path)
+
+    def select_one(self, path, default=None):
+        """
+        Returns the first plain value matching path, or default.
+        """
+        matches = select_data(self.response_data, path)
+        if matches:
+            return matches[0]
+        return default
+
+    def get(self, name, default=None):
+        """
+        Returns the value of the attribute name of the wrapped element
+        (parsed with attributes=True), or default.
+        """
+        try:
+            return self.response_data[ATTRIBUTES_KEY].get(name, default)
+        except (KeyError, TypeError, AttributeError):
+            return default
+
+    @property
+    def attrib(self):
+        """
+        The attributes of the wrapped element (parsed with attributes=True).
+        """
+        try:
+            return self.response_data[ATTRIBUTES_KEY]
+        except (KeyError, TypeError):
+            return {}
+
+    def lookup(self, key, default=None):
+        """
+        Returns the element whose index_by attribute (see fromstring()) is
+        key, or default.
+        """
+        if self._attribute_index is None or key not in self._attribute_index:
+            return default
+        return self._wrap((ATTRIBUTES_KEY, key), self._attribute_index[key])
+
+    def to_json(self, **kwargs):
+        """
+        Returns the wrapped data as a JSON document; kwargs are passed on to
+        json.dumps(). See write_json() to write it to a file.
+        """
+        return json.dumps(self.response_data, **kwargs)
+
+    def dumps(self):
+        """
+        Serializes the wrapped data with dumps_binary(), to be read back
+        with loads_binary().
+        """
+        return dumps_binary(self.response_data)
+
+    @staticmethod
+    def objectify_if_needed(response_data):
+        """
+        Returns an objectifier object to wrap the provided response_data.
+        """
+        if hasattr(response_data, 'pop'):
+            return Objectifier(response_data)
+        return response_data
+
+    def _wrap(self, key, value):
+        """
+        Like objectify_if_needed(), but memoizes the wrapper for the child
+        at key (a dict key or list index), so navigating to the same child
+        again returns the same Objectifier.
+        """
+        if not hasattr(value, 'pop'):
+            return value
+
+        wrappers = self._wrappers
+        if wrappers is None:
+            wrappers = self._wrappers = {}
+        else:
+            cached = wrappers.get(key)
+            # The child may have been replaced in response_data since
+            if cached is not None and cached[0] is value:
+                return cached[1]
+
+        stats = _instrumentation
+        if stats is None:
+            wrapper = Objectifier(value)
+        else:
+            stats.wrappers += 1
+            wrapper = _timed('wrap', Objectifier, value)
+        # The tag the child is written out with; list items share the tag
+        # of their list
+        if isinstance(key, basestring):
+            wrapper._root_tag = key
+        elif isinstance(key, int):
+            wrapper._root_tag = self._root_tag
+        wrappers[key] = (value, wrapper)
+        return wrapper
+
+    def __dir__(self):
+        try:
+            return self.response_data.keys()
+        except AttributeError:
+            return []
+
+    def __repr__(self):
+        try:
+            return "<Objectifier#dict {}>".format(" ".join(["%s=%s" % (k, type(v).__name__)
+                for k, v in self.response_data.iteritems()]))
+        except AttributeError:
+            try:
+                return "<Objectifier#list elements:{}>".format(len(self.response_data))
+            except TypeError:
+                return self.response_data
+
+    def __contains__(self, k):
+        return k in self.response_data
+
+    def __len__(self):
+        return len(self.response_data)
+
+    def __iter__(self):
+        """
+        Provides iteration functionality for the wrapped object.
+        """
+        try:
+            for k, v in self.response_data.iteritems():
+                yield (k, self._wrap(k, v))
+        except AttributeError:
+            try:
+                for i, v in enumerate(self.response_data):
+                    yield self._wrap(i, v)
+            except TypeError:
+                return
+
+    def __getitem__(self, k):
+        try:
+            if isinstance(k, slice):
+                return Objectifier.objectify_if_needed(self.response_data[k])
+            return self._wrap(k, self.response_data[k])
+        except TypeError:
+            return None
+
+    def __getattr__(self, k):
+        if k in self.response_data:
+            return self._wrap(k, self.response_data[k])
+        return None
+
+
+class LazyObjectifier(Objectifier):
+    """
+    An Objectifier that wraps an ElementTree element (or a list of sibling
+    elements sharing a tag) directly and only converts the children that are
+    actually accessed. Converted children are memoized per node.
+
+    The options are those of arrayify_etree() and apply to response_data.
+    Leaf elements are always converted to plain values, but get() and
+    attrib read the attributes of a wrapped element directly.
+    """
+
+    __slots__ = ('_node', '_options', '_coerce', '_names', '_index', '_values', '_data')
+
+    def __init__(self, node, **options):
+        types = options.get('types')
+        names = tag_names(options.get('nsmap'))
+        if names is not None:
+            # Share translated names with every node of the document
+            options['nsmap'] = names
+        self._node = node
+        self._options = options
+        self._coerce = (default_types if types is None else types).coerce
+        self._names = names
+        self._wrappers = None
+        self._attribute_index = None
+        if not isinstance(node, list):
+            self._root_tag = self._tag(node)
+        else:
+            # An empty slice of repeated elements has no element to name it
+            self._root_tag = self._tag(node[0]) if node else None
+        self._index = None
+        self._values = {}
+        self._data = None
+
+    @property
+    def response_data(self):
+        """
+        The fully arrayified data for this node, converted on first use.
+        """
+        if self._data is None:
+            if isinstance(self._node, list):
+                self._data = [arrayify_etree(e, **self._options)[self._tag(e)] for e in self._node]
+            else:
+                self._data = arrayify_etree(self._node, **self._options)[self._tag(self._node)]
+        return self._data
+
+    def _children(self):
+        """
+        Returns a mapping of tag to the child elements with that tag.
+        """
+        if self._index is None:
+            index = {}
+            for child in self._node:
+                tag = self._tag(child)
+                if tag in index:
+                    index[tag].append(child)
+                else:
+                    index[tag] = [child]
+            self._index = index
+        return self._index
+
+    def _tag(self, e):
+        if self._names is None:
+            return e.tag
+        return self._names[e.tag]
+
+    def _convert(self, e):
+        if len(e):
+            stats = _instrumentation
+            if stats is not None:
+                stats.wrappers += 1
+                return _timed('wrap', LazyObjectifier, e, **self._options)
+            return LazyObjectifier(e, **self._options)
+        return self._coerce(e.text, self._tag(e))
+
+    def _child(self, k):
+        try:
+            return self._values[k]
+        except KeyError:
+            pass
+
+        elems = self._children()[k]
+        if len(elems) == 1:
+            value = self._convert(elems[0])
+        else:
+            value = LazyObjectifier(elems, **self._options)
+        self._values[k] = value
+        return value
+
+    def _item(self, i):
+        try:
+            return self._values[i]
+        except KeyError:
+            pass
+
+        value = self._values[i] = self._convert(self._node[i])
+        return value
+
+    def __dir__(self):
+        if isinstance(self._node, list):
+            return []
+        return list(self._children().keys())
+
+    def __repr__(self):
+        if isinstance(self._node, list):
+            return "<Objectifier#list elements:{}>".format(len(self._node))
+
+        def type_name(k, elems):
+            if len(elems) > 1:
+                return 'list'
+            elif len(elems[0]):
+                return 'dict'
+            return type(self._coerce(elems[0].text, k)).__name__
+
+        return "<Objectifier#dict {}>".format(" ".join(["%s=%s" % (k, type_name(k, v))
+            for k, v in self._children().iteritems()]))
+
+    def __contains__(self, k):
+        if isinstance(self._node, list):
+            return any(v == k for v in self)
+        return k in self._children()
+
+    def __len__(self):
+        if isinstance(self._node, list):
+            return len(self._node)
+        return len(self._children())
+
+    def __iter__(self):
+        if isinstance(self._node, list):
+            for i in range(len(self._node)):
+                yield self._item(i)
+        else:
+            for k in self._children():
+                yield (k, self._child(k))
+
+    def __getitem__(self, k):
+        if not isinstance(self._node, list):
+            return self._child(k)
+
+        if isinstance(k, slice):
+            obj = LazyObjectifier(self._node[k], **self._options)
+            obj._root_tag = self._root_tag
+            return obj
+        try:
+            return self._item(k)
+        except TypeError:
+            return None
+
+    def __getattr__(self, k):
+        if isinstance(self._node, list) or k not in self._children():
+            return None
+        return self._child(k)
+
+    def get(self, name, default=None):
+        if isinstance(self._node, list):
+            return default
+        if self._names is not None:
+            return self.attrib.get(name, default)
+        return self._node.get(name, default)
+
+    @property
+    def attrib(self):
+        if isinstance(self._node, list):
+            return {}
+        return _attrib_dict(self._node.items(), self._names)
+
+    def lookup(self, key, default=None):
+        # The index maps to elements here, converted on first lookup
+        if self._attribute_index is None or key not in self._attribute_index:
+            return default
+        try:
+            return self._values[(ATTRIBUTES_KEY, key)]
+        except KeyError:
+            value = self._values[(ATTRIBUTES_KEY, key)] = self._convert(self._attribute_index[key])
+            return value
+
+
+# Python 2's os.rename() already replaces the target on POSIX, and it has
+# no os.replace()
+_replace = getattr(os, 'replace', os.rename)
+
+
+class ParseCache(object):
+    """
+    A cache of arrayified documents for fromstring(), keyed by a hash of the
+    document and the options it was parsed with, so that a document seen
+    before costs a hash and a lookup instead of a parse.
+
+    Entries are kept in memory up to max_bytes, counting an estimate of the
+    memory used by the arrayified data of each document (the sizes of its
+    dicts, lists and values, as reported by sys.getsizeof()), and the least
+    recently used ones are evicted beyond that.
+
+    With directory, every parsed document is also written there in the
+    format of dumps_binary(), and documents evicted from memory (or parsed
+    by another process) are loaded from it instead of being parsed again;
+    files that don't load are parsed again as if they were missing. Data
+    loaded from disk no longer shares objects with its index_by index.
+    Documents parsed with a custom TypeTable are only cached in memory,
+    since their options can't be identified across processes.
+
+    Cached data is shared by every Objectifier returned for the document and
+    must not be modified. A ParseCache can be shared between threads.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def key(self, xml_str, index_by, options):
+        """
+        Returns the key of xml_str parsed with index_by and options.
+        """
+        if isinstance(xml_str, unicode):
+            xml_str = xml_str.encode('utf-8')
+        fingerprint = [('index_by', index_by)]
+        for name, value in sorted(options.items()):
+            if isinstance(value, TagNames):
+                value = (tuple(sorted(value.prefixes.items())), value.default_prefix)
+            elif isinstance(value, dict):
+                value = tuple(sorted(value.items()))
+            elif isinstance(value, (list, tuple, set, frozenset)):
+                value = tuple(sorted(value))
+            fingerprint.append((name, value))
+        return hashlib.sha1(xml_str).hexdigest(), tuple(fingerprint)
+
+    def get(self, key):
+        """
+        Returns the entry stored for key, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                # Most recently used entries are kept at the end
+                del self._entries[key]
+                self._entries[key] = entry
+                self._hits += 1
+                return entry[0]
+
+        path = self._path(key)
+        if path is not None:
+            try:
+                with open(path, 'rb') as f:
+                    value, size = self._decode(f.read())
+            except (IOError, OSError, ValueError):
+                pass
+            else:
+                with self._lock:
+                    self._disk_hits += 1
+                self._store(key, value, size)
+                return value
+
+        with self._lock:
+            self._misses += 1
+        return None
+
+    def put(self, key, value, size):
+        """
+        Stores value, an entry using about size bytes of memory (see
+        entry_size()), under key. value is the (data, index) pair of an
+        arrayified document and its AttributeIndex or None.
+        """
+        self._store(key, value, size)
+
+        path = self._path(key)
+        if path is not None:
+            # Written under a temporary name and renamed, so that other
+            # processes never see a partial file
+            fd, temp_path = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self._encode(value, size))
+            _replace(temp_path, path)
+
+    @staticmethod
+    def _encode(value, size):
+        data, index = value
+        if index is None:
+            return dumps_binary([data, size])
+        return dumps_binary([data, size, index.name, dict(index)])
+
+    @staticmethod
+    def _decode(document):
+        # Raises ValueError for anything that isn't an encoded entry
+        entry = _decode_binary(document)
+        if not isinstance(entry, list) or len(entry) not in (2, 4) or not isinstance(entry[1], (int, long)) or \
+                (len(entry) == 4 and not isinstance(entry[3], dict)):
+            raise ValueError("Not a cache entry")
+        index = None
+        if len(entry) == 4:
+            index = AttributeIndex(entry[2])
+            index.update(entry[3])
+        return (entry[0], index), entry[1]
+
+    def _store(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._bytes -= self._entries.popitem(last=False)[1][1]
+                self._evictions += 1
+
+    @staticmethod
+    def entry_size(value):
+        """
+        Estimates the memory used by value and the dicts, lists and tuples
+        it contains, counting objects shared between them once.
+        """
+        seen = set()
+        size = 0
+        stack = [value]
+        while stack:
+            obj = stack.pop()
+            if id(obj) in seen:
+                continue
+            seen.add(id(obj))
+            size += sys.getsizeof(obj)
+            if isinstance(obj, dict):
+                stack.extend(obj.keys())
+                stack.extend(obj.values())
+            elif isinstance(obj, (list, tuple)):
+                stack.extend(obj)
+        return size
+
+    def _path(self, key):
+        if self.directory is None:
+            return None
+        digest, fingerprint = key
+        for name, value in fingerprint:
+            if name == 'types' and value not in (None, default_types):
+                return None
+        suffix = hashlib.sha1(repr(fingerprint).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, '%s-%s.ezxb' % (digest, suffix))
+
+    def clear(self):
+        """
+        Empties the memory tier; entries written to disk are left there.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        Returns the hit, miss and eviction counts and the current size of
+        the memory tier as a dict.
+        """
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'disk_hits': self._disk_hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def fromstring(xml_str, lazy=False, backend=None, index_by=None, cache=None, **options):
+    """
+    Parses xml_str and returns an Objectifier for its root element.
+
+    backend names the parser backend to use (see available_backends());
+    by default the one chosen with set_default_backend() is used. The
+    options are those of arrayify_etree(), e.g. types to convert leaf text
+    with a different TypeTable, attributes=True to keep attributes or nsmap
+    to translate namespaced names.
+
+    index_by names an attribute (e.g. 'id') to index elements by, so that
+    they can be found with lookup() on the returned Objectifier.
+
+    With lazy=True the parsed element tree is wrapped directly and children
+    are converted only when they are accessed, instead of arrayifying the
+    whole document up front.
+
+    cache is an optional ParseCache: documents found in it are not parsed
+    again, and the Objectifiers returned for them share their data.
+
+    include projects the document on a list of paths relative to the root
+    element, as for select() but without indexes, e.g. ['Items/Item/ISBN',
+    'ResponseHeader']: only the elements on those paths and everything
+    inside the elements they end at are kept, and the rest is skipped while
+    parsing, without being converted or kept in memory.
+
+    budget is an optional Budget limiting the depth, number of elements,
+    amount of text and time of the parse. It is checked as the parser goes,
+    so an oversized document fails with BudgetExceeded as soon as it
+    exceeds a limit rather than once it has been fully parsed.
+    """
+    if cache is not None:
+        if lazy:
+            raise ValueError("A cache can't be used with lazy=True")
+        # Documents found in the cache aren't parsed, so the budget isn't
+        # part of the key
+        budget = options.pop('budget', None)
+        key = cache.key(xml_str, index_by, options)
+        entry = cache.get(key)
+        if entry is None:
+            index = None if index_by is None else AttributeIndex(index_by)
+            entry = (arrayify_xml(xml_str, backend, index=index, budget=budget, **options), index)
+            cache.put(key, entry, cache.entry_size(entry))
+        return _root_objectifier(*entry)
+
+    backend = get_backend(backend)
+    return _objectify(backend, xml_str, False, lazy, index_by, options)
+
+
+def _objectify(backend, source, from_file, lazy, index_by, options):
+    # Shared by fromstring() and parse_file(), which differ only in the
+    # backend methods that read source
+    index = None if index_by is None else AttributeIndex(index_by)
+
+    if lazy:
+        include = options.pop('include', None)
+        budget = options.pop('budget', None)
+        if include is None and budget is None:
+            parse = backend.parse if from_file else backend.fromstring
+            etree = _timed('parse', parse, source)
+        else:
+            names = tag_names(options.get('nsmap'))
+            if names is not None:
+                options['nsmap'] = names
+            parse_target = backend.parse_target_file if from_file else backend.parse_target
+            target = _limit_target(ElementTree.TreeBuilder(), include, budget, names)
+            etree = _timed('parse', parse_target, source, target)
+        obj = LazyObjectifier(etree, **options)
+        if index is not None:
+            for e in etree.iter():
+                key = e.get(index_by)
+                if key is not None:
+                    index[key] = e
+            obj._attribute_index = index
+        return obj
+
+    arrayify = backend.arrayify_file if from_file else backend.arrayify
+    return _root_objectifier(arrayify(source, index=index, **options), index)
+
+
+def _root_objectifier(root, index):
+    tag, children = root.items()[0]
+    obj = Objectifier(children)
+    obj._attribute_index = index
+    obj._root_tag = tag
+    return obj
+
+
+def _record_objectifier(record, tag):
+    obj = Objectifier.objectify_if_needed(record)
+    if isinstance(obj, Objectifier):
+        obj._root_tag = tag
+    return obj
+
+
+class _RecordSplitter(object):
+    """
+    Picks the complete tag records out of a stream of ElementTree start and
+    end events (with tag matched against the names translated by the
+    TagNames names, if given), enforcing budget over the whole stream if it
+    isn't None.
+
+    Each record is detached from its parent once it has been handled, and
+    every element outside of a record is cleared and detached as soon as it
+    ends, so only the records in flight are kept in memory.
+    """
+
+    def __init__(self, tag, names=None, budget=None):
+        self.tag = tag
+        self.names = names
+        self.path = []
+        self.depth = 0
+        self.meter = None if budget is None else _BudgetMeter(budget)
+
+    def records(self, events):
+        path = self.path
+        names = self.names
+        meter = self.meter
+
+        for event, elem in events:
+            name = elem.tag if names is None else names[elem.tag]
+
+            if event == 'start':
+                path.append(elem)
+                if meter is not None:
+                    meter.node(len(path))
+                if name == self.tag:
+                    self.depth += 1
+                continue
+
+            path.pop()
+            if meter is not None and elem.text:
+                meter.add_text(len(elem.text))
+
+            if name == self.tag:
+                self.depth -= 1
+                if self.depth > 0:
+                    # A nested record is converted along with its outer record
+                    continue
+                yield elem
+            elif self.depth > 0:
+                # Still inside a record; it is needed until the record ends
+                continue
+            else:
+                elem.clear()
+
+            if path:
+                path[-1].remove(elem)
+
+
+def iterparse(source, tag, **options):
+    """
+    Incrementally parses source (a filename or file object) and yields an
+    objectified record for every element named tag, without building the
+    whole document tree.
+
+    Each record is detached from its parent as soon as it has been yielded,
+    and every element outside of a record is cleared and detached once it
+    ends, so memory stays flat regardless of the size of the document. The
+    options are those of arrayify_etree(); with nsmap, tag is matched
+    against the translated names, and budget, a Budget, applies to the
+    whole document. The text of an element is counted against max_text
+    (and the timeout checked with it) only once the element ends, so the
+    text of one element is read in full before it can exceed the budget.
+    """
+    for record in _iter_records(source, tag, options):
+        yield _record_objectifier(record, tag)
+
+
+def _iter_records(source, tag, options, splitter=None):
+    # The arrayified records of iterparse(), picked out by splitter if given
+    names = tag_names(options.get('nsmap'))
+    if names is not None:
+        options['nsmap'] = names
+
+    budget = options.pop('budget', None)
+    if splitter is None:
+        splitter = _RecordSplitter(tag, names, budget)
+    events = ElementTree.iterparse(source, events=('start', 'end'))
+
+    for elem in splitter.records(events):
+        record = arrayify_etree(elem, **options)[tag]
+        elem.clear()
+        yield record
+
+
+def parse_file(path, tag=None, mmap=True, lazy=False, backend=None, index_by=None, **options):
+    """
+    Parses the XML file at path without first reading it into one string.
+    With mmap=True the file is memory-mapped, so that its pages are read
+    only as the parser reaches them and can be dropped again by the OS
+    under memory pressure; otherwise it is read in buffered chunks.
+
+    Without tag this returns an Objectifier for the root element, with the
+    options of fromstring(). With tag it returns an iterator over the
+    records named tag, as iterparse() does, which keeps memory bounded for
+    files of any size; the file is closed once the iterator is exhausted.
+    """
+    if tag is not None:
+        return _iterparse_file(path, tag, mmap, options)
+
+    with _open_source(path, mmap) as source:
+        backend = get_backend(backend)
+        return _objectify(backend, source, True, lazy, index_by, options)
+
+
+def _iterparse_file(path, tag, mmap, options):
+    with _open_source(path, mmap) as source:
+        for record in iterparse(source, tag, **options):
+            yield record
+
+
+@contextlib.contextmanager
+def _open_source(path, mmap):
+    with open(path, 'rb') as f:
+        source = f
+        # Empty files can't be mapped; the parser reports them as usual
+        if mmap and os.fstat(f.fileno()).st_size > 0:
+            source = _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ)
+        try:
+            yield source
+        finally:
+            if source is not f:
+                source.close()
+
+
+_missing = object()
+
+# Python 2 has neither array.typecodes nor the 'q' (long long) typecode
+_array_typecodes = getattr(array, 'typecodes', 'bBuhHiIlLfd')
+_int_typecode = 'q' if 'q' in _array_typecodes else 'l'
+
+#: The array typecode, numpy dtype and conversion of each column type
+_column_types = {
+    int: (_int_typecode, _int_typecode, int),
+    long: (_int_typecode, _int_typecode, long),
+    float: ('d', 'd', float),
+    bool: ('B', '?', parse_bool),
+    str: (None, None, _keep_text),
+    unicode: (None, None, _keep_text),
+}
+
+
+class _Column(object):
+    """
+    A field of to_columns(): the steps of its path relative to the record
+    (ending with '@name' for an attribute), and the column its converted
+    values are appended to.
+    """
+
+    __slots__ = ('name', 'steps', 'attribute', 'convert', 'dtype', 'values', 'default')
+
+    def __init__(self, name, kind, defaults):
+        steps = compile_path(name)
+        if any([index is not None for step, index in steps]):
+            raise ValueError("Indexes aren't supported in column paths: %r" % name)
+        self.name = name
+        self.steps = [step for step, index in steps]
+        self.attribute = None
+        if self.steps[-1] is not None and self.steps[-1].startswith(ATTRIBUTES_KEY):
+            self.attribute = self.steps.pop()[len(ATTRIBUTES_KEY):]
+
+        if kind in _column_types:
+            typecode, self.dtype, self.convert = _column_types[kind]
+        elif isinstance(kind, basestring) and len(kind) == 1 and kind in _array_typecodes and kind != 'u':
+            typecode = self.dtype = kind
+            self.convert = float if kind in 'fd' else int
+        elif callable(kind):
+            typecode, self.dtype, self.convert = None, None, kind
+        else:
+            raise TypeError("Unsupported column type for %r: %r" % (name, kind))
+
+        self.values = [] if typecode is None else array.array(typecode)
+        self.default = defaults.get(name, _missing)
+
+    def text(self, record, names):
+        node = record
+        for step in self.steps:
+            for child in node:
+                if step is None or step == (child.tag if names is None else names[child.tag]):
+                    node = child
+                    break
+            else:
+                return None
+
+        if self.attribute is None:
+            return node.text
+        for name, value in node.attrib.iteritems():
+            if self.attribute == (name if names is None else names[name]):
+                return value
+        return None
+
+    def append(self, record, names, number):
+        text = self.text(record, names)
+        if text is None or text == '':
+            if self.default is not _missing:
+                self.values.append(self.default)
+            elif isinstance(self.values, list):
+                self.values.append(None)
+            else:
+                raise ValueError("Record %d has no %s" % (number, self.name))
+            return
+
+        try:
+            self.values.append(self.convert(text))
+        except (ValueError, OverflowError):
+            raise ValueError("Record %d: invalid %s %r" % (number, self.name, text))
+
+    def finish(self, as_numpy):
+        if not as_numpy:
+            return self.values
+        if self.dtype is None:
+            return numpy.array(self.values, dtype=object)
+        # Shares the buffer of the array instead of copying it
+        return numpy.frombuffer(self.values, dtype=self.dtype)
+
+
+def to_columns(source, record, fields, defaults=None, as_numpy=None, nsmap=None, budget=None):
+    """
+    Streams the records named record out of source (an XML document, as
+    bytes or text starting with '<', a filename or a file object) into one
+    column per field and returns an OrderedDict of {field: column}.
+
+    fields maps each field's path relative to the record (such as 'ISBN',
+    'Author/Name', or '@id' for an attribute) to its type: int, float and
+    bool fill a typed array.array, an array typecode such as 'i' or 'f' an
+    array of that type, and str (or any other callable, applied to the
+    text) a list. With as_numpy the columns are returned as numpy arrays
+    instead; by default they are whenever numpy is installed.
+
+    A field missing or empty in a record takes its value in defaults, or
+    is None in list columns; in typed columns it raises a ValueError, as
+    does text that doesn't convert. Records are dropped once their fields
+    are read, so memory grows with the columns only. budget, a Budget,
+    limits the parse as for iterparse(), which counts the text of an
+    element only once it ends.
+    """
+    if as_numpy is None:
+        as_numpy = numpy is not None
+    elif as_numpy and numpy is None:
+        raise ImportError("as_numpy requires numpy")
+
+    if isinstance(fields, dict):
+        fields = fields.items()
+    columns = [_Column(name, kind, defaults or {}) for name, kind in fields]
+    names = tag_names(nsmap)
+
+    if isinstance(source, (basestring, bytes)) and sniff_format(source[:1024]) == 'xml':
+        if not isinstance(source, bytes):
+            source = source.encode('utf-8')
+        source = io.BytesIO(source)
+    if isinstance(source, (basestring, bytes)):
+        with _open_source(source, True) as f:
+            _fill_columns(f, record, names, columns, budget)
+    else:
+        _fill_columns(source, record, names, columns, budget)
+
+    return OrderedDict([(column.name, column.finish(as_numpy)) for column in columns])
+
+
+def _fill_columns(source, record, names, columns, budget):
+    splitter = _RecordSplitter(record, names, budget)
+    events = ElementTree.iterparse(source, events=('start', 'end'))
+
+    for number, elem in enumerate(splitter.records(events)):
+        for column in columns:
+            column.append(elem, names, number)
+        elem.clear()
+
+
+class Record(object):
+    """
+    The base class of the record classes generated by compile_schema().
+    Each child element in the schema has a slot, named after its tag (with
+    characters that can't be in an identifier replaced by '_'), holding its
+    value, a list of values for repeated elements, or None if the element
+    was missing. _tags lists the tags of the slots in _fields.
+    """
+
+    __slots__ = ()
+    _tag = None
+    _fields = ()
+    _tags = ()
+
+    def __getitem__(self, tag):
+        return getattr(self, self._fields[self._tags.index(tag)])
+
+    def get(self, tag, default=None):
+        if tag not in self._tags:
+            return default
+        value = self[tag]
+        return default if value is None else value
+
+    @property
+    def response_data(self):
+        """
+        The record as the nested dicts and lists that fromstring() would
+        have arrayified the element into.
+        """
+        return _record_data(self)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            [getattr(self, name) == getattr(other, name) for name in self._fields])
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+            ['%s=%r' % (name, getattr(self, name)) for name in self._fields]))
+
+
+def _record_data(value):
+    if isinstance(value, list):
+        return [_record_data(v) for v in value]
+    if not isinstance(value, Record):
+        return value
+    data = {}
+    for name, tag in zip(value._fields, value._tags):
+        field = getattr(value, name)
+        if field != []:
+            data[tag] = _record_data(field)
+    return data
+
+
+def _identifier(tag, taken):
+    name = re.sub(r'\W', '_', tag)
+    if not name or name[0].isdigit():
+        name = '_' + name
+    if name.startswith('__'):
+        # Names with two leading underscores would be mangled in __init__
+        name = '_' + name.lstrip('_')
+    if keyword.iskeyword(name) or hasattr(Record, name):
+        name += '_'
+    while name in taken:
+        name += '_'
+    taken.add(name)
+    return name
+
+
+def _record_class(tag, tags):
+    """
+    Generates the Record subclass for the elements named tag, with a slot
+    for each of tags and an __init__ that takes their values in order.
+    """
+    taken = set()
+    fields = tuple([_identifier(t, taken) for t in tags])
+    source = 'def __init__(self%s):\n    %s\n' % (
+        ''.join([', ' + name for name in fields]),
+        '\n    '.join(['self.%s = %s' % (name, name) for name in fields]) or 'pass')
+    namespace = {}
+    exec(source, namespace)
+
+    name = _identifier(tag, set())
+    return type(str(name), (Record,), {
+        '__slots__': fields,
+        '__init__': namespace['__init__'],
+        '_tag': tag,
+        '_fields': fields,
+        '_tags': tuple(tags),
+    })
+
+
+class _RecordType(object):
+    """
+    The compiled schema of an element with children: its record class and,
+    for each child tag, the (slot index, repeated, compiled schema) of the
+    child, where the schema of a leaf is the function converting its text.
+    """
+
+    __slots__ = ('cls', 'children', 'repeated')
+
+    def __init__(self, cls, children):
+        self.cls = cls
+        self.children = children
+        self.repeated = [index for index, repeated, child in children.itervalues() if repeated]
+
+
+#: The function converting leaf text for each leaf type in a schema (None
+#: to keep the text)
+_leaf_converters = {int: int, long: long, float: float, bool: parse_bool,
+                    str: None, unicode: None, type(None): None}
+
+
+def _infer_schema(e, types, names):
+    # Turns the sample element e into the equivalent declared spec: an
+    # OrderedDict of its child tags in order of first appearance if it has
+    # children, and otherwise the function of the TypeTable types that its
+    # text converts with; child tags that occur more than once are repeated
+    children = OrderedDict()
+    for child in e:
+        tag = child.tag if names is None else names[child.tag]
+        spec = _infer_schema(child, types, names)
+        if tag in children:
+            existing = children[tag]
+            spec = _merge_schemas(existing if isinstance(existing, list) else [existing], spec)
+        children[tag] = spec
+    if children:
+        return children
+    if e.text is None:
+        return type(None)
+    tag = e.tag if names is None else names[e.tag]
+    return types.leaf_type(e.text, tag).convert
+
+
+def _merge_schemas(a, b):
+    if a is None or a is type(None):
+        return b
+    if b is None or b is type(None):
+        return a
+    repeated = isinstance(a, list) or isinstance(b, list)
+    if repeated:
+        a = a[0] if isinstance(a, list) else a
+        b = b[0] if isinstance(b, list) else b
+        return [_merge_schemas(a, b)]
+    if isinstance(a, dict) or isinstance(b, dict):
+        if not isinstance(a, dict):
+            return b
+        if not isinstance(b, dict):
+            return a
+        merged = OrderedDict(a)
+        for tag, child in b.iteritems():
+            merged[tag] = _merge_schemas(merged.get(tag), child)
+        return merged
+    if a is b:
+        return a
+    if set([a, b]) <= set([int, long, float]):
+        return float
+    return str
+
+
+def _compile_node(tag, spec, path, classes):
+    if isinstance(spec, dict):
+        cls = _record_class(tag, list(spec))
+        classes[path] = cls
+        children = {}
+        for index, (child_tag, child) in enumerate(spec.iteritems()):
+            repeated = isinstance(child, list)
+            if repeated:
+                if len(child) != 1:
+                    raise ValueError("A repeated element is declared as a one-item list: %s/%s" % (path, child_tag))
+                child = child[0]
+            children[child_tag] = (index, repeated, _compile_node(child_tag, child, path + '/' + child_tag, classes))
+        return _RecordType(cls, children)
+    if spec in _leaf_converters:
+        return _leaf_converters[spec]
+    if callable(spec):
+        return spec
+    raise TypeError("Unsupported schema for %s: %r" % (path, spec))
+
+
+class Schema(object):
+    """
+    A compiled document schema (see compile_schema()). root is the record
+    class of the root element and classes maps the path of every element
+    with children (e.g. 'Books/Items/Item') to its record class.
+    """
+
+    def __init__(self, tag, spec, nsmap=None):
+        self.tag = tag
+        self.nsmap = nsmap
+        self.classes = OrderedDict()
+        self._root = _compile_node(tag, spec, tag, self.classes)
+        self.root = self._root.cls if isinstance(self._root, _RecordType) else None
+
+    def _builder(self, budget):
+        builder = _SchemaBuilder(self.tag, self._root, tag_names(self.nsmap))
+        if budget is None:
+            return _LatchingTarget(builder)
+        return _limit_target(builder, None, budget)
+
+    def fromstring(self, xml_str, backend=None, budget=None):
+        """
+        Parses xml_str straight into the schema's records and returns the
+        record of the root element. Elements that aren't in the schema are
+        skipped while parsing. budget is an optional Budget, as for
+        ezxml.fromstring().
+        """
+        backend = get_backend(backend)
+        return _timed('parse_convert', backend.parse_target, xml_str, self._builder(budget))
+
+    def parse_file(self, path, mmap=True, backend=None, budget=None):
+        """
+        As fromstring(), for the XML file at path (see parse_file()).
+        """
+        backend = get_backend(backend)
+        with _open_source(path, mmap) as source:
+            return _timed('parse_convert', backend.parse_target_file, source, self._builder(budget))
+
+
+class _SchemaBuilder(object):
+    """
+    A parser target building the records of a Schema directly from parser
+    events. Leaf text is converted with the leaf's type (and left as text
+    if it doesn't convert); a record element without children is None,
+    and a non-repeated element that occurs more than once becomes a list,
+    as in arrayified data.
+    """
+
+    def __init__(self, tag, root, names):
+        self._tag = tag
+        self._root = root
+        self._names = names
+        # Per open element: its compiled schema, the values of its record's
+        # slots (None until a child starts) and its text
+        self._frames = []
+        self._skipped = 0
+        self._result = None
+
+    def start(self, tag, attrib=None):
+        if self._skipped:
+            self._skipped += 1
+            return
+        if self._names is not None:
+            tag = self._names[tag]
+
+        frames = self._frames
+        if not frames:
+            if tag != self._tag:
+                raise ValueError("Expected a %s document, got %s" % (self._tag, tag))
+            frames.append([self._root, None, []])
+            return
+
+        parent = frames[-1]
+        node = parent[0]
+        if not isinstance(node, _RecordType):
+            self._skipped = 1
+            return
+        if parent[1] is None:
+            parent[1] = [None] * len(node.children)
+        child = node.children.get(tag)
+        if child is None:
+            self._skipped = 1
+            return
+        frames.append([child[2], None, [], child])
+
+    def data(self, text):
+        if not self._skipped and self._frames[-1][1] is None:
+            self._frames[-1][2].append(text)
+
+    def end(self, tag):
+        if self._skipped:
+            self._skipped -= 1
+            return
+
+        frame = self._frames.pop()
+        node, values = frame[0], frame[1]
+        if isinstance(node, _RecordType):
+            if values is None:
+                value = None
+            else:
+                for index in node.repeated:
+                    if values[index] is None:
+                        values[index] = []
+                value = node.cls(*values)
+        else:
+            value = ''.join(frame[2]) if frame[2] else None
+            if value is not None and node is not None:
+                try:
+                    value = node(value)
+                except ValueError:
+                    _count_coercion_failure()
+
+        if not self._frames:
+            self._result = value
+            return
+
+        index, repeated = frame[3][0], frame[3][1]
+        values = self._frames[-1][1]
+        existing = values[index]
+        if repeated:
+            if existing is None:
+                values[index] = [value]
+            else:
+                existing.append(value)
+        elif existing is None:
+            values[index] = value
+        elif isinstance(existing, list):
+            existing.append(value)
+        else:
+            values[index] = [existing, value]
+
+    def close(self):
+        return self._result
+
+
+def compile_schema(schema, nsmap=None, types=None, backend=None):
+    """
+    Compiles a schema into a Schema, whose fromstring() and parse_file()
+    parse documents straight into generated record classes: one per element
+    with children, with a __slots__ slot per child element, so that fields
+    are plain attribute reads and no dicts or wrappers are built.
+
+    schema is either a sample document, whose structure and leaf types
+    (inferred with types, as by fromstring()) are taken as the schema, or a
+    declared schema {root_tag: spec}, where spec is a dict of child tags to
+    specs for an element with children, a one-item list [spec] for a
+    repeated element, or the type (or function) to convert a leaf's text
+    with. Elements that are repeated anywhere in a sample are repeated
+    throughout, and leaves that are empty in a sample stay text. nsmap
+    translates namespaced names as for fromstring().
+
+    The slots of a record class are in the order of the first appearance
+    of its children in a sample, or in the order of a declared dict (use
+    an OrderedDict for a fixed order on Python 2).
+    """
+    if isinstance(schema, (basestring, bytes)):
+        root = get_backend(backend).fromstring(schema)
+        names = tag_names(nsmap)
+        types = default_types if types is None else types
+        schema = {root.tag if names is None else names[root.tag]: _infer_schema(root, types, names)}
+    if not isinstance(schema, dict) or len(schema) != 1:
+        raise ValueError("A schema has exactly one root element")
+    tag, spec = list(schema.items())[0]
+    return Schema(tag, spec, nsmap)
+
+
+class AsyncFeedParser(object):
+    """
+    An incremental parser for XML that arrives in chunks, e.g. the body of
+    an HTTP response being streamed on an asyncio event loop: feed() it the
+    chunks as they come in, close() it at the end, and iterate over it with
+    async for to get an objectified record for every element named tag.
+
+        parser = AsyncFeedParser('Item')
+        ...
+        parser.feed(chunk)  # as each chunk arrives
+        ...
+        async for item in parser:
+            ...
+
+    Records are converted as soon as the chunk that completes them has been
+    fed, so the work is spread out over the reading of the body. With an
+    executor (see loop.run_in_executor()) the conversion of each record is
+    handed off to it instead of being done on the event loop; records are
+    still delivered in document order.
+
+    Records that have been parsed but not yet delivered are kept until the
+    iteration reaches them, so if the body is read faster than the records
+    are consumed they pile up in memory; a reader can check pending and
+    wait before feeding more.
+
+    loop is the event loop to deliver records on, by default the loop
+    running when it is first needed (by __anext__(), or by feed() with an
+    executor). Parse errors are raised by feed() or close() and, once the
+    records before the error have been delivered, by the async iteration.
+    The options are those of iterparse(). Requires Python 3.5 or later.
+    """
+
+    def __init__(self, tag, executor=None, loop=None, **options):
+        names = tag_names(options.get('nsmap'))
+        if names is not None:
+            options['nsmap'] = names
+
+        self.tag = tag
+        self._executor = executor
+        self._loop = loop
+        self._options = options
+        self._parser = ElementTree.XMLPullParser(events=('start', 'end'))
+        self._splitter = _RecordSplitter(tag, names, options.pop('budget', None))
+        self._pending = deque()
+        self._waiter = None
+        # The pending conversion whose completion wakes the waiter
+        self._watched = None
+        self._error = None
+        self._closed = False
+
+    def _get_loop(self):
+        if self._loop is None:
+            # get_event_loop() is deprecated outside a running loop, but it
+            # is all there is before Python 3.7
+            get_running_loop = getattr(asyncio, 'get_running_loop', None)
+            if get_running_loop is None:
+                self._loop = asyncio.get_event_loop()
+            else:
+                self._loop = get_running_loop()
+        return self._loop
+
+    @property
+    def pending(self):
+        """
+        The number of records parsed (and possibly still being converted)
+        that haven't been delivered yet.
+        """
+        return len(self._pending)
+
+    def feed(self, data):
+        """
+        Feeds the next chunk of the document to the parser.
+        """
+        self._parse(self._parser.feed, data)
+
+    def close(self):
+        """
+        Tells the parser that the whole document has been fed, which ends
+        the async iteration once the remaining records have been delivered.
+        """
+        self._parse(self._parser.close)
+        self._closed = True
+        self._wake()
+
+    def _parse(self, method, *args):
+        try:
+            method(*args)
+            self._convert(self._splitter.records(self._parser.read_events()))
+        except SyntaxError as e:
+            self._error = e
+            raise
+        finally:
+            self._wake()
+
+    def _convert(self, records):
+        for elem in records:
+            if self._executor is None:
+                self._pending.append(arrayify_etree(elem, **self._options))
+            else:
+                self._pending.append(self._get_loop().run_in_executor(
+                    self._executor, partial(arrayify_etree, elem, **self._options)))
+
+    def _wake(self):
+        waiter = self._waiter
+        if waiter is not None and (waiter.cancelled() or self._fill(waiter)):
+            self._waiter = None
+
+    def _fill(self, waiter):
+        if self._pending:
+            record = self._pending[0]
+            if not isinstance(record, dict):
+                # A conversion in the executor. It stays pending until it is
+                # done, so that it isn't lost if waiter is cancelled meanwhile
+                if not record.done():
+                    if record is not self._watched:
+                        self._watched = record
+                        record.add_done_callback(self._converted)
+                    return False
+                if record.cancelled():
+                    self._pending.popleft()
+                    waiter.cancel()
+                    return True
+                if record.exception() is not None:
+                    self._pending.popleft()
+                    waiter.set_exception(record.exception())
+                    return True
+                record = record.result()
+            self._pending.popleft()
+            waiter.set_result(_record_objectifier(record[self.tag], self.tag))
+        elif self._error is not None:
+            waiter.set_exception(self._error)
+        elif self._closed:
+            waiter.set_exception(StopAsyncIteration())
+        else:
+            return False
+        return True
+
+    def _converted(self, future):
+        self._wake()
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        waiter = self._get_loop().create_future()
+        if not self._fill(waiter):
+            self._waiter = waiter
+        return waiter
+
+
+class _SentParseError(SyntaxError):
+    """
+    A parse error sent back from a worker process. Python 2's cElementTree
+    ParseError can't be pickled, so its message, code and position are
+    sent instead, and rebuild() turns them back into an ElementTree
+    ParseError.
+    """
+
+    def __init__(self, msg, code=None, position=None):
+        SyntaxError.__init__(self, msg)
+        self.code = code
+        self.position = position
+
+    def __reduce__(self):
+        return (_SentParseError, (self.args[0], self.code, self.position))
+
+    @classmethod
+    def wrap(cls, error):
+        if isinstance(error, SyntaxError):
+            return cls(str(error), getattr(error, 'code', None), getattr(error, 'position', None))
+        return error
+
+    @staticmethod
+    def unwrap(error):
+        if not isinstance(error, _SentParseError):
+            return error
+        rebuilt = ElementTree.ParseError(error.args[0])
+        rebuilt.code = error.code
+        rebuilt.position = error.position
+        return rebuilt
+
+
+def _arrayify_numbered(job, backend=None, **options):
+    # Errors are sent back rather than raised, so that they don't take the
+    # other documents of the chunk down with them
+    number, xml_str = job
+    try:
+        return number, arrayify_xml(xml_str, backend, **options), None
+    except Exception as e:
+        return number, None, _SentParseError.wrap(e)
+
+
+def parse_many(sources, workers=None, chunksize=16, ordered=True, backend=None, **options):
+    """
+    Parses every XML document in the iterable sources across a pool of
+    workers processes (by default one per CPU) and yields an Objectifier
+    for each, in the order of sources. With ordered=False results are
+    yielded as soon as they are done, as (position in sources, Objectifier)
+    pairs.
+
+    Documents are sent to the workers chunksize at a time and come back as
+    arrayified data, which is wrapped in this process. The backend and
+    options are those of fromstring() and must be picklable; with the spawn
+    start method, workers only know the backends registered when ezxml is
+    imported. A document that fails to parse raises its error when its
+    result is reached, which ends the batch.
+
+    With workers=1 the documents are parsed in this process without a pool.
+    """
+    job = partial(_arrayify_numbered, backend=backend, **options)
+
+    if workers == 1:
+        results = (job(numbered) for numbered in enumerate(sources))
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers)
+        if ordered:
+            results = pool.imap(job, enumerate(sources), chunksize)
+        else:
+            results = pool.imap_unordered(job, enumerate(sources), chunksize)
+
+    try:
+        for number, root, error in results:
+            if error is not None:
+                raise _SentParseError.unwrap(error)
+            obj = _root_objectifier(root, None)
+            if ordered:
+                yield obj
+            else:
+                yield number, obj
+    finally:
+        if pool is not None:
+            # Also stops the workers if the caller stops iterating early
+            pool.terminate()
+            pool.join()
+
+
+_xml_declaration = re.compile(br'(?:\xef\xbb\xbf)?<\?xml[^>]*\?>')
+
+_start_tag = re.compile(br'<([^\s/>]+)(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*>')
+
+
+class _RecordFound(Exception):
+    pass
+
+
+def _record_context(data, tag, names):
+    """
+    Finds the first element named tag (as translated by the TagNames names,
+    if given) in data, and returns its offset (None if there is none) along
+    with the XML declaration and start tags, and the end tags, of the
+    elements enclosing it. These are wrapped around every chunk of the
+    document so that it parses with the same encoding and namespaces.
+    """
+    open_tags = []
+    parser = expat.ParserCreate(None, '}')
+
+    def start(name, attrs):
+        if '}' in name:
+            name = '{' + name
+        if (name if names is None else names[name]) == tag:
+            raise _RecordFound(parser.CurrentByteIndex)
+        open_tags.append(parser.CurrentByteIndex)
+
+    parser.StartElementHandler = start
+    parser.EndElementHandler = lambda name: open_tags.pop()
+    try:
+        for i in range(0, len(data), FEED_CHUNK_SIZE):
+            parser.Parse(data[i:i + FEED_CHUNK_SIZE], False)
+        parser.Parse(b'', True)
+    except _RecordFound as found:
+        first = found.args[0]
+    except expat.ExpatError as err:
+        raise ElementTree.ParseError(str(err))
+    else:
+        return None, b'', b''
+
+    declaration = _xml_declaration.match(data)
+    start_tags = [_start_tag.match(data, offset) for offset in open_tags]
+    prefix = (declaration.group(0) if declaration else b'') + b''.join([m.group(0) for m in start_tags])
+    suffix = b''.join([b'</' + m.group(1) + b'>' for m in reversed(start_tags)])
+    return first, prefix, suffix
+
+
+def _record_pattern(tag, nsmap):
+    """
+    Returns a pattern matching the start tags of the elements that could be
+    named tag once translated with nsmap, whatever their prefix.
+    """
+    locals_ = set([tag.split('}')[-1]])
+    if nsmap is not None:
+        for prefix in nsmap:
+            if prefix and tag.startswith(prefix + '_'):
+                locals_.add(tag[len(prefix) + 1:])
+    names = '|'.join([re.escape(name) for name in sorted(locals_)]).encode('utf-8')
+    return re.compile(br'<(?:[^\s<>/!?:]+:)?(?:' + names + br')[\s/>]')
+
+
+def _split_document(data, first, pattern, chunk_size):
+    """
+    Returns the (start, end, wrap_start, wrap_end) byte ranges that data is
+    split into, given the offset of its first record: each begins with a
+    start tag matching pattern, except for the first, and is at least
+    chunk_size bytes long, except for the last. wrap_start and wrap_end say
+    whether the range needs the context of the first record (see
+    _record_context()) before and after it.
+    """
+    points = [first]
+    while True:
+        match = pattern.search(data, points[-1] + chunk_size)
+        if match is None:
+            break
+        points.append(match.start())
+
+    bounds = [0] + points[1:] + [len(data)]
+    last = len(bounds) - 2
+    return [(bounds[i], bounds[i + 1], i > 0, i < last) for i in range(last + 1)]
+
+
+def _parse_range(job, tag=None, options=None):
+    # Sends errors back rather than raising them, as _arrayify_numbered(),
+    # along with the elements and text the range used of the budget
+    path, start, end, prefix, suffix = job
+    options = dict(options)
+    names = tag_names(options.get('nsmap'))
+    if names is not None:
+        options['nsmap'] = names
+    splitter = _RecordSplitter(tag, names, options.get('budget'))
+    try:
+        with _open_source(path, True) as source:
+            chunk = source[start:end]
+        records = list(_iter_records(io.BytesIO(prefix + chunk + suffix), tag, options, splitter))
+    except ElementTree.ParseError as e:
+        return None, _SentParseError(
+            "%s, in bytes %d-%d, which can't be parsed apart from the rest of the document" % (e, start, end),
+            getattr(e, 'code', None)), None
+    except Exception as e:
+        return None, _SentParseError.wrap(e), None
+
+    meter = splitter.meter
+    return records, None, None if meter is None else (meter.nodes, meter.text)
+
+
+def _submit_bounded(pool, func, jobs, limit):
+    """
+    Yields func(job) for each of jobs, in order, as computed by pool,
+    submitting a job only once fewer than limit results are waiting to be
+    yielded, so that memory stays bounded when they are consumed slowly.
+    """
+    jobs = iter(jobs)
+    pending = deque()
+    for job in jobs:
+        pending.append(pool.apply_async(func, (job,)))
+        if len(pending) == limit:
+            break
+
+    while pending:
+        result = pending.popleft().get()
+        # Keeps the workers busy while the result is being consumed
+        for job in jobs:
+            pending.append(pool.apply_async(func, (job,)))
+            break
+        yield result
+
+
+def parse_large(path, record, workers=None, chunk_size=16 * 1024 * 1024, **options):
+    """
+    Parses the XML file at path across a pool of workers processes (by
+    default one per CPU) and yields an objectified record for every element
+    named record, in document order, as parse_file(path, tag=record) does.
+
+    The file is split into chunks of about chunk_size bytes at the start
+    tags of records. Each worker reads its chunk from the file itself and
+    parses it wrapped in the XML declaration and the start and end tags of
+    the elements around the first record, so that encoding and namespace
+    declarations carry over. This requires every element after the first
+    record with the local name of record to be at the depth of the first
+    record, as with sibling records, and the encoding to be ASCII
+    compatible; a chunk that doesn't parse raises a ParseError.
+
+    Records are converted by the workers and come back as arrayified data,
+    which is wrapped in this process; the options are those of
+    arrayify_etree() and must be picklable. At most two chunks per worker
+    are parsed ahead of the records being consumed. With workers=1, or if
+    the file is a single chunk, it is parsed in this process without a
+    pool.
+
+    budget is an optional Budget for the whole document. Each chunk is
+    parsed within it, and the elements and text of the chunks and the time
+    since the call are added up as the chunks come back, in document order,
+    so a document over a limit fails with BudgetExceeded before the records
+    of the chunk that takes it over are yielded, but only once that chunk
+    has been parsed. As with iterparse(), the text of an element is only
+    counted once the element ends.
+    """
+    with _open_source(path, True) as source:
+        # Empty files aren't mapped; they fail to parse as with parse_file()
+        data = source if isinstance(source, _mmap.mmap) else b''
+        first, prefix, suffix = _record_context(data, record, tag_names(options.get('nsmap')))
+        if first is None:
+            ranges = [(0, len(data), False, False)]
+        else:
+            ranges = _split_document(data, first, _record_pattern(record, options.get('nsmap')), chunk_size)
+
+    jobs = [(path, start, end, prefix if wrap_start else b'', suffix if wrap_end else b'')
+            for start, end, wrap_start, wrap_end in ranges]
+    job = partial(_parse_range, tag=record, options=options)
+    budget = options.get('budget')
+    meter = None if budget is None else _BudgetMeter(budget)
+    # The elements wrapped around a chunk were counted with the first one
+    wrappers = suffix.count(b'<')
+
+    if workers == 1 or len(jobs) == 1:
+        results = (job(j) for j in jobs)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers)
+        results = _submit_bounded(pool, job, jobs, 2 * (workers or multiprocessing.cpu_count()))
+
+    try:
+        for i, (records, error, used) in enumerate(results):
+            if error is not None:
+                raise _SentParseError.unwrap(error)
+            if meter is not None:
+                nodes, text = used
+                meter.add(nodes - wrappers if ranges[i][2] else nodes, text)
+            for value in records:
+                yield _record_objectifier(value, record)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+#: The namespace of xml:lang, xml:space and the like
+XML_NAMESPACE = 'http://www.w3.org/XML/1998/namespace'
+
+
+def _escape_text(text):
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+
+def _escape_attrib(text):
+    text = _escape_text(text)
+    if '"' in text:
+        text = text.replace('"', '&quot;')
+    if '\n' in text:
+        text = text.replace('\n', '&#10;')
+    if '\t' in text:
+        text = text.replace('\t', '&#09;')
+    return text
+
+
+def _leaf_text(value):
+    """
+    Returns the XML text of a leaf value, the reverse of default_types.
+    """
+    if value is True:
+        return 'true'
+    elif value is False:
+        return 'false'
+    elif isinstance(value, basestring):
+        return value
+    elif isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class XMLWriter(object):
+    """
+    Writes arrayified data (or Objectifiers) to the file object file as XML,
+    incrementally: output is buffered up to buffer_size characters and then
+    written out, so the whole document is never built in memory. Documents
+    can be written whole with element(), or built up record by record:
+
+        writer = XMLWriter(f)
+        writer.start('Items')
+        for item in ezxml.iterparse(source, 'Item'):
+            writer.element('Item', transform(item))
+        writer.close()
+
+    This reverses arrayify_etree(): lists are written as repeated elements,
+    dicts as elements with children, attributes stored under ATTRIBUTES_KEY
+    as attributes and leaf values as text ('true'/'false' for booleans,
+    empty elements for None). Names in ElementTree's "{uri}local" form are
+    written with generated ns0, ns1, ... prefixes, declared on the elements
+    where they are first needed.
+
+    encoding follows ElementTree's write(): text is encoded with it (using
+    character references for what it can't encode) unless it is 'unicode',
+    and an XML declaration is written if xml_declaration is true, or if it
+    is None and encoding isn't 'us-ascii', 'utf-8' or 'unicode'.
+    """
+
+    def __init__(self, file, encoding='us-ascii', xml_declaration=None, buffer_size=65536):
+        self.file = file
+        self.encoding = encoding
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._buffered = 0
+        self._open = []
+        # Namespace URI to prefix, for the namespaces declared on the open
+        # elements
+        self._prefixes = {}
+        self._declared = 0
+
+        if xml_declaration or (xml_declaration is None and
+                               encoding.lower() not in ('us-ascii', 'utf-8', 'unicode')):
+            declared = 'utf-8' if encoding.lower() == 'unicode' else encoding
+            self._write(u"<?xml version='1.0' encoding='%s'?>\n" % declared)
+
+    def _write(self, text):
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered output to the file.
+        """
+        text = u''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        if self.encoding.lower() == 'unicode':
+            self.file.write(text)
+        else:
+            self.file.write(text.encode(self.encoding, 'xmlcharrefreplace'))
+
+    def _qualify(self, name, declarations):
+        if name[:1] != '{':
+            return name
+        uri, local = name[1:].split('}', 1)
+        if uri == XML_NAMESPACE:
+            # Bound to the xml prefix by definition, and must not be declared
+            return 'xml:' + local
+        prefix = self._prefixes.get(uri)
+        if prefix is None:
+            prefix = self._prefixes[uri] = 'ns%d' % self._declared
+            self._declared += 1
+            declarations.append(uri)
+        return '%s:%s' % (prefix, local)
+
+    def _start_tag(self, tag, attrib, close):
+        # Returns the qualified name written, for the end tag, and the
+        # namespaces declared on the element
+        declarations = []
+        qualified = self._qualify(tag, declarations)
+        parts = ['<', qualified]
+        if attrib:
+            for name, value in attrib.iteritems():
+                parts.extend([' ', self._qualify(name, declarations), '="',
+                              _escape_attrib(_leaf_text(value)), '"'])
+        for uri in declarations:
+            parts.extend([' xmlns:', self._prefixes[uri], '="', _escape_attrib(uri), '"'])
+        parts.append(close)
+        self._write(u''.join(parts))
+        return qualified, declarations
+
+    def start(self, tag, attrib=None):
+        """
+        Writes the start tag of an element, to be closed by end().
+        """
+        self._open.append(self._start_tag(tag, attrib, '>'))
+
+    def end(self):
+        """
+        Writes the end tag of the most recently started element that is
+        still open.
+        """
+        name, declarations = self._open.pop()
+        self._write(u'</%s>' % name)
+        self._forget(declarations)
+
+    def element(self, tag, value):
+        """
+        Writes value (arrayified data or an Objectifier) as tag elements,
+        one per item if it is a list.
+        """
+        if isinstance(value, Objectifier):
+            value = value.response_data
+
+        # Walked with an explicit stack like arrayify_etree(), so that deep
+        # documents don't hit the recursion limit; ends holds whether each
+        # level must be closed with end()
+        stack = [iter([(tag, value)])]
+        ends = [False]
+
+        while stack:
+            for tag, value in stack[-1]:
+                if isinstance(value, list):
+                    stack.append(_tagged(tag, value))
+                    ends.append(False)
+                    break
+
+                if not isinstance(value, dict):
+                    if value is None:
+                        self._forget(self._start_tag(tag, None, '/>')[1])
+                    else:
+                        name, declarations = self._start_tag(tag, None, '>')
+                        self._write(_escape_text(_leaf_text(value)) + u'</%s>' % name)
+                        self._forget(declarations)
+                    continue
+
+                attrib = value.get(ATTRIBUTES_KEY)
+                text = value.get(TEXT_KEY)
+                children = [(k, v) for k, v in value.iteritems() if k != ATTRIBUTES_KEY and k != TEXT_KEY]
+
+                if not children and text is None:
+                    self._forget(self._start_tag(tag, attrib, '/>')[1])
+                    continue
+
+                self.start(tag, attrib)
+                if text is not None:
+                    self._write(_escape_text(_leaf_text(text)))
+                stack.append(iter(children))
+                ends.append(True)
+                break
+            else:
+                stack.pop()
+                if ends.pop():
+                    self.end()
+
+    def _forget(self, declarations):
+        # Namespaces declared on an element that is already closed
+        for uri in declarations:
+            del self._prefixes[uri]
+
+    def close(self):
+        """
+        Ends every element that is still open and flushes the output.
+        """
+        while self._open:
+            self.end()
+        self.flush()
+
+
+def _tagged(tag, values):
+    for value in values:
+        yield tag, value
+
+
+def _tag_for(obj, tag):
+    if tag is None:
+        tag = getattr(obj, '_root_tag', None)
+        if tag is None:
+            raise ValueError("A tag is needed to write %r as XML" % (obj,))
+    return tag
+
+
+def write(obj, file, tag=None, encoding='us-ascii', xml_declaration=None):
+    """
+    Writes obj (an Objectifier or arrayified data) to the file object file
+    as XML, incrementally, with an XMLWriter. tag is the name of the root
+    element, by default the one obj was parsed or navigated from.
+    """
+    writer = XMLWriter(file, encoding, xml_declaration)
+    writer.element(_tag_for(obj, tag), obj)
+    writer.close()
+
+
+def tostring(obj, tag=None, encoding='us-ascii', xml_declaration=None):
+    """
+    Returns obj as an XML document, as write() would write it: bytes, or
+    text if encoding is 'unicode'.
+    """
+    if encoding.lower() == 'unicode':
+        f = io.StringIO()
+    else:
+        f = io.BytesIO()
+    write(obj, f, tag, encoding, xml_declaration)
+    return f.getvalue()
 
-    root = arrayify_etree(etree)
-    children = root.items()[0][1]
 
-    return Objectifier(children)
+def write_json(obj, file, **kwargs):
+    """
+    Writes obj (an Objectifier or plain data) to the text file object file
+    as JSON, incrementally with json.dump(); kwargs are passed on to it.
+    """
+    if isinstance(obj, Objectifier):
+        obj = obj.response_data
+    json.dump(obj, file, **kwargs)
@@ -0,0 +1,81 @@
+"""
+Benchmarks for ezxml: micro-benchmarks of individual features (micro) and
+a suite comparing ezxml with lxml.objectify and plain ElementTree on the
+test fixtures and generated documents (suite). Run with:
+
+    python -m ezxml.benchmarks [--json FILE]
+
+This module holds the measuring helpers they share.
+"""
+
+from __future__ import print_function
+
+import os
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def measure(func, *args, **kwargs):
+    """
+    Returns (best seconds per call, transient bytes) for func(*args), or
+    (None, None) if the call fails, e.g. by exceeding the recursion limit.
+
+    Transient bytes is the peak traced memory minus what the result itself
+    retains, i.e. the temporary allocations made along the way.
+    """
+    repeat = kwargs.pop('repeat', 5)
+
+    try:
+        seconds = min(timeit.repeat(lambda: func(*args), number=1, repeat=repeat))
+    except RuntimeError:
+        return None, None
+
+    transient = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        result = func(*args)
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        transient = peak - retained
+        del result
+
+    return seconds, transient
+
+
+def peak_memory(func, *args):
+    """
+    Returns the peak traced memory in bytes while running func(*args), or
+    None if tracemalloc is unavailable.
+    """
+    if tracemalloc is None:
+        return None
+
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def resident_memory():
+    """
+    Returns the resident set size of this process in bytes, or None where
+    /proc is unavailable. Used for memory that tracemalloc can't see.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def format_result(name, seconds, transient):
+    if seconds is None:
+        return '%-40s %12s' % (name, 'failed')
+    if transient is None:
+        return '%-40s %10.2fms' % (name, seconds * 1000)
+    return '%-40s %10.2fms %10.1fKiB transient' % (name, seconds * 1000, transient / 1024.0)
@@ -0,0 +1,49 @@
+"""
+Runs the ezxml benchmarks; see ezxml.benchmarks.
+"""
+
+from __future__ import print_function
+
+import sys
+from optparse import OptionParser
+
+from ezxml import json
+from ezxml.benchmarks import micro, suite
+
+
+def main(argv=None):
+    parser = OptionParser(usage='python -m ezxml.benchmarks [options]')
+    parser.add_option('--micro', action='store_true', help='only run the micro-benchmarks')
+    parser.add_option('--suite', action='store_true', help='only run the comparison suite')
+    parser.add_option('--repeat', type='int', default=5, help='runs per measurement (default: %default)')
+    parser.add_option('--json', metavar='FILE',
+                      help='write the suite results to FILE as JSON ("-" for stdout)')
+    options, args = parser.parse_args(argv)
+
+    stdout = sys.stdout
+    if options.json == '-':
+        # Keep stdout for the JSON document
+        sys.stdout = sys.stderr
+
+    try:
+        if not options.suite:
+            micro.run()
+            if not options.micro:
+                print()
+        if not options.micro:
+            results = suite.run(options.repeat)
+    finally:
+        sys.stdout = stdout
+
+    if options.json and not options.micro:
+        document = {'metadata': suite.metadata(), 'results': results}
+        if options.json == '-':
+            json.dump(document, sys.stdout, indent=2, sort_keys=True)
+            print()
+        else:
+            with open(options.json, 'w') as f:
+                json.dump(document, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""
+Documents for the benchmarks: the fixtures that the tests run against both
+ezxml and lxml.objectify (which the tests own, see ezxml.tests), and
+generators for large, wide and deep documents.
+"""
+
+from ezxml.tests import EZXMLTests as _EZXMLTests
+
+# Any test method will do to get at the fixtures
+_tests = _EZXMLTests('get_books_xml')
+
+BOOKS_XML = _tests.get_books_xml()
+PEOPLE_XML = _tests.get_people_xml()
+PRICING_XML = _tests.get_pricing_xml()
+PLIST_XML = _tests.get_plist_xml()
+SAMPLE_XHTML = _tests.get_sample_xhtml()
+
+
+def wide_xml(count=20000):
+    """A document with many repeated records under a single parent."""
+    items = ''.join(['<Item><ISBN>%d</ISBN><Title>Book %d</Title></Item>' % (i, i)
+                     for i in range(count)])
+    return '<Books><Items>%s</Items></Books>' % items
+
+
+def deep_xml(depth=500):
+    """A document nested depth levels deep."""
+    return '<a>' * depth + '<b>1</b>' + '</a>' * depth
+
+
+def large_xml(count=5000):
+    """A catalog of count records with attributes and mixed leaf types."""
+    items = ''.join([
+        '<Item id="%d"><Title>Book %d</Title><Price currency="USD">%d.99</Price>'
+        '<InStock>%s</InStock><Tags><Tag>fiction</Tag><Tag>series %d</Tag></Tags></Item>'
+        % (i, i, i % 100, 'true' if i % 3 else 'false', i % 7) for i in range(count)])
+    return '<Catalog><Header><Generated>2012-01-01</Generated></Header><Items>%s</Items></Catalog>' % items
@@ -0,0 +1,485 @@
+"""
+Micro-benchmarks of individual ezxml features against the implementations
+they replaced or the alternatives they offer. Run with the rest of the
+benchmarks, or on their own with:
+
+    python -m ezxml.benchmarks --micro
+"""
+
+from __future__ import print_function
+
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import timeit
+
+import ezxml
+from ezxml import ElementTree
+from ezxml.benchmarks import format_result, measure, peak_memory, tracemalloc
+from ezxml.benchmarks.fixtures import deep_xml, wide_xml
+
+
+def legacy_coerce_text(text):
+    """
+    The int-only leaf coercion that ezxml used to ship, kept as a reference
+    point for the benchmarks.
+    """
+    try:
+        return int(text)
+    except (TypeError, ValueError):
+        return text
+
+
+def arrayify_etree_recursive(e):
+    """
+    The recursive arrayify_etree() that ezxml used to ship, kept as a
+    reference point for the benchmarks.
+    """
+    children = list(e)
+
+    if len(children) == 0:
+        return {e.tag: ezxml.coerce_text(e.text)}
+    else:
+        d = {}
+
+        for x in children:
+            for k, v in arrayify_etree_recursive(x).items():
+                if k in d:
+                    if isinstance(d[k], list):
+                        d[k].append(v)
+                    else:
+                        d[k] = [d[k], v]
+                else:
+                    d[k] = v
+
+        return {e.tag: d}
+
+
+class LegacyObjectifiedElement(object):
+    """
+    ObjectifiedElement as ezxml used to define it, with a per-instance
+    __dict__ and a __setattr__ hook, kept as a reference point for the
+    benchmarks.
+    """
+
+    def __init__(self, text=None):
+        self.tag = self.__class__.__name__
+        self._children = []
+        self._parent = None
+        self._text = text
+
+    def append(self, child):
+        child._parent = self
+        self._children.append(child)
+
+    def __setattr__(self, attr_name, value):
+        if attr_name == 'text':
+            raise TypeError("attribute %r of %r objects is not writable"
+                % (attr_name, self.__class__.__name__))
+
+        super(LegacyObjectifiedElement, self).__setattr__(attr_name, value)
+
+
+class UncachedObjectifier(ezxml.Objectifier):
+    """
+    An Objectifier that allocates a new wrapper on every navigation step, as
+    ezxml used to, kept as a reference point for the benchmarks.
+    """
+
+    __slots__ = ()
+
+    def _wrap(self, key, value):
+        if hasattr(value, 'pop'):
+            return UncachedObjectifier(value)
+        return value
+
+
+def bench_arrayify_etree():
+    """Compares the explicit-stack arrayify_etree() with the recursive one."""
+    fixtures = [
+        ('wide (20000 records)', wide_xml(20000)),
+        ('deep (500 levels)', deep_xml(500)),
+        ('deep (%d levels)' % (sys.getrecursionlimit() * 2), deep_xml(sys.getrecursionlimit() * 2)),
+    ]
+
+    for fixture_name, xml in fixtures:
+        etree = ElementTree.fromstring(xml)
+        print(fixture_name)
+        for name, func in [('  arrayify_etree (recursive)', arrayify_etree_recursive),
+                           ('  arrayify_etree', ezxml.arrayify_etree)]:
+            print(format_result(name, *measure(func, etree)))
+
+
+def bench_backends():
+    """Compares fromstring() throughput and peak memory per parser backend."""
+    xml = wide_xml(20000).encode('utf-8')
+
+    print('fromstring, wide (20000 records)')
+    for backend in ezxml.available_backends():
+        parse = lambda: ezxml.fromstring(xml, backend=backend)
+        seconds, _ = measure(parse, repeat=5)
+        peak = peak_memory(parse)
+        line = '%-40s %10.2fms %8.1f docs/s' % ('  ' + backend, seconds * 1000, 1 / seconds)
+        if peak is not None:
+            line += ' %10.1fKiB peak' % (peak / 1024.0)
+        print(line)
+
+
+def bench_wrapper_caching():
+    """Compares repeated navigation with and without memoized wrappers."""
+    data = ezxml.fromstring(wide_xml(20000)).response_data
+    count = len(data['Items']['Item'])
+
+    def navigate(obj):
+        for i in range(count):
+            obj.Items.Item[i].ISBN
+
+    print('obj.Items.Item[i].ISBN for 20000 records')
+    for name, cls in [('  uncached wrappers', UncachedObjectifier),
+                      ('  memoized wrappers', ezxml.Objectifier)]:
+        obj = cls(data)
+        navigate(obj)
+        print(format_result(name, *measure(navigate, obj)))
+
+
+def bench_type_inference(count=100000):
+    """Compares leaf coercion on string-heavy and numeric leaves."""
+    fixtures = [
+        ('string leaves', ['Book %d' % i for i in range(count)]),
+        ('integer leaves', [str(i) for i in range(count)]),
+    ]
+
+    def coerce_all(coerce, texts):
+        for text in texts:
+            coerce(text)
+
+    for fixture_name, texts in fixtures:
+        print('coercing %d %s' % (count, fixture_name))
+        for name, coerce in [('  try int() (legacy)', legacy_coerce_text),
+                             ('  default_types.coerce', ezxml.default_types.coerce)]:
+            print(format_result(name, *measure(coerce_all, coerce, texts)))
+
+
+def build_elements(element_class, data_element_class, count):
+    root = element_class()
+    for i in range(count):
+        item = element_class()
+        item.append(data_element_class('Book %d' % i))
+        root.append(item)
+    return root
+
+
+def bench_element_memory(count=100000):
+    """Compares the memory used by trees of element objects."""
+    print('element trees (%d records, %d elements)' % (count, count * 2 + 1))
+
+    candidates = [
+        ('  legacy ObjectifiedElement', LegacyObjectifiedElement, LegacyObjectifiedElement),
+        ('  ObjectifiedElement (__slots__)', ezxml.ObjectifiedElement, ezxml.StringElement),
+    ]
+    for name, element_class, data_element_class in candidates:
+        if tracemalloc is None:
+            peak = None
+        else:
+            tracemalloc.start()
+            tree = build_elements(element_class, data_element_class, count)
+            peak = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del tree
+        if peak is None:
+            print('%-40s %12s' % (name, 'n/a'))
+        else:
+            print('%-40s %10.1fKiB %6.1f bytes/element' % (name, peak / 1024.0, peak / (count * 2 + 1.0)))
+
+    # lxml allocates its tree outside the Python heap, so compare resident
+    # memory instead, in a fresh interpreter where it isn't muddied by the
+    # allocations above
+    script = '\n'.join([
+        'import lxml.objectify, ezxml.benchmarks as b',
+        'xml = "<Books>%s</Books>" % "".join(["<Item><Title>Book %d</Title></Item>" % i for i in range(COUNT)])',
+        'before = b.resident_memory()',
+        'tree = lxml.objectify.fromstring(xml)',
+        'after = b.resident_memory()',
+        'print(after - before if before is not None else "")',
+    ]).replace('COUNT', str(count))
+    try:
+        output = subprocess.check_output([sys.executable, '-c', script], stderr=subprocess.STDOUT)
+        used = int(output)
+    except (subprocess.CalledProcessError, OSError, ValueError):
+        # lxml is not installed or /proc is unavailable
+        return
+
+    print('%-40s %10.1fKiB %6.1f bytes/element (resident)' % (
+        '  lxml.objectify', used / 1024.0, used / (count * 2 + 1.0)))
+
+
+def bench_parse_many(count=2000):
+    """Compares a fromstring() loop with parse_many() over process pools."""
+    documents = [wide_xml(50).encode('utf-8')] * count
+
+    def parse_serially():
+        for xml in documents:
+            ezxml.fromstring(xml)
+
+    def parse_pooled(workers):
+        for obj in ezxml.parse_many(documents, workers=workers, chunksize=64):
+            pass
+
+    print('%d documents (50 records each), %d CPUs' % (count, multiprocessing.cpu_count()))
+    candidates = [('  fromstring() loop', parse_serially, ())]
+    for workers in sorted(set([1, 2, 4, multiprocessing.cpu_count()])):
+        candidates.append(('  parse_many(workers=%d)' % workers, parse_pooled, (workers,)))
+    for name, func, args in candidates:
+        seconds = min(timeit.repeat(lambda: func(*args), number=1, repeat=3))
+        print('%-40s %10.2fms %8.1f docs/s' % (name, seconds * 1000, count / seconds))
+
+
+def bench_async_feed(chunk_size=16384):
+    """
+    Compares the longest time the event loop is blocked when a body that
+    arrives in chunks is parsed with fromstring() at the end or fed to an
+    AsyncFeedParser as it arrives.
+    """
+    if ezxml.asyncio is None:
+        return
+
+    xml = wide_xml(20000).encode('utf-8')
+    chunks = [xml[i:i + chunk_size] for i in range(0, len(xml), chunk_size)]
+
+    def feed_all():
+        loop = ezxml.asyncio.new_event_loop()
+        parser = ezxml.AsyncFeedParser('Item', loop=loop)
+        steps = []
+        for chunk in chunks:
+            start = timeit.default_timer()
+            parser.feed(chunk)
+            steps.append(timeit.default_timer() - start)
+        parser.close()
+        loop.close()
+        return sorted(steps)
+
+    steps = feed_all()
+    p99 = steps[int(len(steps) * 0.99)]
+    print('event loop blocking, wide (20000 records) in %d chunks of %d bytes' % (len(chunks), chunk_size))
+    print('%-40s %10.2fms longest' % ('  fromstring() at the end', measure(ezxml.fromstring, xml)[0] * 1000))
+    print('%-40s %10.2fms longest %8.2fms p99' % ('  AsyncFeedParser.feed() per chunk', steps[-1] * 1000, p99 * 1000))
+
+
+def bench_parse_file():
+    """Compares the peak memory of reading a file whole and parse_file()."""
+    fd, path = tempfile.mkstemp(suffix='.xml')
+    os.write(fd, wide_xml(100000).encode('utf-8'))
+    os.close(fd)
+
+    def read_whole():
+        with open(path, 'rb') as f:
+            return ezxml.fromstring(f.read())
+
+    def read_records(**kwargs):
+        for record in ezxml.parse_file(path, tag='Item', **kwargs):
+            pass
+
+    try:
+        print('wide (100000 records), %.1fKiB file' % (os.path.getsize(path) / 1024.0))
+        for name, func in [('  fromstring(f.read())', read_whole),
+                           ('  parse_file(mmap=False)', lambda: ezxml.parse_file(path, mmap=False)),
+                           ('  parse_file()', lambda: ezxml.parse_file(path)),
+                           ('  parse_file(tag=...)', read_records)]:
+            seconds, _ = measure(func, repeat=3)
+            peak = peak_memory(func)
+            line = '%-40s %10.2fms' % (name, seconds * 1000)
+            if peak is not None:
+                line += ' %10.1fKiB peak' % (peak / 1024.0)
+            print(line)
+    finally:
+        os.remove(path)
+
+
+def bench_parse_cache():
+    """Compares parsing a document with finding it in a ParseCache."""
+    xml = wide_xml(2000).encode('utf-8')
+    cache = ezxml.ParseCache()
+    ezxml.fromstring(xml, cache=cache)
+
+    print('fromstring, wide (2000 records)')
+    print(format_result('  uncached', *measure(ezxml.fromstring, xml)))
+    print(format_result('  ParseCache hit', *measure(lambda: ezxml.fromstring(xml, cache=cache))))
+
+
+def bench_binary():
+    """Compares reloading a document from XML and from dumps()."""
+    xml = wide_xml(20000).encode('utf-8')
+    data = ezxml.fromstring(xml).dumps()
+
+    print('wide (20000 records): %.1fKiB as XML, %.1fKiB binary' % (len(xml) / 1024.0, len(data) / 1024.0))
+    print(format_result('  fromstring()', *measure(ezxml.fromstring, xml)))
+    print(format_result('  loads_binary()', *measure(ezxml.loads_binary, data)))
+
+
+def build_etree(tag, value):
+    """Rebuilds an ElementTree element from arrayified data, by hand."""
+    elem = ElementTree.Element(tag)
+    for k, v in value.items():
+        for item in (v if isinstance(v, list) else [v]):
+            if isinstance(item, dict):
+                elem.append(build_etree(k, item))
+            else:
+                ElementTree.SubElement(elem, k).text = str(item)
+    return elem
+
+
+def bench_serialize():
+    """Compares writing arrayified data out via ElementTree and directly."""
+    obj = ezxml.fromstring(wide_xml(20000))
+
+    def write_file(f):
+        ezxml.write(obj, f)
+
+    def write_streaming():
+        with open(os.devnull, 'wb') as f:
+            write_file(f)
+
+    print('writing wide (20000 records)')
+    for name, func in [('  rebuild ElementTree + tostring()',
+                        lambda: ElementTree.tostring(build_etree('Books', obj.response_data))),
+                       ('  ezxml.tostring()', lambda: ezxml.tostring(obj)),
+                       ('  ezxml.write() to a file', write_streaming),
+                       ('  to_json()', obj.to_json)]:
+        seconds, _ = measure(func, repeat=3)
+        peak = peak_memory(func)
+        line = '%-40s %10.2fms' % (name, seconds * 1000)
+        if peak is not None:
+            line += ' %10.1fKiB peak' % (peak / 1024.0)
+        print(line)
+
+
+def bench_instrumentation():
+    """Compares fromstring() and navigation with and without instrument()."""
+    xml = wide_xml(20000)
+
+    def parse_and_navigate():
+        obj = ezxml.fromstring(xml)
+        for item in obj.Items.Item:
+            item.ISBN
+
+    def instrumented():
+        with ezxml.instrument():
+            parse_and_navigate()
+
+    print('fromstring + navigation, wide (20000 records)')
+    print(format_result('  not instrumented', *measure(parse_and_navigate)))
+    print(format_result('  instrument()', *measure(instrumented)))
+
+
+def bench_projection(count=20000):
+    """Compares fromstring() of a payload-heavy document with include=."""
+    item = '<Item><ISBN>%d</ISBN><Payload>' + ''.join('<Field%d>%d</Field%d>' % (i, i, i) for i in range(20)) + '</Payload></Item>'
+    xml = ('<Response><Items>' + ''.join(item % i for i in range(count)) + '</Items></Response>').encode('utf-8')
+
+    print('fromstring, %d records of 21 fields' % count)
+    for backend in ezxml.available_backends():
+        print(format_result('  %-8s full' % backend, *measure(lambda: ezxml.fromstring(xml, backend=backend))))
+        print(format_result('  %-8s include=' % backend, *measure(
+            lambda: ezxml.fromstring(xml, backend=backend, include=['Items/Item/ISBN']))))
+
+
+def bench_columns(count=100000):
+    """Compares collecting a column by iterating records with to_columns()."""
+    xml = wide_xml(count).encode('utf-8')
+
+    def iterated():
+        return [item.ISBN for item in ezxml.fromstring(xml).Items.Item]
+
+    print('ISBN column, wide (%d records)' % count)
+    print(format_result('  iterate Objectifier', *measure(iterated)))
+    print(format_result('  to_columns()', *measure(lambda: ezxml.to_columns(xml, 'Item', {'ISBN': int}))))
+
+
+def bench_schema(count=20000):
+    """Compares fromstring() and field access with compile_schema() records."""
+    xml = wide_xml(count).encode('utf-8')
+    schema = ezxml.compile_schema(xml)
+
+    def objectified():
+        for item in ezxml.fromstring(xml).Items.Item:
+            item.ISBN, item.Title
+
+    def records():
+        for item in schema.fromstring(xml).Items.Item:
+            item.ISBN, item.Title
+
+    obj = ezxml.fromstring(xml)
+    root = schema.fromstring(xml)
+
+    def access(items):
+        for item in items:
+            item.ISBN, item.Title
+
+    print('parse + field access, wide (%d records)' % count)
+    print(format_result('  fromstring()', *measure(objectified)))
+    print(format_result('  Schema.fromstring()', *measure(records)))
+    print(format_result('  access, Objectifier', *measure(lambda: access(obj.Items.Item))))
+    print(format_result('  access, records', *measure(lambda: access(root.Items.Item))))
+
+
+def bench_budget(count=100000):
+    """Measures the cost of a Budget, and how soon it rejects an oversized document."""
+    xml = wide_xml(count).encode('utf-8')
+    generous = ezxml.Budget(max_depth=100, max_nodes=10 ** 9, max_text=10 ** 12, timeout=3600)
+    tight = ezxml.Budget(max_nodes=1000)
+
+    def rejected():
+        try:
+            ezxml.fromstring(xml, budget=tight)
+        except ezxml.BudgetExceeded:
+            pass
+
+    print('fromstring, wide (%d records)' % count)
+    print(format_result('  no budget', *measure(lambda: ezxml.fromstring(xml))))
+    print(format_result('  within budget', *measure(lambda: ezxml.fromstring(xml, budget=generous))))
+    print(format_result('  max_nodes=1000', *measure(rejected)))
+
+
+def bench_parse_large(count=200000):
+    """Compares parse_file(tag=...) with parse_large() on one large file."""
+    fd, path = tempfile.mkstemp(suffix='.xml')
+    os.write(fd, wide_xml(count).encode('utf-8'))
+    os.close(fd)
+
+    def consume(records):
+        for record in records:
+            pass
+
+    cpus = multiprocessing.cpu_count()
+    try:
+        print('wide (%d records), %.1fMiB file, %d CPUs' % (count, os.path.getsize(path) / 1048576.0, cpus))
+        seconds, _ = measure(lambda: consume(ezxml.parse_file(path, tag='Item')), repeat=1)
+        print('%-40s %10.2fms' % ('  parse_file(tag=...)', seconds * 1000))
+        for workers in sorted(set([1, 2, cpus])):
+            seconds, _ = measure(lambda: consume(ezxml.parse_large(
+                path, 'Item', workers=workers, chunk_size=1024 * 1024)), repeat=1)
+            print('%-40s %10.2fms' % ('  parse_large(workers=%d)' % workers, seconds * 1000))
+    finally:
+        os.remove(path)
+
+
+def run():
+    bench_arrayify_etree()
+    bench_backends()
+    bench_wrapper_caching()
+    bench_type_inference()
+    bench_element_memory()
+    bench_parse_many()
+    bench_async_feed()
+    bench_parse_file()
+    bench_parse_cache()
+    bench_binary()
+    bench_serialize()
+    bench_instrumentation()
+    bench_projection()
+    bench_columns()
+    bench_schema()
+    bench_budget()
+    bench_parse_large()
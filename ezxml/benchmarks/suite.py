@@ -0,0 +1,193 @@
+"""
+Compares ezxml (with each parser backend, eager and lazy) with
+lxml.objectify and plain ElementTree on the test fixtures and on generated
+large, wide and deep documents, measuring for each document:
+
+    parse_seconds         fromstring() (or the equivalent) of the document
+    first_field_seconds   parsing plus getting the first field of the path
+    fields_per_second     getting every field of the path from a parsed tree
+    peak_bytes            the peak memory traced by tracemalloc while parsing
+
+Timings are the best of several runs. tracemalloc only sees the Python
+heap, so peak_bytes leaves out what lxml and ElementTree allocate in C.
+ElementTree fields are the raw text, without type conversion.
+"""
+
+from __future__ import print_function
+
+import platform
+import sys
+import time
+import timeit
+
+import ezxml
+from ezxml import ElementTree
+from ezxml.benchmarks import fixtures, peak_memory
+
+try:
+    import lxml.objectify
+except ImportError:
+    lxml = None
+
+
+def documents():
+    """
+    Returns (name, xml, path) for every benchmarked document, where path
+    leads to the fields that are extracted from it.
+    """
+    return [
+        ('books', fixtures.BOOKS_XML, 'Items/Item/ISBN'),
+        ('people', fixtures.PEOPLE_XML, 'Person/Name'),
+        ('pricing', fixtures.PRICING_XML, 'Items/Item/BiblioId'),
+        ('plist', fixtures.PLIST_XML, 'dict/key'),
+        ('xhtml', fixtures.SAMPLE_XHTML, 'body/div/p'),
+        ('large', fixtures.large_xml(5000).encode('utf-8'), 'Items/Item/Title'),
+        ('wide', fixtures.wide_xml(20000).encode('utf-8'), 'Items/Item/ISBN'),
+        ('deep', fixtures.deep_xml(500).encode('utf-8'), '/'.join(['a'] * 499 + ['b'])),
+    ]
+
+
+def _ezxml_children(node, step):
+    child = getattr(node, step)
+    if child is None:
+        return []
+    if isinstance(child, ezxml.LazyObjectifier):
+        siblings = isinstance(child._node, list)
+    elif isinstance(child, ezxml.Objectifier):
+        siblings = isinstance(child.response_data, list)
+    else:
+        siblings = False
+    return list(child) if siblings else [child]
+
+
+def _lxml_children(node, step):
+    child = getattr(node, step, None)
+    if child is None:
+        return []
+    # Iterating an lxml.objectify element iterates over it and its siblings
+    return list(child)
+
+
+def _etree_children(node, step):
+    return node.findall(step)
+
+
+class Candidate(object):
+    """
+    An objectifier under test: parse(xml) returns its tree, children(node,
+    step) the child nodes named step and value(node) the field value of a
+    leaf node.
+    """
+
+    def __init__(self, name, parse, children, value=None):
+        self.name = name
+        self.parse = parse
+        self.children = children
+        self.value = value
+
+    def iter_fields(self, root, path):
+        steps = path.split('/')
+        stack = [(root, 0)]
+
+        while stack:
+            node, depth = stack.pop()
+            if depth == len(steps):
+                yield node if self.value is None else self.value(node)
+                continue
+            found = self.children(node, steps[depth])
+            found.reverse()
+            stack.extend([(child, depth + 1) for child in found])
+
+    def first_field(self, xml, path):
+        for field in self.iter_fields(self.parse(xml), path):
+            return field
+
+    def fields(self, root, path):
+        return list(self.iter_fields(root, path))
+
+
+def candidates():
+    """
+    Returns the Candidates available in this environment.
+    """
+    result = []
+    for backend in ezxml.available_backends():
+        parse = lambda xml, backend=backend: ezxml.fromstring(xml, backend=backend)
+        result.append(Candidate('ezxml[%s]' % backend, parse, _ezxml_children))
+    result.append(Candidate('ezxml[lazy]', lambda xml: ezxml.fromstring(xml, lazy=True), _ezxml_children))
+    if lxml is not None:
+        result.append(Candidate('lxml.objectify', lxml.objectify.fromstring, _lxml_children,
+                                lambda node: getattr(node, 'pyval', node)))
+    result.append(Candidate('ElementTree', ElementTree.fromstring, _etree_children, lambda node: node.text))
+    return result
+
+
+def best_time(func, repeat, setup=None):
+    """
+    Returns the best time in seconds of one call of func(), running it
+    often enough per measurement to be timed reliably. setup() is called
+    before each measurement and its result passed to func.
+    """
+    def timed(number):
+        args = () if setup is None else (setup(),)
+        start = timeit.default_timer()
+        for i in range(number):
+            func(*args)
+        return timeit.default_timer() - start
+
+    number = 1
+    while timed(number) < 0.005 and number < 100000:
+        number *= 10
+    return min([timed(number) for i in range(repeat)]) / number
+
+
+def run(repeat=5):
+    """
+    Runs every candidate on every document and returns the results as a
+    list of dicts, printing a line per result as it goes.
+    """
+    results = []
+
+    for name, xml, path in documents():
+        print('%s (%d bytes), fields %s' % (name, len(xml), path if len(path) < 30 else path[:27] + '...'))
+
+        for candidate in candidates():
+            parse = lambda: candidate.parse(xml)
+            try:
+                count = len(candidate.fields(parse(), path))
+                result = {
+                    'document': name,
+                    'objectifier': candidate.name,
+                    'bytes': len(xml),
+                    'fields': count,
+                    'parse_seconds': best_time(parse, repeat),
+                    'first_field_seconds': best_time(lambda: candidate.first_field(xml, path), repeat),
+                    'fields_per_second': count / best_time(lambda root: candidate.fields(root, path), repeat, parse),
+                    'peak_bytes': peak_memory(parse),
+                }
+            except (RuntimeError, SyntaxError):
+                # E.g. the recursion limit, or lxml's limit on nesting depth
+                result = {'document': name, 'objectifier': candidate.name, 'bytes': len(xml), 'error': True}
+                print('  %-20s %12s' % (candidate.name, 'failed'))
+            else:
+                print('  %-20s %9.3fms parse %9.3fms first %12.0f fields/s %10s peak' % (
+                    candidate.name, result['parse_seconds'] * 1000, result['first_field_seconds'] * 1000,
+                    result['fields_per_second'],
+                    '-' if result['peak_bytes'] is None else '%.1fKiB' % (result['peak_bytes'] / 1024.0)))
+            results.append(result)
+
+    return results
+
+
+def metadata():
+    """
+    Returns a description of the environment the benchmarks ran in.
+    """
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': sys.version.split()[0],
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'lxml': None if lxml is None else lxml.etree.__version__,
+        'backends': ezxml.available_backends(),
+    }
@@ -1,7 +1,16 @@
 from __future__ import with_statement
 
 import contextlib
+import datetime
+import io
+import json
+import os
+import pickle
+import re
+import shutil
 import sys
+import tempfile
+from functools import partial
 
 try:
     import unittest2 as unittest
@@ -20,6 +29,19 @@ except ImportError:
 
 from parameterizedtestcase import ParameterizedTestCase, ParameterizedTestMixin
 
+
+def wide_xml(count):
+    """A document with count repeated records under a single parent."""
+    items = ''.join(['<Item><ISBN>%d</ISBN><Title>Book %d</Title></Item>' % (i, i)
+                     for i in range(count)])
+    return ('<Books><Items>%s</Items></Books>' % items).encode('utf-8')
+
+
+def deep_xml(depth):
+    """A document nested depth levels deep, plus its leaf."""
+    return ('<a>' * depth + '<b>1</b>' + '</a>' * depth).encode('utf-8')
+
+
 def for_each_objectifier(test_method):
     """A test method decorator for running the test with each supported objectifier"""
 
@@ -47,8 +69,6 @@ class EZXMLTests(ParameterizedTestCase):
         if cm:
             self.assertEqual(str(cm.exception), "attribute %r of %r objects is not writable" % (attr_name, class_name))
 
-class FromStringTests(EZXMLTests):
-
     def get_books_xml(self):
         return """
             <?xml version="1.0" encoding="utf-8"?>
@@ -139,6 +159,9 @@ class FromStringTests(EZXMLTests):
             </html>
             """.strip().encode('utf-8')
 
+
+class FromStringTests(EZXMLTests):
+
     @for_each_objectifier
     def test_books_xml(self, objectifier):
         obj = objectifier.fromstring(self.get_books_xml())
@@ -394,3 +417,1493 @@ class StringElementTests(EZXMLTests):
 
         with self.assertRaisesAttributeNotWritableError(attr_name='text', class_name='StringElement'):
             obj.text = 'foobar'
+
+
+class IterParseTests(EZXMLTests):
+
+    def get_large_books_xml(self, count):
+        items = ''.join(['<Item><ISBN>%d</ISBN><Title>Book %d</Title></Item>' % (i, i) for i in range(count)])
+        return ('<Books><ResponseHeader/><Items>%s</Items></Books>' % items).encode('utf-8')
+
+    def test_books_xml(self):
+        records = list(ezxml.iterparse(io.BytesIO(self.get_books_xml()), tag='Item'))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0].ISBN, int('0321558235'))
+        self.assertEqual(records[1].ISBN, int('9780321558237'))
+
+    def test_people_xml(self):
+        records = ezxml.iterparse(io.BytesIO(self.get_people_xml()), tag='Person')
+        self.assertEqual([(p.Name, p.Age) for p in records], [('Marc', 37), ('Zach', 3)])
+
+    def test_leaf_records(self):
+        records = ezxml.iterparse(io.BytesIO(self.get_plist_xml()), tag='key')
+        self.assertEqual(
+            list(records),
+            ['BuildVersion', 'CFBundleShortVersionString', 'CFBundleVersion', 'ProjectName', 'SourceVersion'])
+
+    def test_nested_records(self):
+        xml = b'<Items><Item><ISBN>1</ISBN><Item><ISBN>2</ISBN></Item></Item><Item><ISBN>3</ISBN></Item></Items>'
+        records = list(ezxml.iterparse(io.BytesIO(xml), tag='Item'))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0].ISBN, 1)
+        self.assertEqual(records[0].Item.ISBN, 2)
+        self.assertEqual(records[1].ISBN, 3)
+
+    def test_first_record_before_end_of_input(self):
+        source = io.BytesIO(self.get_large_books_xml(10000))
+        records = ezxml.iterparse(source, tag='Item')
+
+        first = next(records)
+        self.assertEqual(first.ISBN, 0)
+        self.assertTrue(source.tell() < len(source.getvalue()))
+        self.assertEqual(len(list(records)), 9999)
+
+
+class LazyFromStringTests(EZXMLTests):
+
+    def test_books_xml(self):
+        obj = ezxml.fromstring(self.get_books_xml(), lazy=True)
+        self.assertEqual(obj.Items.Item[0].ISBN, int('0321558235'))
+        self.assertEqual(obj.Items.Item[1].ISBN, int('9780321558237'))
+        self.assertEqual(obj.Missing, None)
+
+    def test_people_xml(self):
+        obj = ezxml.fromstring(self.get_people_xml(), lazy=True)
+        self.assertEqual([(p.Name, p.Age) for p in obj.Person], [('Marc', 37), ('Zach', 3)])
+        self.assertEqual(len(obj.Person), 2)
+
+    def test_sample_xhtml(self):
+        obj = ezxml.fromstring(self.get_sample_xhtml(), lazy=True)
+        self.assertEqual(obj.head.title, 'XHTML 1.0: The Extensible HyperText Markup Language')
+        self.assertEqual(obj.body.div[0].a, 'table of contents')
+        self.assertEqual(obj.body.div[1].p[1], 'Some more stuff')
+        self.assertEqual(obj.body.div[1].p[2], 'And yet more stuff')
+
+    def test_children_are_memoized(self):
+        obj = ezxml.fromstring(self.get_books_xml(), lazy=True)
+        self.assertTrue(obj.Items is obj.Items)
+        self.assertTrue(obj.Items.Item[0] is obj.Items.Item[0])
+
+    def test_slices(self):
+        eager = ezxml.fromstring(self.get_people_xml())
+        lazy = ezxml.fromstring(self.get_people_xml(), lazy=True)
+        self.assertEqual([p.Name for p in lazy.Person[1:]], ['Zach'])
+        for k in (slice(5, None), slice(1, 1)):
+            self.assertEqual(list(lazy.Person[k]), list(eager.Person[k]))
+            self.assertEqual(len(lazy.Person[k]), 0)
+            self.assertEqual(lazy.Person[k].response_data, [])
+
+    def test_matches_eager_objectifier(self):
+        for xml in (self.get_books_xml(), self.get_pricing_xml(), self.get_plist_xml()):
+            eager = ezxml.fromstring(xml)
+            lazy = ezxml.fromstring(xml, lazy=True)
+            self.assertEqual(lazy.response_data, eager.response_data)
+            self.assertEqual(repr(lazy), repr(eager))
+            self.assertEqual(len(lazy), len(eager))
+            self.assertEqual(sorted(dir(lazy)), sorted(dir(eager)))
+
+
+class ArrayifyEtreeTests(EZXMLTests):
+
+    def test_repeated_tags_fold_into_lists(self):
+        etree = ezxml.ElementTree.fromstring(self.get_pricing_xml())
+        self.assertEqual(
+            ezxml.arrayify_etree(etree),
+            {'ProductPricing': {'ResponseHeader': None,
+                                'Items': {'Item': [{'BiblioId': 15536985}, {'BiblioId': 16432444}]}}})
+
+    def test_leaf_root(self):
+        etree = ezxml.ElementTree.fromstring('<ISBN>0321558235</ISBN>')
+        self.assertEqual(ezxml.arrayify_etree(etree), {'ISBN': 321558235})
+
+    def test_deeper_than_recursion_limit(self):
+        depth = sys.getrecursionlimit() * 2
+        etree = ezxml.ElementTree.fromstring('<a>' * depth + '<b>1</b>' + '</a>' * depth)
+
+        value = ezxml.arrayify_etree(etree)['a']
+        for i in range(depth - 1):
+            value = value['a']
+        self.assertEqual(value, {'b': 1})
+
+
+class BackendTests(EZXMLTests):
+
+    def get_fixtures(self):
+        return [self.get_books_xml(), self.get_people_xml(), self.get_pricing_xml(),
+                self.get_plist_xml(), self.get_sample_xhtml(), deep_xml(200)]
+
+    def tearDown(self):
+        ezxml.set_default_backend('etree')
+
+    def test_etree_is_always_available(self):
+        self.assertTrue('etree' in ezxml.available_backends())
+
+    def test_backend_parity(self):
+        for xml in self.get_fixtures():
+            expected = ezxml.arrayify_xml(xml, backend='etree')
+            for backend in ezxml.available_backends():
+                self.assertEqual(ezxml.arrayify_xml(xml, backend=backend), expected)
+                self.assertEqual(
+                    repr(ezxml.fromstring(xml, backend=backend)),
+                    repr(ezxml.fromstring(xml, backend='etree')))
+
+    def test_depth_limit(self):
+        backends = ezxml.available_backends()
+        if 'lxml' in backends:
+            ezxml.register_backend('lxml-huge', ezxml.LxmlBackend(huge_tree=True))
+            self.addCleanup(ezxml._backends.pop, 'lxml-huge')
+            backends.append('lxml-huge')
+
+        # Too deep to compare whole, so only the innermost leaf is checked
+        for levels in [256, 257, 2048, 2049, 3000]:
+            xml = deep_xml(levels - 1)
+            path = '/'.join(['a'] * (levels - 2) + ['b'])
+            for backend in backends:
+                max_depth = ezxml.get_backend(backend).max_depth
+                if max_depth is not None and levels > max_depth:
+                    self.assertRaises(SyntaxError, ezxml.fromstring, xml, backend=backend)
+                else:
+                    self.assertEqual(ezxml.fromstring(xml, backend=backend).select(path), [1])
+
+    def test_books_xml(self):
+        for backend in ezxml.available_backends():
+            obj = ezxml.fromstring(self.get_books_xml(), backend=backend)
+            self.assertEqual(obj.Items.Item[0].ISBN, int('0321558235'))
+            self.assertEqual(obj.Items.Item[1].ISBN, int('9780321558237'))
+
+    def test_set_default_backend(self):
+        calls = []
+
+        class RecordingBackend(ezxml.ElementTreeBackend):
+            def fromstring(self, xml_str):
+                calls.append(xml_str)
+                return super(RecordingBackend, self).fromstring(xml_str)
+
+        ezxml.register_backend('recording', RecordingBackend())
+        try:
+            ezxml.set_default_backend('recording')
+            obj = ezxml.fromstring(self.get_people_xml())
+            self.assertEqual(obj.Person[1].Name, 'Zach')
+            self.assertEqual(calls, [self.get_people_xml()])
+        finally:
+            ezxml._backends.pop('recording')
+
+    def test_fromstring_only_backend(self):
+        class TreeBackend(ezxml.Backend):
+            def fromstring(self, xml_str):
+                return ezxml.ElementTree.fromstring(xml_str)
+
+        ezxml.register_backend('tree', TreeBackend())
+        self.addCleanup(ezxml._backends.pop, 'tree')
+
+        for xml in self.get_fixtures() + [b'<a>x<!-- c -->y<b>1</b>z<?pi?>w</a>']:
+            self.assertEqual(ezxml.arrayify_xml(xml, backend='tree', include=['Items', 'dict', 'b']),
+                             ezxml.arrayify_xml(xml, backend='etree', include=['Items', 'dict', 'b']))
+            self.assertEqual(ezxml.arrayify_xml(xml, backend='tree', budget=ezxml.Budget(max_nodes=1000)),
+                             ezxml.arrayify_xml(xml, backend='etree'))
+        self.assertRaises(ezxml.BudgetExceeded, ezxml.fromstring, self.get_books_xml(), backend='tree',
+                          budget=ezxml.Budget(max_nodes=3))
+        schema = ezxml.compile_schema(self.get_people_xml())
+        self.assertEqual(schema.fromstring(self.get_people_xml(), backend='tree').response_data,
+                         ezxml.fromstring(self.get_people_xml()).response_data)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            ezxml.fromstring(self.get_books_xml(), backend='nonexistent')
+        with self.assertRaises(ValueError):
+            ezxml.set_default_backend('nonexistent')
+
+    def test_malformed_xml(self):
+        for backend in ezxml.available_backends():
+            with self.assertRaises(SyntaxError):
+                ezxml.fromstring(b'<Books><Items></Books>', backend=backend)
+
+    def test_expat_namespaced_tags(self):
+        xml = b'<feed xmlns="http://www.w3.org/2005/Atom"><title>Example</title></feed>'
+        self.assertEqual(ezxml.arrayify_xml(xml, backend='expat'), ezxml.arrayify_xml(xml, backend='etree'))
+
+
+class DictTreeBuilderTests(EZXMLTests):
+
+    def test_as_elementtree_parser_target(self):
+        parser = ezxml.ElementTree.XMLParser(target=ezxml.DictTreeBuilder())
+        parser.feed(self.get_people_xml())
+        self.assertEqual(
+            parser.close(),
+            {'People': {'Person': [{'Name': 'Marc', 'Age': 37}, {'Name': 'Zach', 'Age': 3}]}})
+
+    def test_ignores_text_after_first_child(self):
+        builder = ezxml.DictTreeBuilder()
+        builder.start('Items', {})
+        builder.data('\n  ')
+        builder.start('Item', {})
+        builder.data('1')
+        builder.end('Item')
+        builder.data('\n  ')
+        builder.start('Item', {})
+        builder.end('Item')
+        builder.data('\n')
+        builder.end('Items')
+        self.assertEqual(builder.close(), {'Items': {'Item': [1, None]}})
+
+
+class ObjectifierFormatTests(EZXMLTests):
+
+    def test_sniff_format(self):
+        self.assertEqual(ezxml.sniff_format(self.get_books_xml()), 'xml')
+        self.assertEqual(ezxml.sniff_format(u'\ufeff  <a/>'), 'xml')
+        self.assertEqual(ezxml.sniff_format(b'\xef\xbb\xbf<a/>'), 'xml')
+        self.assertEqual(ezxml.sniff_format(b'\n {"a": 1}'), 'json')
+        self.assertEqual(ezxml.sniff_format(u'[1, 2]'), 'json')
+        self.assertEqual(ezxml.sniff_format(u'42'), None)
+        self.assertEqual(ezxml.sniff_format(u'   '), None)
+        self.assertEqual(ezxml.sniff_format(b''), None)
+
+    def test_xml(self):
+        obj = ezxml.Objectifier(self.get_books_xml())
+        self.assertEqual(obj.Items.Item[0].ISBN, int('0321558235'))
+        self.assertEqual(obj.response_data, ezxml.fromstring(self.get_books_xml()).response_data)
+
+    def test_json(self):
+        obj = ezxml.Objectifier('{"Items": {"Item": [{"ISBN": 321558235}, {"ISBN": 9780321558237}]}}')
+        self.assertEqual(obj.Items.Item[1].ISBN, 9780321558237)
+
+    def test_json_scalar(self):
+        self.assertEqual(ezxml.Objectifier('42').response_data, 42)
+
+    def test_unparseable_data_is_wrapped_as_is(self):
+        self.assertEqual(ezxml.Objectifier('<Books><Items></Books>').response_data, '<Books><Items></Books>')
+        self.assertEqual(ezxml.Objectifier('{"a": ').response_data, '{"a": ')
+        self.assertEqual(ezxml.Objectifier('plain text').response_data, 'plain text')
+        self.assertEqual(ezxml.Objectifier({'a': 1}).response_data, {'a': 1})
+
+    def test_explicit_format(self):
+        self.assertEqual(ezxml.Objectifier(' <a><b>1</b></a>', format='xml').response_data, {'b': 1})
+        self.assertEqual(ezxml.Objectifier('"text"', format='json').response_data, 'text')
+
+        with self.assertRaises(SyntaxError):
+            ezxml.Objectifier('{"a": 1}', format='xml')
+        with self.assertRaises(ValueError):
+            ezxml.Objectifier('<a/>', format='json')
+        with self.assertRaises(ValueError):
+            ezxml.Objectifier('<a/>', format='yaml')
+
+
+class SelectTests(EZXMLTests):
+
+    def test_select(self):
+        obj = ezxml.fromstring(self.get_books_xml())
+        self.assertEqual(obj.select('Items/Item/ISBN'), [int('0321558235'), int('9780321558237')])
+        self.assertEqual(obj.select('/Items/Item/ISBN/'), [int('0321558235'), int('9780321558237')])
+        self.assertEqual(obj.select('Items/Item/Title'), [])
+        self.assertEqual(obj.select('Missing/Item'), [])
+
+    def test_select_index(self):
+        obj = ezxml.fromstring(self.get_sample_xhtml())
+        self.assertEqual(obj.select('body/div[1]/p[1]'), ['Some more stuff'])
+        self.assertEqual(obj.select('body/div[-1]/p[-1]'), ['And yet more stuff'])
+        self.assertEqual(obj.select('body/div[5]/p'), [])
+        self.assertEqual(obj.select('head/title[0]'), ['XHTML 1.0: The Extensible HyperText Markup Language'])
+
+    def test_select_wildcard(self):
+        obj = ezxml.fromstring(self.get_people_xml())
+        # The children of each person come in the order of its dict
+        people = obj.select('Person/*')
+        self.assertEqual(sorted(people[:2], key=repr), sorted(['Marc', 37], key=repr))
+        self.assertEqual(sorted(people[2:], key=repr), sorted(['Zach', 3], key=repr))
+        self.assertEqual(obj.select('*[1]/Name'), ['Zach'])
+
+    def test_select_with_attributes(self):
+        obj = ezxml.fromstring(b'<a k="v"><b>1</b><c n="2">x</c></a>', attributes=True)
+        self.assertEqual(sorted(obj.select('*'), key=repr), sorted([1, {'@': {'n': '2'}, '#text': 'x'}], key=repr))
+        self.assertEqual(obj.select('c/#text'), ['x'])
+        self.assertEqual(obj.select('c/@'), [{'n': '2'}])
+        self.assertEqual(obj.select('c/*'), [])
+
+    def test_select_from_list(self):
+        obj = ezxml.fromstring(self.get_people_xml())
+        self.assertEqual(obj.Person.select('Age'), [37, 3])
+
+    def test_select_one(self):
+        obj = ezxml.fromstring(self.get_pricing_xml())
+        self.assertEqual(obj.select_one('Items/Item/BiblioId'), 15536985)
+        self.assertEqual(obj.select_one('Items/Item[1]/BiblioId'), 16432444)
+        self.assertEqual(obj.select_one('Items/Item/ISBN'), None)
+        self.assertEqual(obj.select_one('Items/Item/ISBN', 0), 0)
+
+    def test_invalid_path(self):
+        obj = ezxml.fromstring(self.get_books_xml())
+        for path in ['', 'Items//Item', 'Items/Item[x]', 'Items/[0]']:
+            with self.assertRaises(ValueError):
+                obj.select(path)
+
+    def test_compiled_paths_are_cached(self):
+        steps = ezxml.compile_path('Items/Item[0]/*')
+        self.assertEqual(steps, (('Items', None), ('Item', 0), (None, None)))
+        self.assertTrue(ezxml.compile_path('Items/Item[0]/*') is steps)
+
+        for i in range(ezxml.PATH_CACHE_SIZE):
+            ezxml.compile_path('Item%d' % i)
+        self.assertEqual(len(ezxml._compiled_paths), ezxml.PATH_CACHE_SIZE)
+        self.assertFalse('Items/Item[0]/*' in ezxml._compiled_paths)
+
+
+class WrapperCachingTests(EZXMLTests):
+
+    def test_navigation_returns_same_wrapper(self):
+        obj = ezxml.fromstring(self.get_books_xml())
+        self.assertTrue(obj.Items is obj.Items)
+        self.assertTrue(obj['Items'] is obj.Items)
+        self.assertTrue(obj.Items.Item[0] is obj.Items.Item[0])
+        self.assertTrue(list(obj.Items.Item)[1] is obj.Items.Item[1])
+        self.assertTrue(dict(list(obj))['Items'] is obj.Items)
+
+    def test_replaced_child_is_rewrapped(self):
+        obj = ezxml.fromstring(self.get_books_xml())
+        items = obj.Items
+        obj.response_data['Items'] = {'Item': []}
+        self.assertFalse(obj.Items is items)
+        self.assertEqual(len(obj.Items.Item), 0)
+
+    def test_slices(self):
+        obj = ezxml.fromstring(self.get_people_xml())
+        self.assertEqual([p.Name for p in obj.Person[1:]], ['Zach'])
+
+    def test_iterating_scalar(self):
+        self.assertEqual(list(ezxml.Objectifier(42)), [])
+
+
+class CompactElementTests(EZXMLTests):
+
+    def test_no_instance_dict(self):
+        for cls in [ezxml.ObjectifiedElement, ezxml.ObjectifiedDataElement, ezxml.StringElement]:
+            obj = cls()
+            self.assertFalse(hasattr(obj, '__dict__'))
+            with self.assertRaises(AttributeError):
+                obj.foo = 'bar'
+
+    def test_children(self):
+        parent = ezxml.ObjectifiedElement()
+        self.assertEqual(parent.getchildren(), [])
+        self.assertEqual(parent.countchildren(), 0)
+
+        child = ezxml.StringElement('MyValue')
+        parent.append(child)
+        self.assertEqual(parent.getchildren(), [child])
+        self.assertEqual(parent.countchildren(), 1)
+        self.assertTrue(child.getparent() is parent)
+
+
+class TypeInferenceTests(EZXMLTests):
+
+    def test_default_types(self):
+        coerce = ezxml.default_types.coerce
+        self.assertEqual(coerce('0321558235'), 321558235)
+        self.assertEqual(coerce(' -37 '), -37)
+        self.assertEqual(coerce('1.1'), 1.1)
+        self.assertEqual(coerce('-.5e3'), -500.0)
+        self.assertEqual(coerce('true'), True)
+        self.assertEqual(coerce('false'), False)
+        self.assertEqual(coerce('True'), 'True')
+        self.assertEqual(coerce('1_000'), '1_000')
+        self.assertEqual(coerce('1.2.3'), '1.2.3')
+        self.assertEqual(coerce('AutomatorActions'), 'AutomatorActions')
+        self.assertEqual(coerce(''), '')
+        self.assertEqual(coerce(None), None)
+
+    def test_plist_xml(self):
+        obj = ezxml.fromstring(self.get_plist_xml())
+        self.assertEqual(list(obj.dict.string), [1, 1.1, 1.1, 'AutomatorActions', 270001000000000])
+
+    def test_tag_hints(self):
+        types = ezxml.default_types.copy()
+        types.hint('ISBN', 'str')
+        types.hint('Age', 'float')
+
+        for backend in ezxml.available_backends():
+            obj = ezxml.fromstring(self.get_books_xml(), backend=backend, types=types)
+            self.assertEqual(obj.select('Items/Item/ISBN'), ['0321558235', '9780321558237'])
+
+        obj = ezxml.fromstring(self.get_people_xml(), lazy=True, types=types)
+        self.assertEqual(obj.Person[0].Age, 37.0)
+        self.assertTrue(isinstance(obj.Person[0].Age, float))
+
+        # The default table is unaffected
+        obj = ezxml.fromstring(self.get_books_xml())
+        self.assertEqual(obj.Items.Item[0].ISBN, 321558235)
+
+    def test_register(self):
+        calls = []
+
+        def parse_hex(text):
+            calls.append(text)
+            return int(text, 16)
+
+        types = ezxml.TypeTable()
+        types.register('hex', parse_hex, re.compile('0x[0-9a-f]+$').match)
+
+        obj = ezxml.fromstring(b'<a><b>0xff</b><c>10</c><d>0xzz</d></a>', types=types)
+        self.assertEqual(obj.response_data, {'b': 255, 'c': '10', 'd': '0xzz'})
+        self.assertEqual(calls, ['0xff'])
+
+        types.unregister('hex')
+        self.assertEqual(types.coerce('0xff'), '0xff')
+
+    def test_element(self):
+        types = ezxml.default_types
+
+        for text, cls, pyval in [('42', ezxml.IntElement, 42),
+                                 ('4.2', ezxml.FloatElement, 4.2),
+                                 ('true', ezxml.BoolElement, True),
+                                 ('MyValue', ezxml.StringElement, 'MyValue'),
+                                 (None, ezxml.NoneElement, None)]:
+            element = types.element(text, tag='Value')
+            self.assertTrue(type(element) is cls)
+            self.assertEqual(element.tag, 'Value')
+            self.assertEqual(element.text, text)
+            if cls is not ezxml.StringElement:
+                self.assertEqual(element.pyval, pyval)
+                self.assertEqual(repr(element), repr(pyval))
+
+        self.assertTrue(type(ezxml.default_types.element('42', tag='ISBN')) is ezxml.IntElement)
+        types = ezxml.default_types.copy()
+        types.hint('ISBN', 'str')
+        self.assertTrue(type(types.element('42', tag='ISBN')) is ezxml.StringElement)
+
+
+class AttributeTests(EZXMLTests):
+
+    def get_catalog_xml(self):
+        return b"""<Catalog><Book id="b1" lang="en"><Title>Biology</Title></Book><Book id="b2"><Title>Math</Title></Book><Note id="n1">Sold out</Note></Catalog>"""
+
+    def test_attributes_dropped_by_default(self):
+        obj = ezxml.fromstring(self.get_sample_xhtml())
+        self.assertEqual(obj.body.div[0].get('class'), None)
+        self.assertEqual(obj.body.div[0].attrib, {})
+        self.assertFalse(ezxml.ATTRIBUTES_KEY in obj.body.div[0])
+
+    def test_sample_xhtml(self):
+        for backend in ezxml.available_backends():
+            obj = ezxml.fromstring(self.get_sample_xhtml(), backend=backend, attributes=True)
+            self.assertEqual(obj.body.div[0].get('class'), 'navbar')
+            self.assertEqual(obj.body.div[1].get('class'), 'head')
+            self.assertEqual(obj.body.div[1].get('id', 'none'), 'none')
+            self.assertEqual(obj.body.div[0].a.get('href'), '#toc')
+            self.assertEqual(obj.body.div[0].a[ezxml.TEXT_KEY], 'table of contents')
+            self.assertEqual(obj.body.div[1].p[0].a.img.attrib, {'class': 'head', 'src': 'w3c_home.gif', 'alt': 'W3C'})
+            self.assertEqual(obj.get('lang'), 'en')
+
+            # Elements without attributes are unchanged
+            self.assertEqual(obj.body.div[1].p[1], 'Some more stuff')
+            self.assertEqual(obj.head.title, 'XHTML 1.0: The Extensible HyperText Markup Language')
+
+    def test_backend_parity(self):
+        expected = ezxml.arrayify_xml(self.get_sample_xhtml(), attributes=True)
+        for backend in ezxml.available_backends():
+            self.assertEqual(ezxml.arrayify_xml(self.get_sample_xhtml(), backend=backend, attributes=True), expected)
+            self.assertEqual(
+                repr(ezxml.fromstring(self.get_sample_xhtml(), backend=backend, attributes=True).body),
+                repr(ezxml.fromstring(self.get_sample_xhtml(), attributes=True).body))
+
+    def test_index_by(self):
+        for backend in ezxml.available_backends():
+            obj = ezxml.fromstring(self.get_catalog_xml(), backend=backend, index_by='id')
+            self.assertEqual(obj.lookup('b2').Title, 'Math')
+            self.assertTrue(obj.lookup('b2').response_data is obj.Book[1].response_data)
+            self.assertEqual(obj.lookup('n1'), 'Sold out')
+            self.assertEqual(obj.lookup('missing'), None)
+
+    def test_lookup_without_index(self):
+        obj = ezxml.fromstring(self.get_catalog_xml())
+        self.assertEqual(obj.lookup('b1'), None)
+
+    def test_lazy(self):
+        obj = ezxml.fromstring(self.get_catalog_xml(), lazy=True, index_by='id')
+        self.assertEqual(obj.Book[0].get('lang'), 'en')
+        self.assertEqual(obj.Book[0].attrib, {'id': 'b1', 'lang': 'en'})
+        self.assertEqual(obj.lookup('b1').Title, 'Biology')
+        self.assertTrue(obj.lookup('b1') is obj.lookup('b1'))
+        self.assertEqual(obj.lookup('n1'), 'Sold out')
+
+        eager = ezxml.fromstring(self.get_catalog_xml(), attributes=True)
+        lazy = ezxml.fromstring(self.get_catalog_xml(), lazy=True, attributes=True)
+        self.assertEqual(lazy.response_data, eager.response_data)
+
+    def test_iterparse(self):
+        records = list(ezxml.iterparse(io.BytesIO(self.get_catalog_xml()), tag='Book', attributes=True))
+        self.assertEqual([r.get('id') for r in records], ['b1', 'b2'])
+
+
+class NamespaceTests(EZXMLTests):
+
+    def get_soap_xml(self):
+        return b"""<?xml version="1.0" encoding="utf-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/" xmlns:x="urn:example:books">
+  <soap:Header/>
+  <soap:Body>
+    <x:Books>
+      <x:Item x:id="b1"><x:ISBN>0321558235</x:ISBN></x:Item>
+      <x:Item x:id="b2"><x:ISBN>9780321558237</x:ISBN></x:Item>
+      <Note>Unqualified</Note>
+    </x:Books>
+  </soap:Body>
+</soap:Envelope>"""
+
+    def get_nsmap(self):
+        return {'soap': 'http://schemas.xmlsoap.org/soap/envelope/', '': 'urn:example:books'}
+
+    def test_clark_notation_by_default(self):
+        obj = ezxml.fromstring(self.get_soap_xml())
+        self.assertEqual(dir(obj), ['{http://schemas.xmlsoap.org/soap/envelope/}Body',
+                                    '{http://schemas.xmlsoap.org/soap/envelope/}Header'])
+
+    def test_nsmap(self):
+        for backend in ezxml.available_backends():
+            obj = ezxml.fromstring(self.get_soap_xml(), backend=backend, nsmap=self.get_nsmap(), attributes=True)
+            self.assertEqual(obj.soap_Header, None)
+            self.assertEqual(obj.soap_Body.Books.Item[1].ISBN, int('9780321558237'))
+            self.assertEqual(obj.soap_Body.Books.Item[0].get('id'), 'b1')
+            self.assertEqual(obj.soap_Body.Books.Note, 'Unqualified')
+
+    def test_wildcard(self):
+        obj = ezxml.fromstring(self.get_soap_xml(), nsmap={'': '*'})
+        self.assertEqual(obj.select('Body/Books/Item/ISBN'), [int('0321558235'), int('9780321558237')])
+
+        obj = ezxml.fromstring(self.get_soap_xml(), nsmap={'s': 'http://schemas.xmlsoap.org/soap/envelope/', 'ns': '*'})
+        self.assertEqual(obj.select('s_Body/ns_Books/ns_Item/ns_ISBN'), [int('0321558235'), int('9780321558237')])
+
+    def test_unmapped_namespaces_are_kept(self):
+        obj = ezxml.fromstring(self.get_soap_xml(), nsmap={'soap': 'http://schemas.xmlsoap.org/soap/envelope/'})
+        self.assertEqual(dir(obj.soap_Body), ['{urn:example:books}Books'])
+
+    def test_tags_are_shared(self):
+        for backend in ezxml.available_backends():
+            data = ezxml.arrayify_xml(self.get_soap_xml(), backend=backend, nsmap=self.get_nsmap())
+            items = data['soap_Envelope']['soap_Body']['Books']['Item']
+            self.assertTrue(list(items[0].keys())[0] is list(items[1].keys())[0])
+
+    def test_lazy(self):
+        obj = ezxml.fromstring(self.get_soap_xml(), lazy=True, nsmap=self.get_nsmap())
+        self.assertEqual(obj.soap_Body.Books.Item[0].ISBN, int('0321558235'))
+        self.assertEqual(obj.soap_Body.Books.Item[1].get('id'), 'b2')
+        eager = ezxml.fromstring(self.get_soap_xml(), nsmap=self.get_nsmap())
+        self.assertEqual(obj.response_data, eager.response_data)
+
+    def test_iterparse(self):
+        records = ezxml.iterparse(io.BytesIO(self.get_soap_xml()), tag='Item', nsmap=self.get_nsmap())
+        self.assertEqual([r.ISBN for r in records], [int('0321558235'), int('9780321558237')])
+
+
+class ParseManyTests(EZXMLTests):
+
+    def get_documents(self):
+        return [self.get_books_xml(), self.get_people_xml(), self.get_pricing_xml()] * 4
+
+    @ParameterizedTestCase.parameterize(
+        ('workers',), [(1,), (2,)])
+    def test_ordered(self, workers):
+        documents = self.get_documents()
+        results = list(ezxml.parse_many(documents, workers=workers, chunksize=2))
+        self.assertEqual([obj.response_data for obj in results],
+                         [ezxml.fromstring(xml).response_data for xml in documents])
+        self.assertTrue(isinstance(results[0], ezxml.Objectifier))
+
+    def test_unordered(self):
+        documents = self.get_documents()
+        results = dict(ezxml.parse_many(documents, workers=2, chunksize=1, ordered=False))
+        self.assertEqual(sorted(results), list(range(len(documents))))
+        for number, obj in results.items():
+            self.assertEqual(obj.response_data, ezxml.fromstring(documents[number]).response_data)
+
+    def test_options(self):
+        results = list(ezxml.parse_many([self.get_books_xml()], workers=2, attributes=True, backend='expat'))
+        expected = ezxml.fromstring(self.get_books_xml(), attributes=True)
+        self.assertEqual(results[0].response_data, expected.response_data)
+
+    @ParameterizedTestCase.parameterize(
+        ('workers',), [(1,), (2,)])
+    def test_malformed(self, workers):
+        results = ezxml.parse_many([self.get_books_xml(), b'<Books><Item></Books>'], workers=workers)
+        self.assertTrue(next(results).Items.Item)
+        try:
+            next(results)
+        except ezxml.ElementTree.ParseError as e:
+            self.assertEqual(e.position, (1, 15))
+        else:
+            self.fail("ParseError not raised")
+
+
+@unittest.skipIf(ezxml.asyncio is None, "requires asyncio")
+class AsyncFeedParserTests(EZXMLTests):
+
+    def setUp(self):
+        self.loop = ezxml.asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def read_all(self, parser):
+        records = []
+        while True:
+            try:
+                records.append(self.loop.run_until_complete(parser.__anext__()))
+            except StopAsyncIteration:
+                return records
+
+    def feed_in_chunks(self, parser, data, size):
+        for i in range(0, len(data), size):
+            parser.feed(data[i:i + size])
+        parser.close()
+
+    @ParameterizedTestCase.parameterize(
+        ('size',), [(1,), (7,), (100000,)])
+    def test_records(self, size):
+        parser = ezxml.AsyncFeedParser('Item', loop=self.loop)
+        self.feed_in_chunks(parser, self.get_books_xml(), size)
+        isbns = [item.ISBN for item in self.read_all(parser)]
+        self.assertEqual(isbns, [int(x) for x in re.findall(b'<ISBN>(\\d+)</ISBN>', self.get_books_xml())])
+
+    def test_waits_for_records(self):
+        parser = ezxml.AsyncFeedParser('Item', loop=self.loop)
+        data = self.get_books_xml()
+        pending = parser.__anext__()
+        self.assertFalse(pending.done())
+
+        middle = data.index(b'</Item>') + len(b'</Item>')
+        parser.feed(data[:middle])
+        self.assertTrue(pending.done())
+        self.assertEqual(pending.result().ISBN, int('0321558235'))
+
+        parser.feed(data[middle:])
+        parser.close()
+        self.assertEqual([item.ISBN for item in self.read_all(parser)], [int('9780321558237')])
+
+    def test_running_loop(self):
+        parser = ezxml.AsyncFeedParser('Item')
+        self.feed_in_chunks(parser, self.get_books_xml(), 16)
+        self.assertEqual(parser.pending, 2)
+
+        # Called from the running loop, as from a coroutine
+        first = self.loop.create_future()
+        self.loop.call_soon(lambda: parser.__anext__().add_done_callback(lambda f: first.set_result(f.result())))
+        self.assertEqual(self.loop.run_until_complete(first).ISBN, int('0321558235'))
+        self.assertTrue(parser._loop is self.loop)
+        self.assertEqual(parser.pending, 1)
+
+    def test_executor(self):
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            parser = ezxml.AsyncFeedParser('Item', executor=executor, loop=self.loop)
+            self.feed_in_chunks(parser, self.get_books_xml(), 16)
+            records = self.read_all(parser)
+        expected = list(ezxml.iterparse(io.BytesIO(self.get_books_xml()), 'Item'))
+        self.assertEqual([r.response_data for r in records], [r.response_data for r in expected])
+
+    def test_cancelled_while_converting(self):
+        import concurrent.futures
+
+        class ManualExecutor(concurrent.futures.Executor):
+            def __init__(self):
+                self.jobs = []
+
+            def submit(self, func, *args, **kwargs):
+                future = concurrent.futures.Future()
+                self.jobs.append((future, partial(func, *args, **kwargs)))
+                return future
+
+        executor = ManualExecutor()
+        parser = ezxml.AsyncFeedParser('Item', executor=executor, loop=self.loop)
+        self.feed_in_chunks(parser, self.get_books_xml(), 100000)
+        self.assertRaises(ezxml.asyncio.TimeoutError, self.loop.run_until_complete,
+                          ezxml.asyncio.wait_for(parser.__anext__(), 0.01))
+
+        for future, job in executor.jobs:
+            future.set_result(job())
+        self.assertEqual([item.ISBN for item in self.read_all(parser)], [int('0321558235'), int('9780321558237')])
+
+    def test_malformed(self):
+        parser = ezxml.AsyncFeedParser('Item', loop=self.loop)
+        data = self.get_books_xml()
+        middle = data.index(b'</Item>') + len(b'</Item>')
+        self.assertRaises(SyntaxError, parser.feed, data[:middle] + b'</Books>')
+        self.assertEqual(self.loop.run_until_complete(parser.__anext__()).ISBN, int('0321558235'))
+        self.assertRaises(SyntaxError, self.loop.run_until_complete, parser.__anext__())
+
+
+class ParseFileTests(EZXMLTests):
+
+    def write_file(self, data):
+        fd, path = tempfile.mkstemp(suffix='.xml')
+        os.write(fd, data)
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        return path
+
+    @ParameterizedTestCase.parameterize(
+        ('mmap',), [(True,), (False,)])
+    def test_parse_file(self, mmap):
+        path = self.write_file(self.get_books_xml())
+        for backend in ezxml.available_backends():
+            obj = ezxml.parse_file(path, mmap=mmap, backend=backend, attributes=True)
+            self.assertEqual(obj.response_data, ezxml.fromstring(self.get_books_xml(), attributes=True).response_data)
+
+    def test_lazy(self):
+        path = self.write_file(self.get_books_xml())
+        obj = ezxml.parse_file(path, lazy=True)
+        self.assertEqual(obj.Items.Item[1].ISBN, int('9780321558237'))
+
+    def test_index_by(self):
+        path = self.write_file(b'<Items><Item id="a">1</Item><Item id="b">2</Item></Items>')
+        self.assertEqual(ezxml.parse_file(path, index_by='id').lookup('b'), 2)
+
+    @ParameterizedTestCase.parameterize(
+        ('mmap',), [(True,), (False,)])
+    def test_records(self, mmap):
+        path = self.write_file(self.get_books_xml())
+        isbns = [item.ISBN for item in ezxml.parse_file(path, tag='Item', mmap=mmap)]
+        self.assertEqual(isbns, [int('0321558235'), int('9780321558237')])
+
+    def test_bounded_submission(self):
+        submitted = []
+
+        class Result(object):
+            def __init__(self, value):
+                self.value = value
+
+            def get(self):
+                return self.value
+
+        class Pool(object):
+            def apply_async(self, func, args):
+                submitted.append(args[0])
+                return Result(func(*args))
+
+        results = ezxml._submit_bounded(Pool(), lambda n: n * 2, range(10), 3)
+        self.assertEqual(submitted, [])
+        self.assertEqual(next(results), 0)
+        self.assertEqual(submitted, [0, 1, 2, 3])
+        self.assertEqual(list(results), [2 * n for n in range(1, 10)])
+        self.assertEqual(submitted, list(range(10)))
+
+    def test_empty_file(self):
+        path = self.write_file(b'')
+        self.assertRaises(SyntaxError, ezxml.parse_file, path)
+        self.assertRaises(SyntaxError, list, ezxml.parse_file(path, tag='Item'))
+
+
+class ParseCacheTests(EZXMLTests):
+
+    def test_hits(self):
+        cache = ezxml.ParseCache()
+        first = ezxml.fromstring(self.get_books_xml(), cache=cache)
+        second = ezxml.fromstring(self.get_books_xml(), cache=cache)
+        self.assertEqual(first.response_data, ezxml.fromstring(self.get_books_xml()).response_data)
+        self.assertTrue(first.response_data is second.response_data)
+        self.assertFalse(first is second)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (1, 1, 1))
+        self.assertEqual(stats['bytes'], ezxml.ParseCache.entry_size((ezxml.arrayify_xml(self.get_books_xml()), None)))
+
+    def test_options_are_part_of_the_key(self):
+        cache = ezxml.ParseCache()
+        xml = b'<Items><Item id="a">1</Item></Items>'
+        plain = ezxml.fromstring(xml, cache=cache)
+        with_attributes = ezxml.fromstring(xml, cache=cache, attributes=True)
+        self.assertEqual(with_attributes.response_data, ezxml.fromstring(xml, attributes=True).response_data)
+        self.assertNotEqual(plain.response_data, with_attributes.response_data)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_index_by(self):
+        cache = ezxml.ParseCache()
+        xml = b'<Items><Item id="a">1</Item><Item id="b">2</Item></Items>'
+        ezxml.fromstring(xml, cache=cache, index_by='id')
+        self.assertEqual(ezxml.fromstring(xml, cache=cache, index_by='id').lookup('b'), 2)
+        self.assertEqual(ezxml.fromstring(xml, cache=cache).lookup('b'), None)
+
+    def test_eviction(self):
+        documents = [b'<Items><Item>%d</Item></Items>' % i for i in range(3)]
+        size = ezxml.ParseCache.entry_size(({'Items': {'Item': 0}}, None))
+        cache = ezxml.ParseCache(max_bytes=size * 2)
+        for xml in documents:
+            ezxml.fromstring(xml, cache=cache)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertTrue(cache.stats()['bytes'] <= cache.max_bytes)
+
+        # The least recently used document was evicted
+        ezxml.fromstring(documents[2], cache=cache)
+        self.assertEqual(cache.stats()['hits'], 1)
+        ezxml.fromstring(documents[0], cache=cache)
+        self.assertEqual(cache.stats()['misses'], 4)
+
+    def test_entry_size(self):
+        # Counts the memory used by the data, not the length of the document
+        short = ezxml.ParseCache.entry_size({'a': [1, 2, 3]})
+        self.assertTrue(short > ezxml.ParseCache.entry_size({'a': [1]}))
+        self.assertTrue(short > len(b'<r><a>1</a><a>2</a><a>3</a></r>'))
+
+        # Shared objects are counted once
+        shared = [u'x' * 1000]
+        self.assertEqual(ezxml.ParseCache.entry_size((shared, shared)),
+                         ezxml.ParseCache.entry_size(shared) + sys.getsizeof((shared, shared)))
+
+    def test_disk_tier(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        xml = b'<Items><Item id="a">1</Item><Item id="b">2</Item></Items>'
+
+        ezxml.fromstring(xml, cache=ezxml.ParseCache(directory=directory), index_by='id')
+        cache = ezxml.ParseCache(directory=directory)
+        obj = ezxml.fromstring(xml, cache=cache, index_by='id')
+        self.assertEqual(obj.response_data, ezxml.fromstring(xml).response_data)
+        self.assertEqual(obj.lookup('a'), 1)
+        self.assertEqual(cache.stats()['disk_hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 0)
+
+    def test_invalid_disk_entries(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        xml = b'<Items><Item id="a">1</Item></Items>'
+        ezxml.fromstring(xml, cache=ezxml.ParseCache(directory=directory), index_by='id')
+        path = os.path.join(directory, os.listdir(directory)[0])
+
+        # Files that aren't entries are never unpickled, but parsed again
+        for content in [b'', b'garbage', pickle.dumps(({'Item': 2}, 10)), ezxml.dumps_binary({'Item': 2})]:
+            with open(path, 'wb') as f:
+                f.write(content)
+            cache = ezxml.ParseCache(directory=directory)
+            obj = ezxml.fromstring(xml, cache=cache, index_by='id')
+            self.assertEqual((obj.Item, obj.lookup('a')), (1, 1))
+            self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_custom_types_are_not_written_to_disk(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache = ezxml.ParseCache(directory=directory)
+        ezxml.fromstring(self.get_books_xml(), cache=cache, types=ezxml.default_types.copy())
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_lazy(self):
+        self.assertRaises(ValueError, ezxml.fromstring, self.get_books_xml(), lazy=True, cache=ezxml.ParseCache())
+
+
+class BinaryTests(EZXMLTests):
+
+    @ParameterizedTestCase.parameterize(
+        ('fixture',), [('get_books_xml',), ('get_people_xml',), ('get_pricing_xml',), ('get_plist_xml',)])
+    def test_round_trip(self, fixture):
+        obj = ezxml.fromstring(getattr(self, fixture)(), attributes=True)
+        loaded = ezxml.loads_binary(obj.dumps())
+        self.assertTrue(isinstance(loaded, ezxml.Objectifier))
+        self.assertEqual(loaded.response_data, obj.response_data)
+
+    def test_leaf_types(self):
+        data = {
+            'ints': [0, 1, -1, 255, 256, -129, 2 ** 40, -2 ** 63, 2 ** 63 - 1],
+            'big': [2 ** 63, -2 ** 63 - 1, 10 ** 30],
+            'floats': [0.5, -1e300, float('inf')],
+            'others': [True, False, None, u'', u'caf\xe9 \u2603', {}, []],
+        }
+        loaded = ezxml.loads_binary(ezxml.dumps_binary(data))
+        self.assertEqual(loaded.response_data, data)
+        self.assertTrue(loaded.others[0] is True)
+        self.assertTrue(loaded.others[2] is None)
+
+    def test_scalars_and_lists(self):
+        self.assertEqual(ezxml.loads_binary(ezxml.dumps_binary(42)), 42)
+        self.assertEqual(ezxml.loads_binary(ezxml.dumps_binary(u'text')), u'text')
+        self.assertEqual(ezxml.loads_binary(ezxml.dumps_binary([1, [2, [3]]])).response_data, [1, [2, [3]]])
+
+    def test_deep(self):
+        depth = sys.getrecursionlimit() * 2
+        xml = '<a>' * depth + '<b>1</b>' + '</a>' * depth
+        value = ezxml.loads_binary(ezxml.fromstring(xml).dumps()).response_data
+        for i in range(depth - 1):
+            value = value['a']
+        self.assertEqual(value, {'b': 1})
+
+    def test_strings_are_stored_once(self):
+        obj = ezxml.fromstring(self.get_books_xml())
+        data = obj.dumps()
+        self.assertEqual(data.count(b'ISBN'), 1)
+        items = ezxml.loads_binary(data).response_data['Items']['Item']
+        self.assertTrue(list(items[0].keys())[0] is list(items[1].keys())[0])
+
+    def test_smaller_than_xml(self):
+        xml = ''.join(['<Item><ISBN>%d</ISBN><Price>%d.99</Price></Item>' % (i, i) for i in range(100)])
+        xml = '<Items>%s</Items>' % xml
+        self.assertTrue(len(ezxml.fromstring(xml).dumps()) < len(xml) / 2)
+
+    def test_errors(self):
+        self.assertRaises(ValueError, ezxml.loads_binary, b'<Items/>')
+        self.assertRaises(ValueError, ezxml.loads_binary, ezxml.BINARY_MAGIC + b'\xff')
+        self.assertRaises(ValueError, ezxml.loads_binary, ezxml.BINARY_MAGIC)
+        self.assertRaises(TypeError, ezxml.dumps_binary, {'a': object()})
+        self.assertRaises(TypeError, ezxml.dumps_binary, {1: 'a'})
+
+    def test_truncated(self):
+        data = ezxml.fromstring(self.get_pricing_xml()).dumps()
+        for length in range(len(ezxml.BINARY_MAGIC), len(data)):
+            self.assertRaises(ValueError, ezxml.loads_binary, data[:length])
+
+
+class SerializationTests(EZXMLTests):
+
+    @ParameterizedTestCase.parameterize(
+        ('fixture',), [('get_books_xml',), ('get_people_xml',), ('get_pricing_xml',), ('get_plist_xml',),
+                       ('get_sample_xhtml',)])
+    def test_round_trip(self, fixture):
+        obj = ezxml.fromstring(getattr(self, fixture)(), attributes=True)
+        xml = ezxml.tostring(obj)
+        self.assertTrue(isinstance(xml, bytes))
+        self.assertEqual(ezxml.fromstring(xml, attributes=True).response_data, obj.response_data)
+
+    def test_leaves(self):
+        children = [b'<Count>-2</Count>', b'<Price>1.5</Price>', b'<InStock>true</InStock>', b'<Note/>',
+                    b'<Name lang="en">Tom &amp; Jerry &lt;3</Name>', b'<Empty lang="fr"/>']
+        xml = b'<Item id="1">' + b''.join(children) + b'</Item>'
+        written = ezxml.tostring(ezxml.fromstring(xml, attributes=True))
+        self.assertTrue(written.startswith(b'<Item id="1">') and written.endswith(b'</Item>'))
+        # The children are written in the order of the dict they are in
+        self.assertEqual(len(written), len(xml))
+        for child in children:
+            self.assertTrue(child in written)
+
+    def test_escaping(self):
+        data = {'@': {'title': u'"a" & <b>\n'}, 'Name': u'x < y & z > w'}
+        xml = ezxml.tostring(data, tag='Item')
+        self.assertEqual(xml, b'<Item title="&quot;a&quot; &amp; &lt;b&gt;&#10;"><Name>x &lt; y &amp; z &gt; w</Name></Item>')
+        self.assertEqual(ezxml.fromstring(xml, attributes=True).response_data, data)
+
+    def test_navigated_objects(self):
+        obj = ezxml.fromstring(self.get_books_xml())
+        self.assertEqual(ezxml.tostring(obj.Items.Item[1]), b'<Item><ISBN>9780321558237</ISBN></Item>')
+        self.assertEqual(ezxml.tostring(obj.Items), ezxml.tostring(obj.Items, tag='Items'))
+        lazy = ezxml.fromstring(self.get_books_xml(), lazy=True)
+        self.assertEqual(ezxml.tostring(lazy), ezxml.tostring(obj))
+        self.assertRaises(ValueError, ezxml.tostring, {'a': 1})
+
+    def test_xml_namespace(self):
+        obj = ezxml.fromstring(b'<html xml:lang="en"><p xml:space="preserve">x</p></html>', attributes=True)
+        self.assertEqual(ezxml.tostring(obj), b'<html xml:lang="en"><p xml:space="preserve">x</p></html>')
+
+    def test_namespaces(self):
+        xml = (b'<a:Feed xmlns:a="urn:a" xmlns:b="urn:b"><a:Entry b:id="1"><b:Title>x</b:Title>'
+               b'<Plain>y</Plain></a:Entry><a:Entry b:id="2"><b:Title>z</b:Title></a:Entry></a:Feed>')
+        obj = ezxml.fromstring(xml, attributes=True)
+        written = ezxml.tostring(obj)
+        self.assertEqual(ezxml.fromstring(written, attributes=True).response_data, obj.response_data)
+
+    def test_namespaced_leaves(self):
+        # Each leaf declares its namespace itself, as no ancestor does
+        xml = b'<r xmlns:x="urn:x"><x:a>1</x:a><x:b>2</x:b><x:c/></r>'
+        obj = ezxml.fromstring(xml)
+        written = ezxml.tostring(obj)
+        self.assertEqual(ezxml.fromstring(written).response_data, obj.response_data)
+        self.assertEqual(ezxml.tostring({'{urn:x}a': 1}, tag='r'), b'<r><ns0:a xmlns:ns0="urn:x">1</ns0:a></r>')
+
+    def test_encodings(self):
+        data = {'Name': u'caf\xe9'}
+        self.assertEqual(ezxml.tostring(data, tag='Item'), b'<Item><Name>caf&#233;</Name></Item>')
+        self.assertEqual(ezxml.tostring(data, tag='Item', encoding='utf-8'),
+                         b'<Item><Name>caf\xc3\xa9</Name></Item>')
+        self.assertEqual(ezxml.tostring(data, tag='Item', encoding='unicode'), u'<Item><Name>caf\xe9</Name></Item>')
+        self.assertEqual(ezxml.tostring(data, tag='Item', encoding='iso-8859-1'),
+                         b"<?xml version='1.0' encoding='iso-8859-1'?>\n<Item><Name>caf\xe9</Name></Item>")
+
+    def test_deep(self):
+        depth = sys.getrecursionlimit() * 2
+        xml = '<a>' * depth + '<b>1</b>' + '</a>' * depth
+        self.assertEqual(ezxml.tostring(ezxml.fromstring(xml), encoding='unicode'), xml)
+
+    def test_streaming(self):
+        source = io.BytesIO(self.get_books_xml())
+        f = io.BytesIO()
+        writes = []
+
+        class RecordingFile(object):
+            def write(self, data):
+                writes.append(data)
+                f.write(data)
+
+        writer = ezxml.XMLWriter(RecordingFile(), buffer_size=16)
+        writer.start('Books', {'count': 2})
+        writer.start('Items')
+        for item in ezxml.iterparse(source, 'Item'):
+            writer.element('Item', item)
+        writer.close()
+
+        self.assertTrue(len(writes) > 2)
+        self.assertEqual(f.getvalue(), b'<Books count="2"><Items><Item><ISBN>321558235</ISBN></Item>'
+                                       b'<Item><ISBN>9780321558237</ISBN></Item></Items></Books>')
+
+    def test_json(self):
+        obj = ezxml.fromstring(self.get_books_xml())
+        self.assertEqual(json.loads(obj.to_json()), obj.response_data)
+        self.assertEqual(obj.to_json(sort_keys=True, indent=1), json.dumps(obj.response_data, sort_keys=True, indent=1))
+        written = []
+
+        class File(object):
+            def write(self, data):
+                written.append(data)
+
+        ezxml.write_json(obj.Items, File())
+        self.assertEqual(json.loads(''.join(written)), obj.response_data['Items'])
+
+
+class InstrumentationTests(EZXMLTests):
+
+    def test_phases_and_counts(self):
+        for backend in ezxml.available_backends():
+            with ezxml.instrument() as stats:
+                ezxml.fromstring(self.get_books_xml(), backend=backend)
+            self.assertEqual((stats.nodes, stats.leaves), (6, 2))
+            if backend == 'expat':
+                self.assertEqual(sorted(stats.seconds), ['parse_convert'])
+            else:
+                self.assertEqual(sorted(stats.seconds), ['convert', 'parse'])
+                self.assertEqual(stats.calls, {'convert': 1, 'parse': 1})
+
+    def test_wrappers(self):
+        obj = ezxml.fromstring(self.get_books_xml())
+        with ezxml.instrument() as stats:
+            obj.Items.Item[0].ISBN
+            obj.Items.Item[0].ISBN
+        self.assertEqual(stats.wrappers, 3)
+        self.assertEqual(stats.calls['wrap'], 3)
+
+        lazy = ezxml.fromstring(self.get_books_xml(), lazy=True)
+        with ezxml.instrument() as stats:
+            lazy.Items.Item[1].ISBN
+        self.assertEqual(stats.wrappers, 2)
+
+    def test_coercion_failures(self):
+        types = ezxml.default_types.copy()
+        types.hint('ISBN', 'bool')
+        with ezxml.instrument() as stats:
+            ezxml.fromstring(self.get_books_xml(), types=types)
+        self.assertEqual(stats.coercion_failures, 2)
+
+    def test_disabled(self):
+        stats = ezxml.Instrumentation()
+        with ezxml.instrument(stats):
+            with ezxml.instrument() as inner:
+                ezxml.fromstring(self.get_books_xml())
+            ezxml.fromstring(self.get_people_xml())
+        ezxml.fromstring(self.get_pricing_xml())
+        self.assertEqual(inner.nodes, 6)
+        self.assertEqual(stats.nodes, 7)
+        self.assertTrue(ezxml._instrumentation is None)
+
+    def test_overlapping(self):
+        # As when blocks in two threads overlap without nesting
+        first = ezxml.instrument()
+        second = ezxml.instrument()
+        a = first.__enter__()
+        b = second.__enter__()
+        first.__exit__(None, None, None)
+        ezxml.fromstring(self.get_books_xml())
+        second.__exit__(None, None, None)
+        ezxml.fromstring(self.get_people_xml())
+        self.assertEqual((a.nodes, b.nodes), (0, 6))
+        self.assertTrue(ezxml._instrumentation is None)
+
+    def test_as_dict(self):
+        with ezxml.instrument() as stats:
+            ezxml.fromstring(self.get_books_xml()).Items
+        data = json.loads(json.dumps(stats.as_dict()))
+        self.assertEqual(sorted(data), ['calls', 'coercion_failures', 'leaves', 'nodes', 'seconds', 'wrappers'])
+        self.assertEqual(data['wrappers'], 1)
+
+
+class ProjectionTests(EZXMLTests):
+
+    def test_include(self):
+        for backend in ezxml.available_backends():
+            obj = ezxml.fromstring(self.get_pricing_xml(), backend=backend, include=['Items/Item/BiblioId'])
+            self.assertEqual(obj.response_data, {'Items': {'Item': [{'BiblioId': 15536985}, {'BiblioId': 16432444}]}})
+
+            obj = ezxml.fromstring(self.get_pricing_xml(), backend=backend, include=['ResponseHeader', 'Items'])
+            self.assertEqual(obj.response_data, ezxml.fromstring(self.get_pricing_xml()).response_data)
+
+    def test_skipped_content(self):
+        xml = (b'<Response><Header><Status>OK</Status><Debug><Trace>1</Trace></Debug></Header>'
+               b'<Items>text<Item id="1"><ISBN>1</ISBN><Blob>xxx<b>y</b></Blob></Item>more'
+               b'<Item id="2"><ISBN>2</ISBN></Item></Items><Payload>zzz</Payload></Response>')
+        for backend in ezxml.available_backends():
+            obj = ezxml.fromstring(xml, backend=backend, attributes=True, index_by='id',
+                                   include=['Items/Item/ISBN', 'Header/Status'])
+            self.assertEqual(obj.response_data, {
+                'Header': {'Status': 'OK'},
+                'Items': {'Item': [{'@': {'id': '1'}, 'ISBN': 1}, {'@': {'id': '2'}, 'ISBN': 2}]},
+            })
+            self.assertEqual(obj.lookup('2').ISBN, 2)
+
+    def test_missing_fields(self):
+        obj = ezxml.fromstring(self.get_books_xml(), include=['Items/Item/Title'])
+        self.assertEqual(obj.response_data, {'Items': {'Item': [None, None]}})
+
+    def test_wildcard(self):
+        obj = ezxml.fromstring(self.get_people_xml(), include=['*/Name'])
+        self.assertEqual(obj.select('Person/Name'), ['Marc', 'Zach'])
+        self.assertEqual(obj.select('Person/Age'), [])
+
+        obj = ezxml.fromstring(self.get_people_xml(), include=['*/Name', 'Person/Age'])
+        self.assertEqual(obj.response_data, ezxml.fromstring(self.get_people_xml()).response_data)
+
+    def test_lazy(self):
+        include = ['Items/Item/BiblioId']
+        lazy = ezxml.fromstring(self.get_pricing_xml(), lazy=True, include=include)
+        self.assertEqual(lazy.Items.Item[1].BiblioId, 16432444)
+        self.assertEqual(lazy.ResponseHeader, None)
+        self.assertEqual(lazy.response_data, ezxml.fromstring(self.get_pricing_xml(), include=include).response_data)
+
+    def test_namespaces(self):
+        xml = b'<a:Feed xmlns:a="urn:a"><a:Meta>x</a:Meta><a:Entry><a:Id>1</a:Id><a:Body>b</a:Body></a:Entry></a:Feed>'
+        for backend in ezxml.available_backends():
+            obj = ezxml.fromstring(xml, backend=backend, nsmap={'': 'urn:a'}, include=['Entry/Id'])
+            self.assertEqual(obj.response_data, {'Entry': {'Id': 1}})
+
+    def test_parse_file(self):
+        fd, path = tempfile.mkstemp(suffix='.xml')
+        os.write(fd, self.get_pricing_xml())
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        for backend in ezxml.available_backends():
+            obj = ezxml.parse_file(path, backend=backend, include=['Items/Item/BiblioId'])
+            self.assertEqual(obj.select('Items/Item/BiblioId'), [15536985, 16432444])
+            self.assertEqual(obj.ResponseHeader, None)
+
+    def test_only_included_nodes_are_converted(self):
+        with ezxml.instrument() as stats:
+            ezxml.fromstring(self.get_pricing_xml(), include=['Items/Item/BiblioId'])
+        self.assertEqual((stats.nodes, stats.leaves), (6, 2))
+
+    def test_cache_key(self):
+        cache = ezxml.ParseCache()
+        full = ezxml.fromstring(self.get_pricing_xml(), cache=cache)
+        projected = ezxml.fromstring(self.get_pricing_xml(), cache=cache, include=['ResponseHeader'])
+        self.assertNotEqual(full.response_data, projected.response_data)
+
+    def test_invalid_paths(self):
+        self.assertRaises(ValueError, ezxml.fromstring, self.get_pricing_xml(), include=['Items/Item[0]'])
+
+
+class ColumnTests(EZXMLTests):
+
+    xml = (b'<Catalog><Book id="1"><ISBN>0321558235</ISBN><Title>A</Title><Price>9.5</Price>'
+           b'<InStock>true</InStock><Author><Name>X</Name></Author></Book>'
+           b'<Shelf><Book id="2"><ISBN>9780321558237</ISBN><Title>B</Title><Price>12</Price>'
+           b'<InStock>false</InStock></Book></Shelf></Catalog>')
+
+    def test_columns(self):
+        columns = ezxml.to_columns(self.xml, 'Book', [('ISBN', int), ('Title', str), ('Price', float),
+                                                       ('InStock', bool), ('@id', 'i'), ('Author/Name', str)],
+                                   as_numpy=False)
+        self.assertEqual(list(columns), ['ISBN', 'Title', 'Price', 'InStock', '@id', 'Author/Name'])
+        # 'q' (long long) where the array module has it, i.e. on Python 3
+        self.assertTrue(columns['ISBN'].typecode in ('q', 'l'))
+        self.assertEqual(columns['ISBN'].tolist(), [321558235, 9780321558237])
+        self.assertEqual(columns['Title'], ['A', 'B'])
+        self.assertEqual(columns['Price'].tolist(), [9.5, 12.0])
+        self.assertEqual(columns['InStock'].tolist(), [1, 0])
+        self.assertEqual(columns['@id'].typecode, 'i')
+        self.assertEqual(columns['@id'].tolist(), [1, 2])
+        self.assertEqual(columns['Author/Name'], ['X', None])
+
+    def test_missing_values(self):
+        self.assertRaises(ValueError, ezxml.to_columns, self.xml, 'Book', {'Pages': int}, as_numpy=False)
+        self.assertRaises(ValueError, ezxml.to_columns, self.xml, 'Book', {'Title': int}, as_numpy=False)
+        columns = ezxml.to_columns(self.xml, 'Book', {'Pages': int}, defaults={'Pages': -1}, as_numpy=False)
+        self.assertEqual(columns['Pages'].tolist(), [-1, -1])
+
+    def test_invalid_fields(self):
+        self.assertRaises(ValueError, ezxml.to_columns, self.xml, 'Book', {'Author[0]/Name': str})
+        self.assertRaises(TypeError, ezxml.to_columns, self.xml, 'Book', {'ISBN': 'int'})
+
+    def test_sources(self):
+        fd, path = tempfile.mkstemp(suffix='.xml')
+        os.write(fd, self.xml)
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        for source in [path, io.BytesIO(self.xml), self.xml.decode('ascii'), b'\n  ' + self.xml]:
+            columns = ezxml.to_columns(source, 'Book', {'ISBN': int}, as_numpy=False)
+            self.assertEqual(columns['ISBN'].tolist(), [321558235, 9780321558237])
+
+    def test_namespaces(self):
+        xml = b'<a:Feed xmlns:a="urn:a" xmlns:b="urn:b"><a:Entry b:id="7"><a:Id>1</a:Id></a:Entry></a:Feed>'
+        columns = ezxml.to_columns(xml, 'Entry', [('Id', int), ('@b_id', int)],
+                                   nsmap={'': 'urn:a', 'b': 'urn:b'}, as_numpy=False)
+        self.assertEqual((columns['Id'].tolist(), columns['@b_id'].tolist()), ([1], [7]))
+
+    def test_numpy(self):
+        if ezxml.numpy is None:
+            self.assertRaises(ImportError, ezxml.to_columns, self.xml, 'Book', {'ISBN': int}, as_numpy=True)
+            return
+        columns = ezxml.to_columns(self.xml, 'Book', {'ISBN': int, 'InStock': bool, 'Title': str})
+        self.assertEqual(columns['ISBN'].dtype.kind, 'i')
+        self.assertEqual(columns['InStock'].tolist(), [True, False])
+        self.assertEqual(columns['Title'].tolist(), ['A', 'B'])
+
+
+class SchemaTests(EZXMLTests):
+
+    def test_sample(self):
+        schema = ezxml.compile_schema(self.get_people_xml())
+        self.assertEqual(list(schema.classes), ['People', 'People/Person'])
+        self.assertEqual(schema.classes['People/Person']._fields, ('Name', 'Age'))
+
+        for backend in ezxml.available_backends():
+            people = schema.fromstring(self.get_people_xml(), backend=backend)
+            self.assertTrue(isinstance(people, schema.root))
+            self.assertEqual([person.Name for person in people.Person], ['Marc', 'Zach'])
+            self.assertEqual(people.Person[1].Age, 3)
+            self.assertFalse(hasattr(people.Person[0], '__dict__'))
+
+    def test_response_data(self):
+        for xml in [self.get_books_xml(), self.get_people_xml(), self.get_pricing_xml()]:
+            record = ezxml.compile_schema(xml).fromstring(xml)
+            self.assertEqual(record.response_data, ezxml.fromstring(xml).response_data)
+
+    def test_declared(self):
+        schema = ezxml.compile_schema({'Books': {'Book': [{'ISBN': int, 'Price': float, 'Tags': {'Tag': [str]}}]}})
+        xml = (b'<Books><Book><ISBN>1</ISBN><Price>2</Price><Extra><ISBN>3</ISBN></Extra>'
+               b'<Tags><Tag>a</Tag></Tags></Book><Book><Price>x</Price><Tags/></Book></Books>')
+        books = schema.fromstring(xml)
+        first, second = books.Book
+        self.assertEqual((first.ISBN, first.Price, first.Tags.Tag), (1, 2.0, ['a']))
+        self.assertEqual((second.ISBN, second.Price, second.Tags), (None, 'x', None))
+        self.assertEqual(first, schema.fromstring(xml).Book[0])
+        self.assertNotEqual(first, second)
+        self.assertEqual(repr(first.Tags), "Tags(Tag=['a'])")
+        self.assertEqual(first['ISBN'], 1)
+        self.assertEqual(second.get('ISBN', 0), 0)
+        self.assertEqual(second.get('Missing', 0), 0)
+
+        # Repeated elements are always lists, other elements only if they repeat
+        books = schema.fromstring(b'<Books><Book><ISBN>1</ISBN><ISBN>2</ISBN></Book></Books>')
+        self.assertEqual((books.Book[0].ISBN, books.Book[0].Tags), ([1, 2], None))
+        self.assertEqual(schema.fromstring(b'<Books/>'), None)
+        self.assertEqual(schema.fromstring(b'<Books><Other/></Books>').Book, [])
+
+    def test_converters(self):
+        schema = ezxml.compile_schema({'Row': {'Amount': lambda text: int(text) * 100, 'Flag': bool}})
+        row = schema.fromstring(b'<Row><Amount>3</Amount><Flag>true</Flag></Row>')
+        self.assertEqual((row.Amount, row.Flag), (300, True))
+
+    def test_custom_types(self):
+        types = ezxml.default_types.copy()
+        types.register('date', lambda text: datetime.datetime.strptime(text, '%Y-%m-%d').date())
+        sample = b'<Orders><Order><Id>1</Id><Date>2024-01-31</Date></Order></Orders>'
+        schema = ezxml.compile_schema(sample, types=types)
+        self.assertEqual(schema.fromstring(sample).Order.Date, datetime.date(2024, 1, 31))
+
+        # Text the type doesn't accept stays text
+        xml = b'<Orders><Order><Id>1</Id><Date>2024-01-31</Date></Order><Order><Id>2</Id><Date>-</Date></Order></Orders>'
+        self.assertEqual([(order.Id, order.Date) for order in schema.fromstring(xml).Order],
+                         [(1, datetime.date(2024, 1, 31)), (2, '-')])
+
+    def test_identifiers(self):
+        fields = ezxml.OrderedDict([(tag, str) for tag in ['my-tag', 'class', '2x', 'get', 'my_tag', '__x', '__init__']])
+        schema = ezxml.compile_schema({'Root': fields})
+        self.assertEqual(schema.root._fields, ('my_tag', 'class_', '_2x', 'get_', 'my_tag_', '_x', '_init__'))
+        root = schema.fromstring(b'<Root><my-tag>a</my-tag><class>b</class><get>c</get><my_tag>d</my_tag>'
+                                 b'<__x>e</__x><__init__>f</__init__></Root>')
+        self.assertEqual((root.my_tag, root.class_, root.get_, root.my_tag_, root._x, root._init__),
+                         ('a', 'b', 'c', 'd', 'e', 'f'))
+        self.assertEqual(root['my-tag'], 'a')
+
+    def test_namespaces(self):
+        xml = b'<a:Feed xmlns:a="urn:a"><a:Entry><a:Id>1</a:Id></a:Entry><a:Entry><a:Id>2</a:Id></a:Entry></a:Feed>'
+        schema = ezxml.compile_schema(xml, nsmap={'': 'urn:a'})
+        self.assertEqual([entry.Id for entry in schema.fromstring(xml).Entry], [1, 2])
+
+    def test_parse_file(self):
+        fd, path = tempfile.mkstemp(suffix='.xml')
+        os.write(fd, self.get_pricing_xml())
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        schema = ezxml.compile_schema(self.get_pricing_xml())
+        for backend in ezxml.available_backends():
+            self.assertEqual(schema.parse_file(path, backend=backend).Items.Item[0].BiblioId, 15536985)
+
+    def test_invalid(self):
+        schema = ezxml.compile_schema(self.get_people_xml())
+        self.assertRaises(ValueError, schema.fromstring, self.get_books_xml())
+        self.assertRaises(ValueError, ezxml.compile_schema, {'A': str, 'B': str})
+        self.assertRaises(ValueError, ezxml.compile_schema, {'A': {'B': [int, str]}})
+        self.assertRaises(TypeError, ezxml.compile_schema, {'A': {'B': 'int'}})
+
+
+class BudgetTests(EZXMLTests):
+
+    def assertExceeds(self, limit, func, *args, **kwargs):
+        try:
+            func(*args, **kwargs)
+        except ezxml.BudgetExceeded as e:
+            self.assertEqual(e.limit, limit)
+            return e.stats
+        self.fail("BudgetExceeded not raised")
+
+    def test_limits(self):
+        deep = deep_xml(5000)
+        wide = wide_xml(1000)
+        for backend in ezxml.available_backends():
+            stats = self.assertExceeds('max_depth', ezxml.fromstring, deep, backend=backend,
+                                       budget=ezxml.Budget(max_depth=100))
+            self.assertEqual((stats['depth'], stats['nodes']), (101, 101))
+
+            stats = self.assertExceeds('max_nodes', ezxml.fromstring, wide, backend=backend,
+                                       budget=ezxml.Budget(max_nodes=50))
+            self.assertEqual(stats['nodes'], 51)
+
+            stats = self.assertExceeds('max_text', ezxml.fromstring, wide, backend=backend,
+                                       budget=ezxml.Budget(max_text=100))
+            self.assertTrue(100 < stats['text'] < 120)
+            self.assertTrue(stats['nodes'] < 100)
+
+            self.assertExceeds('timeout', ezxml.fromstring, wide, backend=backend, budget=ezxml.Budget(timeout=0))
+
+            budget = ezxml.Budget(max_depth=4, max_nodes=3002, max_text=100000, timeout=60)
+            self.assertEqual(ezxml.fromstring(wide, backend=backend, budget=budget).response_data,
+                             ezxml.fromstring(wide, backend=backend).response_data)
+
+    def test_timeout_in_text(self):
+        # A single element, so the timeout can only be noticed in its text
+        xml = b'<a>' + b'x' * 1000000 + b'</a>'
+        for backend in ezxml.available_backends():
+            self.assertExceeds('timeout', ezxml.fromstring, xml, backend=backend, budget=ezxml.Budget(timeout=0))
+        self.assertExceeds('timeout', list, ezxml.iterparse(io.BytesIO(xml), 'a', budget=ezxml.Budget(timeout=0)))
+
+    def test_entry_points(self):
+        wide = wide_xml(1000)
+        budget = ezxml.Budget(max_nodes=50)
+
+        self.assertExceeds('max_nodes', ezxml.fromstring, wide, lazy=True, budget=budget)
+        self.assertExceeds('max_nodes', ezxml.fromstring, wide, include=['Items/Item/ISBN'], budget=budget)
+        self.assertExceeds('max_nodes', ezxml.fromstring, wide, cache=ezxml.ParseCache(), budget=budget)
+        self.assertExceeds('max_nodes', ezxml.arrayify_etree, ezxml.ElementTree.fromstring(wide), budget=budget)
+        self.assertExceeds('max_nodes', ezxml.to_columns, wide, 'Item', {'ISBN': int}, as_numpy=False, budget=budget)
+        self.assertExceeds('max_nodes', ezxml.compile_schema(wide).fromstring, wide, budget=budget)
+        self.assertExceeds('max_nodes', list, ezxml.parse_many([wide], workers=2, budget=budget))
+
+        fd, path = tempfile.mkstemp(suffix='.xml')
+        os.write(fd, wide)
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        self.assertExceeds('max_nodes', ezxml.parse_file, path, budget=budget)
+
+        # Records before the limit are still delivered
+        records = []
+        self.assertExceeds('max_nodes', records.extend, ezxml.parse_file(path, tag='Item', budget=budget))
+        self.assertEqual(len(records), 16)
+
+    def test_events_after_failure(self):
+        # Python 2's cElementTree goes on calling the target after it raised
+        target = ezxml._limit_target(ezxml.DictTreeBuilder(), None, ezxml.Budget(max_nodes=1))
+        target.start('a', {})
+        self.assertRaises(ezxml.BudgetExceeded, target.start, 'b', {})
+        target.data('text')
+        target.end('b')
+        target.end('a')
+        self.assertRaises(ezxml.BudgetExceeded, target.close)
+
+    def test_pickle(self):
+        budget = pickle.loads(pickle.dumps(ezxml.Budget(max_depth=3, timeout=1.5)))
+        self.assertEqual(repr(budget), 'Budget(max_depth=3, max_nodes=None, max_text=None, timeout=1.5)')
+
+        try:
+            ezxml.fromstring(self.get_books_xml(), budget=budget)
+        except ezxml.BudgetExceeded as e:
+            original = e
+        error = pickle.loads(pickle.dumps(original))
+        self.assertTrue(isinstance(error, ValueError))
+        self.assertEqual((error.limit, error.stats['depth']), ('max_depth', 4))
+        self.assertEqual(str(error), str(original))
+
+
+class ParseLargeTests(EZXMLTests):
+
+    def write_file(self, data):
+        fd, path = tempfile.mkstemp(suffix='.xml')
+        os.write(fd, data)
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def assertSameRecords(self, path, tag, **options):
+        data = lambda records: [getattr(r, 'response_data', r) for r in records]
+        expected = data(ezxml.parse_file(path, tag=tag, **options))
+        for workers in [1, 2]:
+            for chunk_size in [1, 100, 10 ** 9]:
+                records = ezxml.parse_large(path, tag, workers=workers, chunk_size=chunk_size, **options)
+                self.assertEqual(data(records), expected)
+        return expected
+
+    def test_records(self):
+        path = self.write_file(wide_xml(200))
+        records = self.assertSameRecords(path, 'Item')
+        self.assertEqual(len(records), 200)
+        self.assertEqual(records[-1], {'ISBN': 199, 'Title': 'Book 199'})
+
+    def test_context(self):
+        xml = (b'<?xml version="1.0" encoding="iso-8859-1"?>\n'
+               b'<f:Feed xmlns:f="urn:f" xmlns="urn:d"><Header><Item>0</Item></Header>'
+               b'<f:Entries a=\'x>y\'>' + b''.join([b'<f:Item n="%d"><Name>caf\xe9 %d</Name></f:Item>\n' % (i, i)
+                                                  for i in range(50)]) +
+               b'<f:Item/></f:Entries><Footer/></f:Feed>')
+        path = self.write_file(xml)
+        records = self.assertSameRecords(path, 'f_Item', nsmap={'f': 'urn:f', '': 'urn:d'}, attributes=True)
+        self.assertEqual(len(records), 51)
+        self.assertEqual(records[7], {'@': {'n': '7'}, 'Name': u'caf\xe9 7'})
+
+    def test_no_records(self):
+        path = self.write_file(self.get_books_xml())
+        self.assertEqual(list(ezxml.parse_large(path, 'Missing', workers=2, chunk_size=1)), [])
+
+    def test_unsplittable(self):
+        xml = b'<Root><Item><Item>1</Item><Item>2</Item></Item><Item>3</Item></Root>'
+        path = self.write_file(xml)
+        self.assertRaises(SyntaxError, list, ezxml.parse_large(path, 'Item', workers=1, chunk_size=1))
+        self.assertEqual(len(list(ezxml.parse_large(path, 'Item', workers=1))), 2)
+
+    def test_bounded_submission(self):
+        submitted = []
+
+        class Result(object):
+            def __init__(self, value):
+                self.value = value
+
+            def get(self):
+                return self.value
+
+        class Pool(object):
+            def apply_async(self, func, args):
+                submitted.append(args[0])
+                return Result(func(*args))
+
+        results = ezxml._submit_bounded(Pool(), lambda n: n * 2, range(10), 3)
+        self.assertEqual(submitted, [])
+        self.assertEqual(next(results), 0)
+        self.assertEqual(submitted, [0, 1, 2, 3])
+        self.assertEqual(list(results), [2 * n for n in range(1, 10)])
+        self.assertEqual(submitted, list(range(10)))
+
+    def test_empty_file(self):
+        path = self.write_file(b'')
+        self.assertRaises(SyntaxError, list, ezxml.parse_large(path, 'Item'))
+
+    def test_budget(self):
+        path = self.write_file(wide_xml(200))
+        nodes = 2 + 200 * 3
+        text = sum([len('%d' % i) + len('Book %d' % i) for i in range(200)])
+
+        # The limits apply to the whole document, not to each chunk
+        for workers in [1, 2]:
+            for limit, within, exceeded in [('max_nodes', {'max_nodes': nodes}, {'max_nodes': nodes - 1}),
+                                            ('max_text', {'max_text': text}, {'max_text': text - 1})]:
+                records = ezxml.parse_large(path, 'Item', workers=workers, chunk_size=100,
+                                            budget=ezxml.Budget(**within))
+                self.assertEqual(len(list(records)), 200)
+                with self.assertRaises(ezxml.BudgetExceeded) as cm:
+                    list(ezxml.parse_large(path, 'Item', workers=workers, chunk_size=100,
+                                           budget=ezxml.Budget(**exceeded)))
+                self.assertEqual(cm.exception.limit, limit)
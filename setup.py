@@ -19,7 +19,7 @@ setup(
     author='Marc Abramowitz',
     author_email='marc@marc-abramowitz.com',
     url='https://github.com/msabramo/python-ezxml',
-    packages=['ezxml'],
+    packages=['ezxml', 'ezxml.benchmarks'],
     tests_require=['lxml'],
     test_suite='ezxml.tests',
     use_2to3=True,